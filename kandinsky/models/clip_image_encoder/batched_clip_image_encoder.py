@@ -0,0 +1,173 @@
+import threading
+import time
+from concurrent.futures import Future
+from queue import Queue, Empty
+
+import numpy as np
+
+import sys
+import os
+sys.path.insert(0, os.getcwd())
+from utility.utils_logger import logger
+from utility.utils import metrics
+
+_STOP = object()
+
+PENDING_IMAGES = metrics.gauge('clip_encoder_pending_images', 'Images queued for the batched CLIP encoder')
+BATCH_SIZE = metrics.histogram('clip_encoder_batch_size', 'Images per forward pass of the batched CLIP encoder',
+                               buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+BATCH_SECONDS = metrics.histogram('clip_encoder_batch_seconds', 'Time to preprocess the deferred frames of a batch and run its forward pass')
+IMAGES = metrics.counter('clip_encoder_images_total', 'Images encoded by the batched CLIP encoder')
+
+
+class _EncodeRequest():
+
+    def __init__(self, pixel_values=None, frame: np.ndarray = None):
+        # a frame is preprocessed with the rest of its batch
+        self.pixel_values = pixel_values
+        self.frame = frame
+        self.future = Future()
+
+
+class BatchedCLIPImageEncoder():
+    """
+    In-process service sharing one `KandinskyCLIPImageEncoder` between threads.
+
+    `get_image_features` has the same interface as the encoder's, so it can be
+    passed to the pipelines in its place. Images are preprocessed in the calling
+    thread, then a single worker thread groups the pending requests of all callers
+    into batches of up to `max_batch_size` images, waiting at most `max_wait`
+    seconds after the first one, and runs one forward pass per batch. The uint8
+    frames are preprocessed by batch in the worker thread too when the encoder
+    preprocesses them on its GPU.
+    """
+
+    def __init__(self, encoder, max_batch_size: int = 32, max_wait: float = 0.01):
+        self.encoder = encoder
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.num_batches = 0
+        self.num_images = 0
+
+        self._requests = Queue()
+        self._closed = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def model_id(self):
+        return self.encoder.model_id
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _get_request(self, image) -> _EncodeRequest:
+        if isinstance(image, np.ndarray):
+            frame_preprocessor = self.encoder.frame_preprocessor
+            if frame_preprocessor is not None and frame_preprocessor.is_batched:
+                return _EncodeRequest(frame=image)
+        # PIL images, frames and pixel tensors, the encoder raises ValueError for other types
+        pixel_values = self.encoder.preprocess(image)
+        return _EncodeRequest(pixel_values if pixel_values.ndim == 4 else pixel_values[None])
+
+    def submit(self, image) -> Future:
+        """
+        Queue a PIL image, a uint8 RGB (H, W, 3) frame or a (3, H, W) / (1, 3, H, W)
+        pixel tensor. The future resolves to its (1, D) float16 features.
+        """
+        request = self._get_request(image)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("BatchedCLIPImageEncoder is closed")
+            self._requests.put(request)
+        PENDING_IMAGES.inc()
+        return request.future
+
+    def get_image_features(self, image):
+        return self.submit(image).result()
+
+    def _collect_batch(self):
+        """
+        Wait for a request, then gather more until the batch is full or `max_wait`
+        has passed. Returns None once the service is closed.
+        """
+        request = self._requests.get()
+        if request is _STOP:
+            return None
+
+        batch = [request]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=timeout)
+            except Empty:
+                break
+            if request is _STOP:
+                # serve the batch, then stop
+                self._requests.put(_STOP)
+                break
+            batch.append(request)
+
+        return batch
+
+    def _run_batch(self, batch):
+        PENDING_IMAGES.dec(len(batch))
+        batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+
+        start_time = time.perf_counter()
+        try:
+            frames = [request.frame for request in batch if request.pixel_values is None]
+            frame_pixel_values = iter(self.encoder.preprocess_frames(frames) if frames else [])
+            pixel_values = self.encoder.concatenate([request.pixel_values if request.pixel_values is not None
+                                                     else next(frame_pixel_values)[None]
+                                                     for request in batch])
+            features = self.encoder.get_pixel_values_features(pixel_values)
+        except Exception as e:
+            logger.error(f"Batched CLIP encoding of {len(batch)} images failed: {e}")
+            for request in batch:
+                request.future.set_exception(e)
+            return
+
+        for index, request in enumerate(batch):
+            request.future.set_result(features[index:index + 1])
+
+        self.num_batches += 1
+        self.num_images += len(batch)
+        BATCH_SECONDS.observe(time.perf_counter() - start_time)
+        BATCH_SIZE.observe(len(batch))
+        IMAGES.inc(len(batch))
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            if batch is None:
+                break
+            self._run_batch(batch)
+
+    def close(self):
+        """
+        Serve the requests already queued and stop the worker thread.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._requests.put(_STOP)
+        self._thread.join()
+
+    def get_stats(self) -> dict:
+        return {
+            'num_batches': self.num_batches,
+            'num_images': self.num_images,
+            'mean_batch_size': self.num_images / self.num_batches if self.num_batches else 0.,
+        }
@@ -4,92 +4,294 @@ import sys
 
 import PIL
 import numpy as np
-import torch
-from torch import nn
 
 sys.path.insert(0, os.getcwd())
 from utility.utils_logger import logger
 from kandinsky.model_paths import PRIOR_MODEL_PATH
-from transformers import CLIPImageProcessor, CLIPVisionModelWithProjection
+from kandinsky.models.clip_image_encoder.inference_backend import (BackendType, TorchBackend, OnnxRuntimeBackend,
+                                                                    get_onnx_model_path, export_onnx, quantize_onnx,
+                                                                    verify_backend)
+from kandinsky.models.clip_image_encoder.frame_preprocessor import FramePreprocessor
 
+# torch and transformers are imported by the torch backend code paths, so that the
+# ONNX Runtime backend preprocesses and encodes frames without them
 
-class KandinskyCLIPImageEncoder(nn.Module):
 
-    def __init__(self, device=None, image_processor=None, vision_model=None):  # , input_mode = PIL.Image.Image):
+class EncoderPrecision:
+    # float16 weights and activations (emulated, hence slow, on most CPUs)
+    FP16 = 'fp16'
+    FP32 = 'fp32'
+    # float32 weights with the linear layers dynamically quantized to INT8, CPU only
+    INT8 = 'int8'
 
-        super().__init__()
+    ALL = (FP16, FP32, INT8)
 
-        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+def is_tensor(value) -> bool:
+    # a tensor only exists once torch is imported
+    torch = sys.modules.get('torch')
+    return torch is not None and isinstance(value, torch.Tensor)
+
+
+class KandinskyCLIPImageEncoder():
+
+    def __init__(self, device=None, image_processor=None, vision_model=None, precision=EncoderPrecision.FP16,
+                 backend=BackendType.TORCH, onnx_batch_size=None, intra_op_num_threads=None, inter_op_num_threads=None):  # , input_mode = PIL.Image.Image):
+
+        if precision not in EncoderPrecision.ALL:
+            raise ValueError(f"Unknown encoder precision {precision}, expected one of {EncoderPrecision.ALL}")
+        if backend not in BackendType.ALL:
+            raise ValueError(f"Unknown encoder backend {backend}, expected one of {BackendType.ALL}")
+        # ONNX Runtime runs on CPU, without fast float16 kernels: fp16 runs as fp32 there
+        if backend == BackendType.ONNX and precision == EncoderPrecision.FP16:
+            precision = EncoderPrecision.FP32
+        self.precision = precision
+        self.backend_type = backend
+        # static batch axis of the exported graph, None for a dynamic one
+        self.onnx_batch_size = onnx_batch_size
+        # ONNX Runtime threads, None for its defaults
+        self.intra_op_num_threads = intra_op_num_threads
+        self.inter_op_num_threads = inter_op_num_threads
+
+        if backend == BackendType.ONNX:
+            self.device = 'cpu'
+            self.input_dtype = None
+            # pixel values stay numpy arrays, as ONNX Runtime takes them
+            self.return_tensors = "np"
+        else:
+            import torch
+
+            # quantized kernels only run on CPU
+            if precision == EncoderPrecision.INT8:
+                self.device = 'cpu'
+            else:
+                self.device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+            # dtype of the pixel values fed to the vision model
+            self.input_dtype = torch.float16 if precision == EncoderPrecision.FP16 else torch.float32
+            self.return_tensors = "pt"
 
         self.vision_model = vision_model
         self.image_processor = image_processor
+        self.frame_preprocessor = None
+        # identifies the vectors of this model and precision, e.g. in caches (set by load_submodels)
+        self.model_id = None
+        self.backend = None
+        if vision_model is not None:
+            self.vision_model = vision_model.to(self.device)
+            self.backend = TorchBackend(self.vision_model, self.device, self.input_dtype)
+
+    def get_quantized_model_path(self, encoder_path=PRIOR_MODEL_PATH):
+        import torch
+
+        # quantized modules are pickled, so the cache is tied to the torch version
+        return os.path.join(encoder_path, "image_encoder", f"int8_dynamic_torch{torch.__version__}.pt")
+
+    def _load_vision_model(self, encoder_path):
+        import torch
+        from transformers import CLIPVisionModelWithProjection
+
+        if self.precision != EncoderPrecision.INT8:
+            torch_dtype = torch.float16 if self.precision == EncoderPrecision.FP16 else torch.float32
+            return CLIPVisionModelWithProjection.from_pretrained(encoder_path,
+                                                                 subfolder="image_encoder",
+                                                                 torch_dtype=torch_dtype,
+                                                                 local_files_only=True)
+
+        quantized_model_path = self.get_quantized_model_path(encoder_path)
+        if os.path.isfile(quantized_model_path):
+            logger.info(f"Loading INT8 CLIP VisionModelWithProjection from : {quantized_model_path}")
+            return torch.load(quantized_model_path, weights_only=False)
+
+        vision_model = CLIPVisionModelWithProjection.from_pretrained(encoder_path,
+                                                                     subfolder="image_encoder",
+                                                                     torch_dtype=torch.float32,
+                                                                     local_files_only=True).eval()
+        vision_model = torch.ao.quantization.quantize_dynamic(vision_model, {torch.nn.Linear}, dtype=torch.qint8)
+
+        # quantization runs once, the next loads read the quantized model
+        temp_path = f"{quantized_model_path}.{os.getpid()}.tmp"
+        torch.save(vision_model, temp_path)
+        os.replace(temp_path, quantized_model_path)
+        logger.info(f"INT8 CLIP VisionModelWithProjection saved to : {quantized_model_path}")
+
+        return vision_model
+
+    def _export_onnx_model(self, encoder_path, dynamic_batch, batch_size):
+        # the export and its check against torch are the only parts of the ONNX backend that need torch
+        import torch
+        from transformers import CLIPImageProcessor, CLIPVisionModelWithProjection
+
+        vision_model = CLIPVisionModelWithProjection.from_pretrained(encoder_path,
+                                                                     subfolder="image_encoder",
+                                                                     torch_dtype=torch.float32,
+                                                                     local_files_only=True).eval()
+        image_processor = CLIPImageProcessor.from_pretrained(encoder_path, subfolder="image_processor", local_files_only=True)
+        image_size = image_processor.crop_size['height']
+        pixel_values = np.random.default_rng(0).standard_normal((2 * batch_size, 3, image_size, image_size)).astype(np.float32)
+        reference = TorchBackend(vision_model)
+
+        # a graph is only saved to its path once its outputs match torch
+        onnx_model_path = get_onnx_model_path(encoder_path, dynamic_batch, batch_size)
+        if not os.path.isfile(onnx_model_path):
+            temp_path = f"{onnx_model_path}.{os.getpid()}.tmp"
+            export_onnx(vision_model, temp_path, image_size=image_size, dynamic_batch=dynamic_batch, batch_size=batch_size)
+            result = verify_backend(reference, OnnxRuntimeBackend(temp_path), pixel_values, min_cosine=0.9999, atol=1e-2)
+            logger.info(f"ONNX CLIP vision model against torch: {result}")
+            os.replace(temp_path, onnx_model_path)
+
+        if self.precision == EncoderPrecision.INT8:
+            quantized_model_path = get_onnx_model_path(encoder_path, dynamic_batch, batch_size, quantized=True)
+            temp_path = f"{quantized_model_path}.{os.getpid()}.tmp"
+            quantize_onnx(onnx_model_path, temp_path)
+            result = verify_backend(reference, OnnxRuntimeBackend(temp_path), pixel_values, min_cosine=0.99, atol=None)
+            logger.info(f"INT8 ONNX CLIP vision model against torch: {result}")
+            os.replace(temp_path, quantized_model_path)
+
+    def _load_backend(self, encoder_path):
+        if self.backend_type == BackendType.TORCH:
+            self.vision_model = self._load_vision_model(encoder_path).eval().to(self.device)
+            return TorchBackend(self.vision_model, self.device, self.input_dtype)
+
+        dynamic_batch = self.onnx_batch_size is None
+        batch_size = self.onnx_batch_size or 1
+        onnx_model_path = get_onnx_model_path(encoder_path, dynamic_batch, batch_size,
+                                              quantized=self.precision == EncoderPrecision.INT8)
+        # the export runs once, the next loads only read the graph
+        if not os.path.isfile(onnx_model_path):
+            self._export_onnx_model(encoder_path, dynamic_batch, batch_size)
+
+        return OnnxRuntimeBackend(onnx_model_path,
+                                  intra_op_num_threads=self.intra_op_num_threads,
+                                  inter_op_num_threads=self.inter_op_num_threads)
+
+    def _load_image_processor(self, encoder_path):
+        from transformers import CLIPImageProcessor
+
+        image_processor = CLIPImageProcessor.from_pretrained(encoder_path, subfolder="image_processor", local_files_only=True)
+        logger.info(f"CLIP ImageProcessor successfully loaded from : {encoder_path}/image_processor \n")
+        return image_processor
 
-        self.to(self.device)
+    def _load_frame_preprocessor(self, encoder_path):
+        if self.image_processor is not None:
+            return FramePreprocessor.from_image_processor(self.image_processor, device=self.device)
+        return FramePreprocessor.from_config_file(os.path.join(encoder_path, "image_processor", "preprocessor_config.json"),
+                                                  device=self.device)
+
+    def get_model_id(self, encoder_path=PRIOR_MODEL_PATH):
+        return f"{os.path.basename(os.path.normpath(encoder_path))}_{self.precision}_{self.backend_type}"
 
     def load_submodels(self, encoder_path=PRIOR_MODEL_PATH):
         try:
-            self.vision_model = (CLIPVisionModelWithProjection.from_pretrained(encoder_path,
-                                                                               subfolder="image_encoder",
-                                                                               torch_dtype=torch.float16,
-                                                                               local_files_only=True).eval().to(self.device))
-            
-            logger.info(f"CLIP VisionModelWithProjection successfully loaded from : {encoder_path}/image_encoder \n")
+            self.backend = self._load_backend(encoder_path)
+            self.model_id = self.get_model_id(encoder_path)
 
-            self.image_processor = CLIPImageProcessor.from_pretrained(encoder_path, subfolder="image_processor", local_files_only=True)
+            logger.info(f"CLIP VisionModelWithProjection ({self.backend_type}, {self.precision}) successfully loaded from : {encoder_path}/image_encoder \n")
 
-            logger.info(f"CLIP ImageProcessor successfully loaded from : {encoder_path}/image_processor \n")
+            # the ONNX backend preprocesses with the frame preprocessor alone, without transformers
+            if self.backend_type == BackendType.TORCH:
+                self.image_processor = self._load_image_processor(encoder_path)
+
+            try:
+                self.frame_preprocessor = self._load_frame_preprocessor(encoder_path)
+            except ValueError as e:
+                # numpy frames then go through the image processor
+                logger.warning(f"Batched frame preprocessing disabled: {e}")
+                if self.image_processor is None:
+                    self.image_processor = self._load_image_processor(encoder_path)
             return self
         except Exception as e:
             logger.error('Error loading submodels: ', e)
 
     def unload_submodels(self):
         # Unload the model from GPU memory
+        self.backend = None
+        self.frame_preprocessor = None
+        self.image_processor = None
         if self.vision_model is not None:
+            import torch
+
             self.vision_model.to('cpu')
             del self.vision_model
             torch.cuda.empty_cache()
             self.vision_model = None
-        if self.image_processor is not None:
-            del self.image_processor
-            torch.cuda.empty_cache()
-            self.image_processor = None
 
     def convert_image_to_tensor(self, image: PIL.Image.Image):
+        import torch
+
         return torch.from_numpy(np.array(image)) \
             .permute(2, 0, 1) \
             .unsqueeze(0) \
             .to(self.device) * (2 / 255.) - 1.0
 
+    def _run_backend(self, pixel_values):
+        if isinstance(self.backend, TorchBackend):
+            return self.backend.run_tensor(pixel_values)
+        if is_tensor(pixel_values):
+            pixel_values = pixel_values.float().cpu().numpy()
+        return self.backend.run(pixel_values)
+
+    def concatenate(self, pixel_values):
+        """
+        One batch of the `pixel_values` of several images, on the device of the model.
+        """
+        if self.return_tensors == "np":
+            return np.concatenate([value.float().cpu().numpy() if is_tensor(value) else value for value in pixel_values])
+
+        import torch
+
+        return torch.cat([value.to(self.device) if is_tensor(value) else torch.from_numpy(value).to(self.device)
+                          for value in pixel_values])
+
+    def preprocess_frames(self, frames):
+        """
+        `pixel_values` of uint8 RGB frames: an (H, W, 3) array, an (N, H, W, 3)
+        batch or a list of frames. A torch tensor with the torch backend, a numpy
+        array with the ONNX one.
+        """
+        if self.frame_preprocessor is not None:
+            return self.frame_preprocessor(frames, return_tensors=self.return_tensors)
+
+        if isinstance(frames, np.ndarray) and frames.ndim == 3:
+            frames = [frames]
+        return self.image_processor([PIL.Image.fromarray(frame) for frame in frames], return_tensors=self.return_tensors)['pixel_values']
+
+    def preprocess(self, image):
+        if isinstance(image, PIL.Image.Image):
+            if self.image_processor is None:
+                return self.preprocess_frames(np.asarray(image.convert("RGB")))
+            return self.image_processor(image, return_tensors=self.return_tensors)['pixel_values']
+        if isinstance(image, np.ndarray):
+            return self.preprocess_frames(image)
+        if is_tensor(image):
+            return image
+        raise ValueError(
+            f"`image` can only contains elements to be of type `PIL.Image.Image`, `np.ndarray` or `torch.Tensor`  but is {type(image)}"
+        )
+
     def forward(self, image):
         # Preprocess image
         # Compute CLIP features
-        if isinstance(image, PIL.Image.Image):
-            image = self.image_processor(image, return_tensors="pt")['pixel_values']
-        
-        if isinstance(image, torch.Tensor):
-            with torch.no_grad():
-                features = self.vision_model(pixel_values= image.to(self.device).half()).image_embeds
-        else:
-            raise ValueError(
-                f"`image` can only contains elements to be of type `PIL.Image.Image` or `torch.Tensor`  but is {type(image)}"
-            )
-        
-        return features
-    
+        return self._run_backend(self.preprocess(image))
+
+    def __call__(self, image):
+        return self.forward(image)
+
     def get_image_features(self, image):
-        # Preprocess image
-        if isinstance(image, PIL.Image.Image):
-            image = self.image_processor(image, return_tensors="pt")['pixel_values']
-        
-         # Compute CLIP features
-        if isinstance(image, torch.Tensor):
-            with torch.no_grad():
-                features = self.vision_model(pixel_values= image.to(self.device).half()).image_embeds
-        else:
-            raise ValueError(
-                f"`image` can only contains elements to be of type `PIL.Image.Image` or `torch.Tensor`  but is {type(image)}"
-            )
-        
+        # Preprocess image, then compute CLIP features
+        return self.get_pixel_values_features(self.preprocess(image))
+
+    def get_pixel_values_features(self, pixel_values):
+        """
+        float16 CLIP features of preprocessed `pixel_values`, which are numpy arrays
+        with the ONNX backend and so cannot be told apart from frames by `preprocess`.
+        """
+        features = self._run_backend(pixel_values)
+
+        # float16 numpy features with the ONNX backend
+        if isinstance(features, np.ndarray):
+            return features.astype(np.float16)
+        import torch
+
         return features.to(torch.float16)
 
     @staticmethod
@@ -105,7 +307,9 @@ class KandinskyCLIPImageEncoder(nn.Module):
     def get_input_type(image):
         if isinstance(image, PIL.Image.Image):
             return PIL.Image.Image
-        elif isinstance(image, torch.Tensor):
-            return torch.Tensor
+        elif isinstance(image, np.ndarray):
+            return np.ndarray
+        elif is_tensor(image):
+            return sys.modules['torch'].Tensor
         else:
-            raise ValueError("Image must be PIL Image or Tensor")
\ No newline at end of file
+            raise ValueError("Image must be PIL Image, numpy array or Tensor")
\ No newline at end of file
@@ -0,0 +1,281 @@
+import json
+from typing import List, Sequence, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+# torch is only imported for the batched resize on a GPU and for `return_tensors="pt"`,
+# so that frames are preprocessed on CPU without it
+
+# PIL resampling filters (`PIL.Image.Resampling`) supported by `FramePreprocessor`
+BILINEAR = 2
+BICUBIC = 3
+
+# fixed-point precision of the PIL resampling coefficients of 8-bit images
+_PRECISION_BITS = 32 - 8 - 2
+
+
+def _bilinear_filter(x):
+    x = np.abs(x)
+    return np.where(x < 1.0, 1.0 - x, 0.0)
+
+
+def _bicubic_filter(x, a=-0.5):
+    x = np.abs(x)
+    return np.where(x < 1.0, ((a + 2.0) * x - (a + 3.0)) * x * x + 1,
+                    np.where(x < 2.0, (((x - 5) * x + 8) * x - 4) * a, 0.0))
+
+
+# filter and support of each resampling filter, as in PIL
+_FILTERS = {
+    BILINEAR: (_bilinear_filter, 1.0),
+    BICUBIC: (_bicubic_filter, 2.0),
+}
+
+
+def get_resampling_taps(in_size: int, out_size: int, resample: int, start: int = 0, stop: int = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Input indices and fixed-point weights, each (stop - start, taps), of the output
+    pixels [start, stop) of a PIL resize of one axis from `in_size` to `out_size`.
+    Unused taps have a zero weight.
+    """
+    stop = out_size if stop is None else stop
+    resampling_filter, support = _FILTERS[resample]
+
+    scale = in_size / out_size
+    filter_scale = max(scale, 1.0)
+    support = support * filter_scale
+    num_taps = int(np.ceil(support)) * 2 + 1
+
+    indices = np.zeros((stop - start, num_taps), dtype=np.int64)
+    weights = np.zeros((stop - start, num_taps), dtype=np.int64)
+    for row, out_index in enumerate(range(start, stop)):
+        center = (out_index + 0.5) * scale
+        # truncated, like the C int casts of PIL
+        x_min = max(int(center - support + 0.5), 0)
+        x_max = min(int(center + support + 0.5), in_size)
+        taps = np.arange(x_min, x_max)
+        tap_weights = resampling_filter((taps - center + 0.5) / filter_scale)
+        total = tap_weights.sum()
+        if total != 0.0:
+            tap_weights = tap_weights / total
+
+        indices[row, :len(taps)] = taps
+        indices[row, len(taps):] = x_min
+        scaled = tap_weights * (1 << _PRECISION_BITS)
+        weights[row, :len(taps)] = np.where(scaled < 0, scaled - 0.5, scaled + 0.5).astype(np.int64)
+
+    return indices, weights
+
+
+def resample_axis(x, indices, weights, axis: int):
+    """
+    Resample axis 1 (rows) or 2 (columns) of an integer (N, H, W, C) batch with
+    the taps of `get_resampling_taps`, rounding back to 0-255 like PIL. Works on
+    numpy arrays and torch tensors.
+    """
+    def taps(t):
+        if axis == 1:
+            return x[:, indices[:, t]] * weights[:, t, None, None]
+        return x[:, :, indices[:, t]] * weights[:, t, None]
+
+    out = taps(0)
+    for t in range(1, indices.shape[1]):
+        out += taps(t)
+
+    return ((out + (1 << (_PRECISION_BITS - 1))) >> _PRECISION_BITS).clip(0, 255)
+
+
+def get_normalization_table(rescale_factor: float, image_mean: Sequence[float], image_std: Sequence[float],
+                            do_rescale: bool = True, do_normalize: bool = True) -> np.ndarray:
+    """
+    (C, 256) float32 table of the rescaled and normalized value of each channel and
+    8-bit value, computed as `CLIPImageProcessor` does.
+    """
+    values = np.arange(256, dtype=np.float64)
+    values = (values * rescale_factor if do_rescale else values).astype(np.float32)
+    values = np.repeat(values[None, :], len(image_mean), axis=0)
+    if do_normalize:
+        mean = np.array(image_mean, dtype=np.float32)[:, None]
+        std = np.array(image_std, dtype=np.float32)[:, None]
+        values = (values - mean) / std
+
+    return values
+
+
+class FramePreprocessor():
+    """
+    Batched replacement of `CLIPImageProcessor` for the uint8 RGB (H, W, 3) frames
+    of the decoder: shortest-edge resize, center crop, rescale and normalize.
+
+    On a GPU, the resize runs as tensor ops on the whole batch, computing only the
+    resized pixels kept by the crop. On CPU, where these gathers are slower than
+    the SIMD loops of PIL, each frame is resized by PIL. Either way the batch is
+    normalized with one table lookup.
+
+    The resize uses the fixed-point arithmetic of PIL and the normalization the
+    float32 arithmetic of the image processor, so `pixel_values` are the same as
+    the image processor's on the same frames.
+
+    `pixel_values` are torch tensors for `return_tensors="pt"` and numpy arrays for
+    `return_tensors="np"`, which only needs torch on a GPU.
+    """
+
+    def __init__(self,
+                 shortest_edge: int = 224,
+                 crop_size: Tuple[int, int] = (224, 224),
+                 image_mean: Sequence[float] = (0.48145466, 0.4578275, 0.40821073),
+                 image_std: Sequence[float] = (0.26862954, 0.26130258, 0.27577711),
+                 rescale_factor: float = 1 / 255,
+                 resample: int = BICUBIC,
+                 do_rescale: bool = True,
+                 do_normalize: bool = True,
+                 device='cpu'):
+        if resample not in _FILTERS:
+            raise ValueError(f"Unsupported resampling filter {resample}, expected one of {list(_FILTERS)}")
+        if min(crop_size) > shortest_edge:
+            raise ValueError(f"Crop size {crop_size} larger than the resized shortest edge {shortest_edge}")
+
+        self.shortest_edge = shortest_edge
+        self.crop_size = tuple(crop_size)
+        self.resample = resample
+        self.device = device
+        # whether frames gain from being preprocessed together, on the device
+        self.is_batched = str(device).split(':')[0] != 'cpu'
+
+        self._normalization_table = get_normalization_table(rescale_factor, image_mean, image_std, do_rescale, do_normalize)
+        self._channels = np.arange(len(image_mean))
+        if self.is_batched:
+            import torch
+
+            self._normalization_table = torch.from_numpy(self._normalization_table).to(device)
+            self._channels = torch.from_numpy(self._channels).to(device)
+        self._taps = {}
+
+    @classmethod
+    def from_config(cls, config: dict, device='cpu'):
+        """
+        Preprocessor with the settings of a `CLIPImageProcessor` config, e.g. its
+        preprocessor_config.json, missing keys taking the `CLIPImageProcessor`
+        defaults. Raises ValueError for the settings it does not implement.
+        """
+        size = config.get('size', {'shortest_edge': 224})
+        crop_size = config.get('crop_size', {'height': 224, 'width': 224})
+        if not (config.get('do_resize', True) and config.get('do_center_crop', True)) \
+                or not isinstance(size, dict) or 'shortest_edge' not in size:
+            raise ValueError("Only the shortest-edge resize followed by a center crop is supported")
+        if not isinstance(crop_size, dict):
+            crop_size = {'height': crop_size, 'width': crop_size}
+
+        return cls(shortest_edge=size['shortest_edge'],
+                   crop_size=(crop_size['height'], crop_size['width']),
+                   image_mean=config.get('image_mean', (0.48145466, 0.4578275, 0.40821073)),
+                   image_std=config.get('image_std', (0.26862954, 0.26130258, 0.27577711)),
+                   rescale_factor=config.get('rescale_factor', 1 / 255),
+                   resample=int(config.get('resample', BICUBIC)),
+                   do_rescale=config.get('do_rescale', True),
+                   do_normalize=config.get('do_normalize', True),
+                   device=device)
+
+    @classmethod
+    def from_config_file(cls, config_path: str, device='cpu'):
+        with open(config_path) as config_file:
+            return cls.from_config(json.load(config_file), device=device)
+
+    @classmethod
+    def from_image_processor(cls, image_processor, device='cpu'):
+        """
+        Preprocessor with the settings of a `CLIPImageProcessor`. Raises ValueError
+        for the settings it does not implement.
+        """
+        return cls.from_config(image_processor.to_dict(), device=device)
+
+    def get_resized_size(self, height: int, width: int) -> Tuple[int, int]:
+        short, long = (width, height) if width <= height else (height, width)
+        long = int(self.shortest_edge * long / short)
+        return (long, self.shortest_edge) if width <= height else (self.shortest_edge, long)
+
+    def _get_crop_taps(self, in_size, out_size, crop_size):
+        import torch
+
+        # output pixels kept by the crop, and the input window they read
+        start = (out_size - crop_size) // 2
+        indices, weights = get_resampling_taps(in_size, out_size, self.resample, start, start + crop_size)
+        window_start, window_stop = int(indices.min()), int(indices.max()) + 1
+
+        return (window_start, window_stop,
+                torch.from_numpy(indices - window_start).to(self.device),
+                torch.from_numpy(weights.astype(np.int32)).to(self.device))
+
+    def _get_taps(self, height, width):
+        if (height, width) not in self._taps:
+            resized_height, resized_width = self.get_resized_size(height, width)
+            self._taps[(height, width)] = (self._get_crop_taps(height, resized_height, self.crop_size[0]),
+                                           self._get_crop_taps(width, resized_width, self.crop_size[1]))
+        return self._taps[(height, width)]
+
+    def _resize_and_crop(self, frames: np.ndarray):
+        import torch
+
+        (row_start, row_stop, row_indices, row_weights), (col_start, col_stop, col_indices, col_weights) = \
+            self._get_taps(frames.shape[1], frames.shape[2])
+
+        x = torch.from_numpy(np.ascontiguousarray(frames[:, row_start:row_stop, col_start:col_stop])).to(self.device)
+        # the fixed-point sums of PIL fit in 32 bits
+        x = x.to(torch.int32)
+        # horizontal pass first, as PIL does
+        x = resample_axis(x, col_indices, col_weights, axis=2)
+        return resample_axis(x, row_indices, row_weights, axis=1)
+
+    def _resize_and_crop_pil(self, frames: np.ndarray) -> np.ndarray:
+        resized_height, resized_width = self.get_resized_size(frames.shape[1], frames.shape[2])
+        top = (resized_height - self.crop_size[0]) // 2
+        left = (resized_width - self.crop_size[1]) // 2
+        box = (left, top, left + self.crop_size[1], top + self.crop_size[0])
+
+        cropped = np.empty((len(frames),) + self.crop_size + frames.shape[3:], dtype=np.uint8)
+        for index, frame in enumerate(frames):
+            image = Image.fromarray(frame).resize((resized_width, resized_height), resample=self.resample, reducing_gap=None)
+            cropped[index] = np.asarray(image.crop(box))
+        return cropped
+
+    def _preprocess_batch(self, frames: np.ndarray, return_tensors: str):
+        if self.is_batched:
+            pixel_values = self._normalization_table[self._channels, self._resize_and_crop(frames).long()]
+            pixel_values = pixel_values.permute(0, 3, 1, 2).contiguous()
+            return pixel_values if return_tensors == "pt" else pixel_values.cpu().numpy()
+
+        pixel_values = self._normalization_table[self._channels, self._resize_and_crop_pil(frames)]
+        pixel_values = np.ascontiguousarray(pixel_values.transpose(0, 3, 1, 2))
+        if return_tensors == "pt":
+            import torch
+
+            return torch.from_numpy(pixel_values)
+        return pixel_values
+
+    def __call__(self, frames: Union[np.ndarray, List[np.ndarray]], return_tensors: str = "pt"):
+        """
+        Preprocess an (H, W, 3) frame, an (N, H, W, 3) batch, or a list of frames of
+        any sizes, into (N, 3, crop height, crop width) float32 `pixel_values`, a
+        torch tensor for `return_tensors="pt"` or a numpy array for "np".
+        """
+        if return_tensors not in ("pt", "np"):
+            raise ValueError(f"Unsupported return_tensors {return_tensors}, expected 'pt' or 'np'")
+        if isinstance(frames, np.ndarray):
+            return self._preprocess_batch(frames[None] if frames.ndim == 3 else frames, return_tensors)
+
+        # one batch per frame size, put back in order
+        batches = {}
+        for index, frame in enumerate(frames):
+            batches.setdefault(frame.shape, []).append(index)
+        pixel_values = [None] * len(frames)
+        for indices in batches.values():
+            batch_values = self._preprocess_batch(np.stack([frames[index] for index in indices]), return_tensors)
+            for index, values in zip(indices, batch_values):
+                pixel_values[index] = values
+
+        if return_tensors == "pt":
+            import torch
+
+            return torch.stack(pixel_values)
+        return np.stack(pixel_values)
@@ -0,0 +1,195 @@
+import os
+from abc import ABC, abstractmethod
+from typing import Optional, Sequence
+
+import numpy as np
+
+import sys
+sys.path.insert(0, os.getcwd())
+from utility.utils_logger import logger
+
+# torch and onnxruntime are imported by the backends that use them, so that the
+# ONNX Runtime backend runs without torch
+
+
+class BackendType:
+    # the transformers vision model run by PyTorch
+    TORCH = 'torch'
+    # the vision model exported to ONNX, run by ONNX Runtime on CPU
+    ONNX = 'onnx'
+
+    ALL = (TORCH, ONNX)
+
+
+class InferenceBackend(ABC):
+    """
+    Runs the CLIP vision model: `run` takes preprocessed pixel values (N, 3, H, W)
+    and returns the (N, D) float32 image embeddings, as numpy arrays.
+    """
+
+    name = None
+
+    @abstractmethod
+    def run(self, pixel_values: np.ndarray) -> np.ndarray:
+        pass
+
+
+class TorchBackend(InferenceBackend):
+
+    name = BackendType.TORCH
+
+    def __init__(self, vision_model, device='cpu', input_dtype=None):
+        import torch
+
+        self.vision_model = vision_model
+        self.device = device
+        self.input_dtype = input_dtype if input_dtype is not None else torch.float32
+
+    def run_tensor(self, pixel_values):
+        """
+        Same as `run` on a torch tensor, returning the embeddings as a tensor on
+        the model device, in the model dtype.
+        """
+        import torch
+
+        with torch.no_grad():
+            return self.vision_model(pixel_values=pixel_values.to(self.device, self.input_dtype)).image_embeds
+
+    def run(self, pixel_values: np.ndarray) -> np.ndarray:
+        import torch
+
+        return self.run_tensor(torch.from_numpy(np.asarray(pixel_values))).float().cpu().numpy()
+
+
+class OnnxRuntimeBackend(InferenceBackend):
+    """
+    ONNX Runtime CPU session over a graph exported by `export_onnx`. With a static
+    batch axis, inputs are split (and the last chunk zero-padded) to the batch
+    size of the graph. `intra_op_num_threads` / `inter_op_num_threads` of None
+    keep the ONNX Runtime defaults.
+    """
+
+    name = BackendType.ONNX
+
+    def __init__(self,
+                 model_path: str,
+                 intra_op_num_threads: Optional[int] = None,
+                 inter_op_num_threads: Optional[int] = None,
+                 providers: Sequence[str] = ('CPUExecutionProvider',)):
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError("OnnxRuntimeBackend requires onnxruntime: pip install onnxruntime") from e
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_num_threads is not None:
+            options.intra_op_num_threads = intra_op_num_threads
+        if inter_op_num_threads is not None:
+            options.inter_op_num_threads = inter_op_num_threads
+            options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+
+        self.model_path = model_path
+        self.session = onnxruntime.InferenceSession(model_path, sess_options=options, providers=list(providers))
+
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        batch_size = model_input.shape[0]
+        # a symbolic (str) or missing dimension is a dynamic batch axis
+        self.batch_size = batch_size if isinstance(batch_size, int) and batch_size > 0 else None
+
+    def _run_batch(self, pixel_values):
+        return self.session.run(None, {self.input_name: pixel_values})[0]
+
+    def run(self, pixel_values: np.ndarray) -> np.ndarray:
+        pixel_values = np.ascontiguousarray(pixel_values, dtype=np.float32)
+        if self.batch_size is None:
+            return self._run_batch(pixel_values)
+
+        features = []
+        for start in range(0, len(pixel_values), self.batch_size):
+            chunk = pixel_values[start:start + self.batch_size]
+            num_images = len(chunk)
+            if num_images < self.batch_size:
+                padding = np.zeros((self.batch_size - num_images,) + chunk.shape[1:], dtype=np.float32)
+                chunk = np.concatenate([chunk, padding])
+            features.append(self._run_batch(chunk)[:num_images])
+
+        return np.concatenate(features)
+
+
+def get_onnx_model_path(encoder_path: str, dynamic_batch: bool = True, batch_size: int = 1, quantized: bool = False) -> str:
+    name = 'model' if dynamic_batch else f'model_batch{batch_size}'
+    if quantized:
+        name += '_int8'
+    return os.path.join(encoder_path, "image_encoder", "onnx", f"{name}.onnx")
+
+
+def export_onnx(vision_model, output_path: str, image_size: int = 224, dynamic_batch: bool = True,
+                batch_size: int = 1, opset_version: int = 14) -> str:
+    """
+    Export the image embeddings of a float32 `CLIPVisionModelWithProjection` to
+    `output_path`, with a dynamic batch axis or a static one of `batch_size`.
+    """
+    import torch
+
+    class ImageEmbeds(torch.nn.Module):
+
+        def __init__(self, vision_model):
+            super().__init__()
+            self.vision_model = vision_model
+
+        def forward(self, pixel_values):
+            return self.vision_model(pixel_values=pixel_values).image_embeds
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    dummy_input = torch.zeros(batch_size, 3, image_size, image_size, dtype=torch.float32)
+    dynamic_axes = {'pixel_values': {0: 'batch'}, 'image_embeds': {0: 'batch'}} if dynamic_batch else None
+
+    # models over 2GB are written with their weights in separate files next to the graph
+    torch.onnx.export(ImageEmbeds(vision_model.float().eval().cpu()),
+                      dummy_input,
+                      output_path,
+                      input_names=['pixel_values'],
+                      output_names=['image_embeds'],
+                      dynamic_axes=dynamic_axes,
+                      opset_version=opset_version,
+                      do_constant_folding=True)
+    logger.info(f"CLIP vision model exported to : {output_path}")
+
+    return output_path
+
+
+def quantize_onnx(model_path: str, output_path: str) -> str:
+    """
+    Dynamic INT8 quantization of the weights of an exported graph with ONNX Runtime.
+    """
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(model_path, output_path, weight_type=QuantType.QInt8)
+    logger.info(f"INT8 ONNX model saved to : {output_path}")
+
+    return output_path
+
+
+def verify_backend(reference: InferenceBackend, backend: InferenceBackend, pixel_values: np.ndarray,
+                   min_cosine: float = 0.999, atol: Optional[float] = 1e-3) -> dict:
+    """
+    Compare the embeddings of `backend` with those of `reference` on `pixel_values`.
+    Raises ValueError if a cosine similarity is below `min_cosine`, or a value
+    differs by more than `atol` (None to skip, e.g. for quantized models).
+    """
+    expected = reference.run(pixel_values)
+    actual = backend.run(pixel_values)
+
+    cosine = np.sum(expected * actual, axis=1) / (np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1))
+    result = {
+        'max_abs_diff': float(np.max(np.abs(expected - actual))),
+        'cosine_min': float(cosine.min()),
+        'cosine_mean': float(cosine.mean()),
+    }
+
+    if result['cosine_min'] < min_cosine or (atol is not None and result['max_abs_diff'] > atol):
+        raise ValueError(f"{backend.name} backend differs from {reference.name}: {result}")
+
+    return result
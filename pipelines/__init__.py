@@ -1 +1,2 @@
-from .video_processing_pipeline import VideoProcessingPipeline
\ No newline at end of file
+from .video_processing_pipeline import VideoProcessingPipeline
+from .video_stage_scheduler import VideoStageScheduler
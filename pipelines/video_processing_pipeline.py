@@ -1,29 +1,56 @@
 
-from genericpath import isfile
 import sys
 import os
 from io import BytesIO
 from typing import Tuple
 import json
+import hashlib
+import threading
+from functools import partial
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from minio import Minio
-import msgpack
 from PIL import Image
+import numpy as np
 
 base_dir = './'
 sys.path.insert(0, base_dir)
 
 from utility.http import request
+from utility.http.image_metadata_writer import ImageMetadataWriter
 from utility.minio import cmd
 from utility.path import separate_bucket_and_file_path
 from utility.video.video_processing import extract_frames_from_video
-from utility.minio.progress import Progress
+from utility.video.video_processing import phash_index
+from utility.video.video_processing import known_hash_index
+from utility.video.video_processing import adaptive_sampler
 from utility.utils.file_utils import delete_all_files
+from utility.utils import tar_shard
+from utility.clip.embedding_format import EmbeddingFormat, encode_embedding, encode_legacy_embedding
+from utility.clip.embedding_shard import EmbeddingShardWriter, get_shard_index_object_name
+from utility.clip import embedding_cache
+from utility.utils import metrics
 from utility import logger
 
 from kandinsky.models.clip_image_encoder.clip_image_encoder import KandinskyCLIPImageEncoder
 
 from schema import VideoMetaData
+
+STAGE_SECONDS = metrics.histogram('video_pipeline_stage_seconds', 'Time a video spends in a stage of VideoProcessingPipeline', ['stage'])
+STAGE_FAILURES = metrics.counter('video_pipeline_stage_failures_total', 'Videos that failed in a stage', ['stage'])
+ACTIVE_VIDEOS = metrics.gauge('video_pipeline_active_videos', 'Videos running a stage', ['stage'])
+VIDEOS = metrics.counter('video_pipeline_videos_total', 'Videos through all the stages')
+# registered: frames registered with the orchestration API, done: frames of the videos through all the stages
+FRAMES = metrics.counter('video_pipeline_frames_total', 'Frames of the pipelines, by step', ['step'])
+CLIP_VECTORS = metrics.counter('clip_vectors_total', 'CLIP vectors of the frames, by source', ['source'])
+CLIP_VECTOR_SECONDS = metrics.histogram('clip_vector_seconds', 'Time a frame waits for its CLIP vector, batching and cache included')
+
+
+def _measure_stage(stage):
+    return metrics.measure(STAGE_SECONDS.labels(stage=stage),
+                           STAGE_FAILURES.labels(stage=stage),
+                           ACTIVE_VIDEOS.labels(stage=stage))
+
+
 class VideoProcessingPipeline():
     
     def __init__(self, 
@@ -31,7 +58,32 @@ class VideoProcessingPipeline():
                 image_encoder: KandinskyCLIPImageEncoder,
                 video: VideoMetaData, 
                 video_bucket_name = 'ingress-video',
-                frame_bucket_name = 'external') -> None:
+                frame_bucket_name = 'external',
+                streaming: bool = False,
+                max_frames_in_flight: int = 64,
+                num_segments: int = 1,
+                analysis_width: int = None,
+                phash_index_dir: str = None,
+                phash_radius: int = phash_index.DEFAULT_RADIUS,
+                strategy: str = extract_frames_from_video.ExtractionStrategy.ORB,
+                scene_threshold: float = extract_frames_from_video.DEFAULT_SCENE_THRESHOLD,
+                pipelined: bool = False,
+                num_extraction_workers: int = 4,
+                num_hash_workers: int = 0,
+                min_fps: float = adaptive_sampler.DEFAULT_MIN_FPS,
+                max_fps: float = adaptive_sampler.DEFAULT_MAX_FPS,
+                fetch_kept_frames: bool = True,
+                image_metadata_writer: ImageMetadataWriter = None,
+                embedding_format: str = EmbeddingFormat.BINARY,
+                embedding_shards: bool = False,
+                frames_per_shard: int = None,
+                pack_frames: bool = False,
+                max_tar_shard_bytes: int = tar_shard.DEFAULT_MAX_SHARD_BYTES,
+                resume: bool = True,
+                known_hash_index_path: str = None,
+                embedding_cache_path: str = None,
+                embedding_cache_max_bytes: int = embedding_cache.DEFAULT_MAX_CACHE_BYTES,
+                embedding_cache_bucket: str = None) -> None:
         self.video_metadata = video
         self.video_bucket_name = video_bucket_name
         self.frame_bucket_name = frame_bucket_name
@@ -44,6 +96,72 @@ class VideoProcessingPipeline():
         self._extracted_frames = []
         
         self.encoder = image_encoder
+
+        # streaming mode: frames are deduplicated, hashed, embedded and uploaded
+        # from memory without writing them into the temp dir.
+        self.streaming = streaming
+        self.max_frames_in_flight = max_frames_in_flight
+        # number of time ranges of the video decoded in parallel processes (disk mode)
+        if num_segments > 1 and streaming:
+            raise ValueError(f"num_segments={num_segments} is only supported in disk mode, not with streaming")
+        extract_frames_from_video.check_segmented_options(num_segments, strategy, analysis_width, pipelined)
+        self.num_segments = num_segments
+        # width of the downscaled stream the dedup checks run on, None for full resolution
+        self.analysis_width = analysis_width
+        # per-game perceptual hash index of frames already kept in other videos
+        self.phash_index_path = None
+        self.phash_index = None
+        self.phash_radius = phash_radius
+        self._new_phashes = []
+        # how candidate frames are selected, see extract_frames_from_video.ExtractionStrategy
+        self.strategy = strategy
+        self.scene_threshold = scene_threshold
+        # sampling rate range of the adaptive strategy
+        self.min_fps = min_fps
+        self.max_fps = max_fps
+        # decode the analysis stream only and fetch the kept frames, see AdaptiveSampler
+        self.fetch_kept_frames = fetch_kept_frames
+        self.extraction_stats = extract_frames_from_video.ExtractionStats(strategy)
+        # run decoding, dedup and frame saving/hashing in separate threads
+        self.pipelined = pipelined
+        self.num_extraction_workers = num_extraction_workers
+        # threads computing the two digests of each frame in parallel, 0 to hash in the calling thread
+        self.num_hash_workers = num_hash_workers
+        # write-behind batcher of frame metadata, shared between pipelines if given
+        self.image_metadata_writer = image_metadata_writer
+        # encoding of the uploaded CLIP vectors, see utility.clip.embedding_format
+        self.embedding_format = embedding_format
+        # store the CLIP vectors of the video in a few shard objects (one per
+        # frames_per_shard frames, or per video) instead of one object per frame
+        self.embedding_shards = embedding_shards
+        self.frames_per_shard = frames_per_shard
+        self._dataset = None
+        # pack frames, metadata and CLIP vectors into tar shards of up to
+        # max_tar_shard_bytes instead of uploading them as separate objects
+        self.pack_frames = pack_frames
+        self.max_tar_shard_bytes = max_tar_shard_bytes
+        # on a retry, reuse the frames registered by the previous attempt (kept in
+        # the temp dir until the video succeeds) and skip the objects it uploaded
+        self.resume = resume
+        self._resume_path = os.path.join(self._temp_dir, 'registered_frames.json')
+        self._resumed_frames = {}
+        self._registered_frames = {}
+        self._existing_objects = {}
+        # image hashes registered by any pipeline, checked right after fingerprinting
+        self.known_hashes = None
+        if known_hash_index_path is not None:
+            self.known_hashes = known_hash_index.get_index(known_hash_index_path)
+        # CLIP vectors of the frames encoded before, by image hash, checked before
+        # the encoder; a miss is also looked up in the shared tier of embedding_cache_bucket
+        self.embedding_cache = None
+        if embedding_cache_path is not None:
+            self.embedding_cache = embedding_cache.get_cache(embedding_cache_path,
+                                                             max_bytes=embedding_cache_max_bytes,
+                                                             minio_client=minio_client,
+                                                             shared_bucket=embedding_cache_bucket)
+        if phash_index_dir is not None:
+            self.phash_index_path = os.path.join(phash_index_dir, f"{self.video_metadata.game_id}.phix")
+            self.phash_index = phash_index.get_index(self.phash_index_path)
         
         if os.path.isfile(self._temp_dir):
             os.mkdir(self._temp_dir)
@@ -65,6 +183,10 @@ class VideoProcessingPipeline():
                                 video_minio_path, 
                                 self._temp_video_path)
 
+    def _get_sampler(self) -> adaptive_sampler.AdaptiveSampler:
+        return adaptive_sampler.AdaptiveSampler(min_fps=self.min_fps, max_fps=self.max_fps,
+                                                fetch_kept_frames=self.fetch_kept_frames)
+
     def _extract_frame(self) -> None:
         logger.debug(msg="Extracting frames from video....")
         # define dir path to extract frames from video
@@ -75,61 +197,267 @@ class VideoProcessingPipeline():
         self._extracted_frames = \
             extract_frames_from_video.process_video(video_path=self._temp_video_path, 
                                                 output_dir=frames_dir,
-                                                fps=self.video_metadata.video_frame_rate)
+                                                fps=self.video_metadata.video_frame_rate,
+                                                num_segments=self.num_segments,
+                                                analysis_width=self.analysis_width,
+                                                phash_index=self.phash_index,
+                                                phash_radius=self.phash_radius,
+                                                strategy=self.strategy,
+                                                scene_threshold=self.scene_threshold,
+                                                stats=self.extraction_stats,
+                                                pipelined=self.pipelined,
+                                                num_workers=self.num_extraction_workers,
+                                                sampler=self._get_sampler(),
+                                                known_hashes=self.known_hashes,
+                                                num_hash_workers=self.num_hash_workers)
+        self._new_phashes = [frame['phash'] for frame in self._extracted_frames if 'phash' in frame]
 
         with open("extract_frame.json", mode='w') as f:
             json.dump(self._extracted_frames, f, indent=4)
             
         logger.debug(msg="Successfully extracted frames!")
+        logger.info(msg=f"{self.video_metadata.video_id} extraction: {self.extraction_stats}")
     
-    def _get_clip_vector(self, fpath: str):
-        img = Image.open(fpath)
-        img = img.convert("RGB")
-        
-        clip_vector = self.encoder.get_image_features(img)
-        clip_vector = clip_vector.cpu().numpy().tolist()
-        
-        clip_feature_dict = {"clip-feature-vector": clip_vector}
-        clip_feature_msgpack = msgpack.packb(clip_feature_dict)
+    def _load_resume_state(self) -> None:
+        """
+        Load the frames registered by a previous attempt and list the objects it
+        uploaded, with one listing per output directory.
+        """
+        self._resumed_frames = {}
+        self._registered_frames = {}
+        self._existing_objects = {}
+        if not self.resume or not os.path.isfile(self._resume_path):
+            return
+
+        with open(self._resume_path) as f:
+            for record in json.load(f):
+                self._resumed_frames[record['image_hash']] = record
+        self._registered_frames.update(self._resumed_frames)
+
+        prefixes = {self._get_embedding_shard_prefix() + '_', self._get_tar_shard_prefix() + '_'}
+        for record in self._resumed_frames.values():
+            _, file_path = separate_bucket_and_file_path(path_str=record['file_path'])
+            prefixes.add(os.path.dirname(file_path) + '/')
+        for prefix in prefixes:
+            self._existing_objects.update(cmd.get_object_etags_with_prefix(self.minio_client, self.frame_bucket_name, prefix))
 
-        clip_feature_msgpack_buffer = BytesIO()
-        clip_feature_msgpack_buffer.write(clip_feature_msgpack)
-        clip_feature_msgpack_buffer.seek(0)
+        logger.info(msg=f"Resuming {self.video_metadata.video_id}: {len(self._resumed_frames)} frames registered, "
+                        f"{len(self._existing_objects)} objects listed")
 
-        return clip_feature_msgpack_buffer
+    def _save_resume_state(self) -> None:
+        if not self.resume:
+            return
+        os.makedirs(self._temp_dir, exist_ok=True)
+        with open(self._resume_path, mode='w') as f:
+            json.dump(list(self._registered_frames.values()), f)
+
+    def _is_uploaded(self, object_name: str, fpath: str = None) -> bool:
+        """
+        Whether a previous attempt uploaded `object_name`, with the content of
+        `fpath` if given.
+        """
+        if object_name not in self._existing_objects:
+            return False
+
+        etag = self._existing_objects[object_name]
+        # the ETag of a single part upload is the MD5 of the content
+        if fpath is None or etag is None or '-' in etag:
+            return True
+        with open(fpath, 'rb') as f:
+            return hashlib.md5(f.read()).hexdigest() == etag
+
+    def _register_frame(self, writer: ImageMetadataWriter, dataset: str, frame_info: dict):
+        # each record of the previous attempt is used once, like a new registration
+        record = self._resumed_frames.pop(frame_info['image_hash'], None)
+        if record is None:
+            record = writer.add_image(self._get_frame_metadata(dataset, frame_info))
+            if record is not None:
+                FRAMES.labels(step='registered').inc()
+        if record is not None:
+            self._registered_frames[record['image_hash']] = record
+        return record
+
+    @staticmethod
+    def _read_frame(f) -> np.ndarray:
+        # uint8 RGB, as the decoder yields the frames, for the batched preprocessing of the encoder
+        return np.asarray(Image.open(f).convert("RGB"))
+
+    def _get_image_features(self, image_hash: str, frame):
+        """
+        CLIP vector of a frame, from the embedding cache if the same model encoded
+        it before. `frame` is the frame or a function loading it, only called on a
+        cache miss.
+        """
+        with CLIP_VECTOR_SECONDS.time():
+            model_id = getattr(self.encoder, 'model_id', None)
+            if self.embedding_cache is None or model_id is None:
+                CLIP_VECTORS.labels(source='encoder').inc()
+                return self.encoder.get_image_features(frame() if callable(frame) else frame)
+
+            clip_vector = self.embedding_cache.get(model_id, image_hash)
+            if clip_vector is None:
+                clip_vector = self.encoder.get_image_features(frame() if callable(frame) else frame)
+                self.embedding_cache.put(model_id, image_hash, clip_vector)
+                CLIP_VECTORS.labels(source='encoder').inc()
+            else:
+                CLIP_VECTORS.labels(source='cache').inc()
+            return clip_vector
+
+    def _get_clip_vector(self, image_hash: str, fpath: str):
+        return self._encode_clip_vector(image_hash, partial(self._read_frame, fpath))
+
+    def _encode_clip_vector(self, image_hash: str, frame):
+        clip_vector = self._get_image_features(image_hash, frame)
+
+        if self.embedding_format == EmbeddingFormat.BINARY:
+            return BytesIO(encode_embedding(clip_vector))
+        return BytesIO(encode_legacy_embedding(clip_vector))
     
-    def _upload_clip_vector(self, minio_path: str, fpath: str):
-        clip_vector = self._get_clip_vector(fpath)
-        
+    def _upload_clip_vector(self, minio_path: str, frame_info: dict, fpath: str):
+        self._upload_clip_vector_data(minio_path, self._get_clip_vector(frame_info['image_hash'], fpath))
+
+    def _add_clip_vector_to_shard(self, shard_writer: EmbeddingShardWriter, minio_path: str, frame_info: dict, frame):
+        shard_writer.add(file_path=minio_path,
+                         image_hash=frame_info['image_hash'],
+                         vector=self._get_image_features(frame_info['image_hash'], frame),
+                         frame_num=frame_info.get('source_image_dict', {}).get('frame_num'))
+
+    def _add_clip_vector_file_to_shard(self, shard_writer: EmbeddingShardWriter, minio_path: str, frame_info: dict, fpath: str):
+        self._add_clip_vector_to_shard(shard_writer, minio_path, frame_info, partial(self._read_frame, fpath))
+
+    def _get_embedding_shard_prefix(self) -> str:
+        return f"{self._dataset}/embeddings/{self.video_metadata.video_id}"
+
+    def _get_tar_shard_prefix(self) -> str:
+        return f"{self._dataset}/shards/{self.video_metadata.video_id}"
+
+    def _get_embedding_shard_writer(self) -> EmbeddingShardWriter:
+        def upload(object_name, data):
+            cmd.upload_data(client=self.minio_client,
+                            bucket_name=self.frame_bucket_name,
+                            object_name=object_name,
+                            data=BytesIO(data))
+
+        return EmbeddingShardWriter(upload=upload,
+                                    prefix=self._get_embedding_shard_prefix(),
+                                    frames_per_shard=self.frames_per_shard)
+
+    def _get_tar_shard_writer(self) -> tar_shard.TarShardWriter:
+        def upload(object_name, path):
+            cmd.upload_from_file(self.minio_client, self.frame_bucket_name, object_name, path)
+
+        return tar_shard.TarShardWriter(upload=upload,
+                                        prefix=self._get_tar_shard_prefix(),
+                                        temp_dir=os.path.join(self._temp_dir, 'shards'),
+                                        max_shard_bytes=self.max_tar_shard_bytes)
+
+    def _pack_frame(self, tar_writer: tar_shard.TarShardWriter, minio_path: str, frame_info: dict, data: bytes, frame):
+        key, extension = os.path.splitext(minio_path)
+        clip_vector = self._get_image_features(frame_info['image_hash'], frame)
+        tar_writer.add(key,
+                       {
+                           extension[1:]: data,
+                           'json': json.dumps(frame_info).encode(),
+                           'bin': encode_embedding(clip_vector),
+                       },
+                       info={'file_path': minio_path, 'image_hash': frame_info['image_hash']})
+
+    def _pack_frame_file(self, tar_writer: tar_shard.TarShardWriter, minio_path: str, frame_info: dict, fpath: str):
+        with open(fpath, 'rb') as f:
+            data = f.read()
+        self._pack_frame(tar_writer, minio_path, frame_info, data, partial(self._read_frame, BytesIO(data)))
+
+    def _pack_frames_into_minio(self) -> None:
+        logger.debug(msg="Packing frames into tar shards....")
+
+        if self._is_uploaded(tar_shard.get_tar_shard_index_object_name(self._get_tar_shard_prefix())):
+            logger.debug(msg="Tar shards already uploaded")
+            return
+
+        tar_writer = self._get_tar_shard_writer()
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            futures = []
+            for frame_info in self._extracted_frames:
+                _, file_path = \
+                        separate_bucket_and_file_path(path_str=frame_info['file_path'])
+                futures.append(executor.submit(self._pack_frame_file,
+                                               tar_writer,
+                                               file_path,
+                                               frame_info,
+                                               self.hash_to_local_path_map[frame_info["image_hash"]]))
+
+            for future in as_completed(futures):
+                future.result()
+        tar_writer.close()
+
+        logger.debug(msg="Successfully uploaded tar shards!")
+
+    def _get_clip_vector_object_name(self, minio_path: str) -> str:
         output_path = os.path.splitext(minio_path)[0]
-        output_path = f"{output_path}_clip_kandinsky.msgpack"
+        return f"{output_path}{EmbeddingFormat.SUFFIXES[self.embedding_format]}"
+
+    def _upload_clip_vector_data(self, minio_path: str, clip_vector: BytesIO):
         cmd.upload_data(client=self.minio_client,
                         bucket_name=self.frame_bucket_name,
-                        object_name=output_path,
+                        object_name=self._get_clip_vector_object_name(minio_path),
                         data=clip_vector)
+
+    def _get_shard_writer_to_resume(self) -> EmbeddingShardWriter:
+        """
+        New shard writer, or None if embedding shards are off or already uploaded.
+        """
+        if not self.embedding_shards or self._is_uploaded(get_shard_index_object_name(self._get_embedding_shard_prefix())):
+            return None
+        return self._get_embedding_shard_writer()
     
     def _upload_frame_into_minio(self) -> None:
         logger.debug(msg="Uploading frames into minio....")
         
+        shard_writer = self._get_shard_writer_to_resume()
         with ThreadPoolExecutor(max_workers=32) as executor:
             futures = []
             for frame_info in self._extracted_frames:
                 _, file_path = \
                         separate_bucket_and_file_path(path_str=frame_info['file_path'])
-                
+                local_path = self.hash_to_local_path_map[frame_info["image_hash"]]
+
+                if self.embedding_shards:
+                    if shard_writer is None:
+                        continue
+                    futures.append(executor.submit(self._add_clip_vector_file_to_shard,
+                                                shard_writer,
+                                                file_path,
+                                                frame_info,
+                                                local_path))
+                    continue
+
+                if self._is_uploaded(self._get_clip_vector_object_name(file_path)):
+                    continue
                 futures.append(executor.submit(self._upload_clip_vector, 
                                             file_path,
-                                            self.hash_to_local_path_map[frame_info["image_hash"]]))
+                                            frame_info,
+                                            local_path))
+        # raise before the shard index is uploaded, which marks all the vectors as done for a retry
+        for future in futures:
+            future.result()
+        if shard_writer is not None:
+            shard_writer.close()
 
         with ThreadPoolExecutor(max_workers=32) as executor:
+            futures = []
             for frame_info in self._extracted_frames:
                 _, file_path = \
                         separate_bucket_and_file_path(path_str=frame_info['file_path'])
+                local_path = self.hash_to_local_path_map[frame_info["image_hash"]]
+                if self._is_uploaded(file_path, local_path):
+                    continue
                 futures.append(executor.submit(cmd.upload_from_file, 
                                             self.minio_client,
                                             self.frame_bucket_name,
                                             file_path,
-                                            self.hash_to_local_path_map[frame_info["image_hash"]]))
+                                            local_path))
+        for future in futures:
+            future.result()
 
         logger.debug(msg="Successfully uploaded frames!")
             
@@ -137,49 +465,173 @@ class VideoProcessingPipeline():
         
         logger.debug(msg="Uploading frame metadata into mongodb...")
 
-        dataset = request.http_get_video_game(game_id=self.video_metadata.game_id)['title']
-        request.http_add_new_dataset(dataset, 2)
-        print(dataset)
-        upload_frames_list = []
-        for frame in self._extracted_frames:
-            frame_info = {
-                'uuid': '',
-                'file_path': '',
-                'dataset': dataset,
-                'image_hash': frame['image_hash'],
-                'image_resolution': frame['image_resolution'],
-                'image_format': frame['image_format'],
-                'source_image_dict': {
-                    'frame_num': frame['frame_num'],
-                    'source_video': self.video_metadata.video_id
-                },
-                'task_attributes_dict': {},
-                'upload_date': '',
-            }
-            upload_frames_list.append(frame_info)
-        
-        updated_frames_list = []
-        with ThreadPoolExecutor(max_workers=32) as executor:
-            futures = []
-            for frame in upload_frames_list:
-                futures.append(executor.submit(request.http_add_image, frame))
-                continue
-            for future in as_completed(futures):
-                result = future.result()
-                if result is not None:
-                    updated_frames_list.append(future.result())
-                
+        dataset = self._get_dataset()
+        self._load_resume_state()
+        upload_frames_list = [self._get_frame_metadata(dataset, frame) for frame in self._extracted_frames
+                              if frame['image_hash'] not in self._resumed_frames]
+
+        writer, is_own_writer = self._get_image_metadata_writer()
+        futures = [writer.submit(frame) for frame in upload_frames_list]
+        if is_own_writer:
+            writer.close()
+
         self.hash_to_local_path_map = {}
         for frame_info in self._extracted_frames:
             self.hash_to_local_path_map[frame_info["image_hash"]] = frame_info["file_path"]
 
+        # frames registered by a previous attempt, see _load_resume_state
+        updated_frames_list = [record for image_hash, record in self._resumed_frames.items()
+                               if image_hash in self.hash_to_local_path_map]
+        for future in futures:
+            result = future.result()
+            if result is not None:
+                self._registered_frames[result['image_hash']] = result
+                updated_frames_list.append(result)
+                FRAMES.labels(step='registered').inc()
+        self._save_resume_state()
+
         self._extracted_frames = updated_frames_list
         logger.debug(msg="Successfully uploaded frame metadata!")
     
+    def _get_image_metadata_writer(self) -> Tuple[ImageMetadataWriter, bool]:
+        """
+        Return the shared writer, or a new one owned by the caller, who closes it.
+        """
+        if self.image_metadata_writer is not None:
+            return self.image_metadata_writer, False
+        return ImageMetadataWriter(), True
+
+    def _get_dataset(self) -> str:
+        dataset = request.http_get_video_game(game_id=self.video_metadata.game_id)['title']
+        request.http_add_new_dataset(dataset, 2)
+        print(dataset)
+        self._dataset = dataset
+        return dataset
+
+    def _get_frame_metadata(self, dataset: str, frame: dict) -> dict:
+        return {
+            'uuid': '',
+            'file_path': '',
+            'dataset': dataset,
+            'image_hash': frame['image_hash'],
+            'image_resolution': frame['image_resolution'],
+            'image_format': frame['image_format'],
+            'source_image_dict': {
+                'frame_num': frame['frame_num'],
+                'source_video': self.video_metadata.video_id
+            },
+            'task_attributes_dict': {},
+            'upload_date': '',
+        }
+
+    def _process_frame_in_memory(self,
+                                 writer: ImageMetadataWriter,
+                                 shard_writer: EmbeddingShardWriter,
+                                 tar_writer: tar_shard.TarShardWriter,
+                                 dataset: str,
+                                 data: bytes,
+                                 frame_info: dict,
+                                 frame: np.ndarray):
+        result = self._register_frame(writer, dataset, frame_info)
+        if result is None:
+            return None
+
+        _, file_path = separate_bucket_and_file_path(path_str=result['file_path'])
+        # `frame` holds the pixels of the stored JPEG, decoded once when it was
+        # hashed, so that it is embedded as in disk mode without decoding it again
+        if self.pack_frames:
+            if tar_writer is not None:
+                self._pack_frame(tar_writer, file_path, result, data, frame)
+            return result
+
+        if not self._is_uploaded(file_path):
+            # the bytes the image hash was computed from
+            cmd.upload_data(client=self.minio_client,
+                            bucket_name=self.frame_bucket_name,
+                            object_name=file_path,
+                            data=BytesIO(data))
+        if self.embedding_shards:
+            if shard_writer is not None:
+                self._add_clip_vector_to_shard(shard_writer, file_path, result, frame)
+        elif not self._is_uploaded(self._get_clip_vector_object_name(file_path)):
+            self._upload_clip_vector_data(file_path, self._encode_clip_vector(result['image_hash'], frame))
+
+        return result
+
+    def _process_frames_in_memory(self) -> None:
+        logger.debug(msg="Extracting, registering and uploading frames in memory....")
+
+        dataset = self._get_dataset()
+        self._load_resume_state()
+        # bound the number of decoded frames waiting in the executor
+        in_flight = threading.BoundedSemaphore(self.max_frames_in_flight)
+        writer, is_own_writer = self._get_image_metadata_writer()
+        shard_writer = None if self.pack_frames else self._get_shard_writer_to_resume()
+        tar_writer = None
+        if self.pack_frames and not self._is_uploaded(tar_shard.get_tar_shard_index_object_name(self._get_tar_shard_prefix())):
+            tar_writer = self._get_tar_shard_writer()
+
+        updated_frames_list = []
+        try:
+            with ThreadPoolExecutor(max_workers=32) as executor:
+                futures = []
+                for data, frame_info, frame in extract_frames_from_video.stream_video(video_path=self._temp_video_path,
+                                                                                      fps=self.video_metadata.video_frame_rate,
+                                                                                      analysis_width=self.analysis_width,
+                                                                                      phash_index=self.phash_index,
+                                                                                      phash_radius=self.phash_radius,
+                                                                                      strategy=self.strategy,
+                                                                                      scene_threshold=self.scene_threshold,
+                                                                                      stats=self.extraction_stats,
+                                                                                      pipelined=self.pipelined,
+                                                                                      num_workers=self.num_extraction_workers,
+                                                                                      sampler=self._get_sampler(),
+                                                                                      known_hashes=self.known_hashes,
+                                                                                      num_hash_workers=self.num_hash_workers):
+                    if 'phash' in frame_info:
+                        self._new_phashes.append(frame_info['phash'])
+                    in_flight.acquire()
+                    future = executor.submit(self._process_frame_in_memory, writer, shard_writer, tar_writer, dataset, data, frame_info, frame)
+                    future.add_done_callback(lambda _: in_flight.release())
+                    futures.append(future)
+
+                for future in as_completed(futures):
+                    result = future.result()
+                    if result is not None:
+                        updated_frames_list.append(result)
+        finally:
+            # frames registered before a failure are reused by the retry
+            self._save_resume_state()
+
+        if is_own_writer:
+            writer.close()
+        if shard_writer is not None:
+            shard_writer.close()
+        if tar_writer is not None:
+            tar_writer.close()
+
+        self._extracted_frames = updated_frames_list
+        logger.debug(msg="Successfully processed frames in memory!")
+        logger.info(msg=f"{self.video_metadata.video_id} extraction: {self.extraction_stats}")
+
     def _update_video_status_to_processed(self):
         self.video_metadata.processed = True
         request.http_update_video_status_to_processed(self.video_metadata)
 
+    def _save_phash_index(self) -> None:
+        # only updated after a successful run, so a retry does not skip the frames of a failed one
+        if self.phash_index is not None:
+            for phash in self._new_phashes:
+                self.phash_index.add(phash)
+            self.phash_index.save(self.phash_index_path)
+
+    def _save_known_hashes(self) -> None:
+        # like the phash index, only updated after a successful run
+        if self.known_hashes is not None:
+            for frame_info in self._extracted_frames:
+                self.known_hashes.add(frame_info['image_hash'])
+            self.known_hashes.sync()
+
     def delete_temp_files(self) -> None:
         delete_all_files(self._temp_dir)
     
@@ -187,19 +639,54 @@ class VideoProcessingPipeline():
         video_file_stats = os.stat(self._temp_video_path)
         self.video_metadata.video_filesize = video_file_stats.st_size
     
-    def run(self) -> Tuple[bool, str]:
-        is_success = False
-        
-        try:
+    def run_download(self) -> None:
+        """
+        Network stage: fetch the video into the temp dir.
+        """
+        with _measure_stage('download'):
             self._download_video_from_minio()
             # temporary part: To update file size of video metadata 
             # because file size of some video metadata is missing now.
             self._update_video_metadata()
-            self._extract_frame()
-            self._save_metadata_in_db()
-            self._upload_frame_into_minio()
+
+    def run_extract(self) -> None:
+        """
+        CPU stage: decode and deduplicate the frames. In streaming mode the frames
+        are also registered, embedded and uploaded here.
+        """
+        with _measure_stage('extract'):
+            if self.streaming:
+                self._process_frames_in_memory()
+            else:
+                self._extract_frame()
+
+    def run_upload(self) -> None:
+        """
+        HTTP/model stage: register, embed and upload the extracted frames, then mark
+        the video as processed and clean up.
+        """
+        with _measure_stage('upload'):
+            if not self.streaming:
+                self._save_metadata_in_db()
+                if self.pack_frames:
+                    self._pack_frames_into_minio()
+                else:
+                    self._upload_frame_into_minio()
             self._update_video_status_to_processed()
+            self._save_phash_index()
+            self._save_known_hashes()
             self.delete_temp_files()
+
+        VIDEOS.inc()
+        FRAMES.labels(step='done').inc(len(self._extracted_frames))
+
+    def run(self) -> Tuple[bool, str]:
+        is_success = False
+        
+        try:
+            self.run_download()
+            self.run_extract()
+            self.run_upload()
             is_success = True
         except Exception as e:
             logger.error(msg="Error on running pipeline:" + str(e))
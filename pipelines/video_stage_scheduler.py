@@ -0,0 +1,80 @@
+import sys
+import traceback
+from typing import Callable, List
+
+base_dir = './'
+sys.path.insert(0, base_dir)
+
+from utility.utils.stage_pipeline import Stage, StagePipeline
+from utility import logger
+
+
+class VideoStageScheduler():
+    """
+    Runs the stages of many `VideoProcessingPipeline`s as a stage graph, so that
+    video N+1 downloads while video N extracts and video N-1 uploads.
+
+    Each stage has its own pool of workers, sized to the resource it uses:
+    `num_download_workers` for the network download, `num_extract_workers` for the
+    ffmpeg decode and dedup, and `num_upload_workers` for the metadata, CLIP and
+    MinIO uploads. `queue_size` bounds how many videos wait between two stages,
+    i.e. how many downloaded videos sit on disk ahead of the extraction.
+
+    A failing stage marks its video as failed and the video skips the remaining
+    stages; the other videos are not affected.
+    """
+
+    def __init__(self,
+                 create_pipeline: Callable,
+                 num_download_workers: int = 2,
+                 num_extract_workers: int = 2,
+                 num_upload_workers: int = 4,
+                 queue_size: int = 1):
+        self.create_pipeline = create_pipeline
+        self.stage_pipeline = StagePipeline([
+            Stage('download', self._stage('download', 'run_download'), num_workers=num_download_workers, queue_size=queue_size),
+            Stage('extract', self._stage('extract', 'run_extract'), num_workers=num_extract_workers, queue_size=queue_size),
+            Stage('upload', self._stage('upload', 'run_upload'), num_workers=num_upload_workers, queue_size=queue_size),
+        ], output_queue_size=queue_size, name='videos')
+
+    @staticmethod
+    def _stage(name, method_name):
+        def run_stage(item):
+            video, pipeline, error = item
+            if error is not None:
+                return item
+
+            try:
+                getattr(pipeline, method_name)()
+            except Exception as e:
+                logger.error(msg=f"Error on {name} stage of video {video.video_id}: {e}")
+                return video, pipeline, f"{name} stage failed: {traceback.format_exc()}"
+
+            return item
+
+        return run_stage
+
+    def _source(self, videos):
+        for video in videos:
+            try:
+                yield video, self.create_pipeline(video), None
+            except Exception as e:
+                logger.error(msg=f"Error on creating the pipeline of video {video.video_id}: {e}")
+                yield video, None, f"creating the pipeline failed: {traceback.format_exc()}"
+
+    def run(self, videos):
+        """
+        Process `videos` and yield (is_success, video_id, pipeline, error) as each
+        one is done, in completion order. `pipeline` is None if it could not be
+        created. `error` is None on success, else the stage that failed and the
+        traceback of its exception.
+        """
+        for video, pipeline, error in self.stage_pipeline.run(self._source(videos)):
+            yield error is None, video.video_id, pipeline, error
+
+    def get_metrics(self) -> List[dict]:
+        """
+        Per-stage processed videos, busy/idle/blocked times and queue depths, see
+        `StagePipeline.get_metrics`.
+        """
+        return self.stage_pipeline.get_metrics()
@@ -0,0 +1,107 @@
+import argparse
+import time
+
+import sys
+base_dir = './'
+sys.path.insert(0, base_dir)
+
+from utility.video.video_processing.adaptive_sampler import AdaptiveSampler, DEFAULT_MIN_FPS, DEFAULT_MAX_FPS
+from utility.video.video_processing.extract_frames_from_video import (
+    SAMPLE_FPS,
+    ExtractionStats,
+    ExtractionStrategy,
+    _decode_frame_at,
+    analysis_frame_generator,
+    frame_generator,
+    get_video_info,
+    kept_frame_generator,
+)
+
+
+def run_decode(video_path, width, height, fps, analysis_width=None, full_resolution=True):
+    # decoding and piping only, what every frame of the stream costs before the sampler sees it
+    if analysis_width is None and full_resolution:
+        frames = frame_generator(video_path, fps=fps, width=width, height=height)
+    else:
+        frames = analysis_frame_generator(video_path, width=width, height=height, analysis_width=analysis_width or width,
+                                          fps=fps, full_resolution=full_resolution)
+
+    decoded = 0
+    start_time = time.perf_counter()
+    for _ in frames:
+        decoded += 1
+
+    return decoded, time.perf_counter() - start_time
+
+
+def run_extraction(video_path, width, height, strategy, analysis_width=None, sampler=None):
+    stats = ExtractionStats(strategy)
+    start_time = time.perf_counter()
+    kept = [frame_num for _, frame_num, _ in kept_frame_generator(video_path, width, height,
+                                                                   analysis_width=analysis_width,
+                                                                   strategy=strategy,
+                                                                   stats=stats,
+                                                                   sampler=sampler)]
+
+    return kept, stats, time.perf_counter() - start_time
+
+
+def run_fetches(video_path, width, height, frame_nums, fps):
+    # the seek and decode of a kept frame fetched at full resolution
+    start_time = time.perf_counter()
+    for frame_num in frame_nums:
+        _decode_frame_at(video_path, frame_num, width, height, fps=fps)
+
+    return (time.perf_counter() - start_time) / max(len(frame_nums), 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the cost of decoding at max_fps for the adaptive sampler, "
+                                                 "piping every frame or fetching the kept ones.")
+    parser.add_argument("--video_path", type=str, required=True, help="Path to the input video file")
+    parser.add_argument("--min_fps", type=float, default=DEFAULT_MIN_FPS, help="Lowest rate of the adaptive sampler")
+    parser.add_argument("--max_fps", type=float, default=DEFAULT_MAX_FPS, help="Highest rate of the adaptive sampler, the rate ffmpeg decodes at")
+    parser.add_argument("--analysis_width", type=int, default=None, help="Width of the analysis stream, full resolution dedup if not set")
+    parser.add_argument("--num_fetches", type=int, default=5, help="Kept frames fetched again to time a fetch")
+
+    args = parser.parse_args()
+
+    info = get_video_info(args.video_path)
+    print(info)
+    width, height = info['width'], info['height']
+
+    decode_results = {}
+    for fps in (args.max_fps, SAMPLE_FPS, args.min_fps):
+        decoded, elapsed = decode_results[fps] = run_decode(args.video_path, width, height, fps, args.analysis_width)
+        print(f"{'decode':>10} {fps:.3f} fps: {decoded} frames in {elapsed:.2f}s "
+              f"({1000 * elapsed / max(decoded, 1):.1f} ms/frame)")
+    # ffmpeg decodes every frame of the video whatever the rate, the rate only changes how many are scaled and piped
+    max_decoded, max_decode_elapsed = decode_results[args.max_fps]
+    min_decoded, min_decode_elapsed = decode_results[args.min_fps]
+    piped_frame_cost = max(max_decode_elapsed - min_decode_elapsed, 0.) / max(max_decoded - min_decoded, 1)
+    print(f"scale + pipe: {1000 * piped_frame_cost:.1f} ms/frame")
+    # what the adaptive strategy decodes when it fetches the kept frames
+    analysis_decoded, analysis_elapsed = run_decode(args.video_path, width, height, args.max_fps, args.analysis_width,
+                                                    full_resolution=False)
+    print(f"{'analysis':>10} {args.max_fps:.3f} fps: {analysis_decoded} frames in {analysis_elapsed:.2f}s, "
+          f"no full resolution frame")
+
+    orb_kept, orb_stats, orb_elapsed = run_extraction(args.video_path, width, height, ExtractionStrategy.ORB,
+                                                      args.analysis_width)
+    print(f"{'orb':>10}: {orb_stats.sampled_frames} sampled, {len(orb_kept)} kept in {orb_elapsed:.2f}s")
+
+    for fetch_kept_frames in (False, True):
+        kept, stats, elapsed = run_extraction(args.video_path, width, height, ExtractionStrategy.ADAPTIVE,
+                                              args.analysis_width,
+                                              AdaptiveSampler(min_fps=args.min_fps, max_fps=args.max_fps,
+                                                              fetch_kept_frames=fetch_kept_frames))
+        name = 'fetch' if fetch_kept_frames else 'pipe all'
+        print(f"{name:>10}: {stats.sampled_frames} decoded, {stats.skipped_frames} skipped, "
+              f"{len(kept)} kept in {elapsed:.2f}s")
+
+    # piping all frames scales and pipes the skipped ones, fetching seeks and decodes each kept one again
+    fetch_cost = run_fetches(args.video_path, width, height, kept[:args.num_fetches], args.max_fps)
+    skipped_cost = stats.skipped_frames * piped_frame_cost
+    print(f"fetch: {1000 * fetch_cost:.1f} ms/kept frame, {fetch_cost * len(kept):.2f}s for the kept frames "
+          f"against ~{skipped_cost:.2f}s of scale + pipe for the skipped ones: "
+          f"fetching pays off below {100 * piped_frame_cost / (piped_frame_cost + fetch_cost):.1f}% kept frames")
@@ -0,0 +1,76 @@
+import argparse
+import time
+
+import sys
+base_dir = './'
+sys.path.insert(0, base_dir)
+
+from utility.video.video_processing.extract_frames_from_video import (
+    FrameDeduplicator,
+    analysis_frame_generator,
+    frame_generator,
+    get_video_info,
+)
+
+
+def run_full_resolution(video_path, width, height):
+    deduplicator = FrameDeduplicator()
+
+    kept, sampled, dedup_time = [], 0, 0.
+    start_time = time.perf_counter()
+    for frame, frame_num in frame_generator(video_path, width=width, height=height):
+        sampled += 1
+        dedup_start = time.perf_counter()
+        if deduplicator.check(frame):
+            kept.append(frame_num)
+        dedup_time += time.perf_counter() - dedup_start
+
+    return kept, sampled, time.perf_counter() - start_time, dedup_time
+
+
+def run_analysis_stream(video_path, width, height, analysis_width):
+    deduplicator = FrameDeduplicator()
+
+    kept, sampled, dedup_time = [], 0, 0.
+    start_time = time.perf_counter()
+    for frame, analysis_frame, thumb, frame_num in analysis_frame_generator(video_path,
+                                                                           width=width,
+                                                                           height=height,
+                                                                           analysis_width=analysis_width):
+        sampled += 1
+        dedup_start = time.perf_counter()
+        if deduplicator.check_features(deduplicator.compute_descriptors(analysis_frame), thumb):
+            kept.append(frame_num)
+        dedup_time += time.perf_counter() - dedup_start
+
+    return kept, sampled, time.perf_counter() - start_time, dedup_time
+
+
+def print_result(name, sampled, elapsed, dedup_time, kept):
+    print(f"{name:>16}: {sampled} sampled frames in {elapsed:.2f}s "
+          f"({sampled / elapsed:.2f} frames/sec, dedup {dedup_time:.2f}s), {len(kept)} kept")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare dedup on full resolution frames against the low resolution analysis stream.")
+    parser.add_argument("--video_path", type=str, required=True, help="Path to the input video file")
+    parser.add_argument("--analysis_width", type=int, default=480, help="Width of the grayscale analysis stream")
+
+    args = parser.parse_args()
+
+    info = get_video_info(args.video_path)
+    print(info)
+
+    full_kept, full_sampled, full_elapsed, full_dedup_time = \
+        run_full_resolution(args.video_path, info['width'], info['height'])
+    analysis_kept, analysis_sampled, analysis_elapsed, analysis_dedup_time = \
+        run_analysis_stream(args.video_path, info['width'], info['height'], args.analysis_width)
+
+    print_result("full resolution", full_sampled, full_elapsed, full_dedup_time, full_kept)
+    print_result(f"analysis {args.analysis_width}px", analysis_sampled, analysis_elapsed, analysis_dedup_time, analysis_kept)
+
+    full_kept, analysis_kept = set(full_kept), set(analysis_kept)
+    print(f"kept by both: {len(full_kept & analysis_kept)}, "
+          f"full resolution only: {sorted(full_kept - analysis_kept)}, "
+          f"analysis only: {sorted(analysis_kept - full_kept)}")
+    print(f"speedup: {full_elapsed / analysis_elapsed:.2f}x")
@@ -0,0 +1,58 @@
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+import sys
+base_dir = './'
+sys.path.insert(0, base_dir)
+
+from kandinsky.models.clip_image_encoder.clip_image_encoder import KandinskyCLIPImageEncoder
+from kandinsky.models.clip_image_encoder.batched_clip_image_encoder import BatchedCLIPImageEncoder
+
+
+def run(encoder, images, num_threads):
+    latencies = []
+
+    def encode(image):
+        start_time = time.perf_counter()
+        encoder.get_image_features(image)
+        latencies.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        list(executor.map(encode, images))
+
+    return time.perf_counter() - start_time, np.array(latencies)
+
+
+def print_result(name, num_images, elapsed, latencies):
+    print(f"{name:>10}: {num_images / elapsed:.2f} images/sec, "
+          f"latency p50 {np.percentile(latencies, 50) * 1000:.0f}ms p99 {np.percentile(latencies, 99) * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare per-image CLIP encoding against the batching encoder service.")
+    parser.add_argument("--num_images", type=int, default=256, help="Number of images to encode")
+    parser.add_argument("--num_threads", type=int, default=32, help="Number of threads submitting images")
+    parser.add_argument("--max_batch_size", type=int, default=32, help="Largest batch of the service")
+    parser.add_argument("--max_wait", type=float, default=0.01, help="Seconds the service waits to fill a batch")
+
+    args = parser.parse_args()
+
+    encoder = KandinskyCLIPImageEncoder(device='cuda' if torch.cuda.is_available() else 'cpu')
+    encoder.load_submodels()
+
+    rng = np.random.default_rng(0)
+    images = [Image.fromarray(rng.integers(0, 256, (720, 1280, 3), dtype=np.uint8)) for _ in range(args.num_images)]
+
+    elapsed, latencies = run(encoder, images, args.num_threads)
+    print_result("direct", len(images), elapsed, latencies)
+
+    with BatchedCLIPImageEncoder(encoder, max_batch_size=args.max_batch_size, max_wait=args.max_wait) as service:
+        batched_elapsed, batched_latencies = run(service, images, args.num_threads)
+        print_result("batched", len(images), batched_elapsed, batched_latencies)
+        print(f"{service.get_stats()}, speedup {elapsed / batched_elapsed:.2f}x")
@@ -0,0 +1,47 @@
+import argparse
+import time
+
+import numpy as np
+
+import sys
+base_dir = './'
+sys.path.insert(0, base_dir)
+
+from utility.clip.embedding_format import decode_embedding, encode_embedding, encode_legacy_embedding
+
+
+def run(name, encode, vectors):
+    start_time = time.perf_counter()
+    encoded = [encode(vector) for vector in vectors]
+    encode_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    decoded = [decode_embedding(data) for data in encoded]
+    decode_time = time.perf_counter() - start_time
+
+    for vector, result in zip(vectors, decoded):
+        assert np.array_equal(vector.astype(np.float32), result.astype(np.float32)), f"{name} round trip changed the values"
+
+    size = sum(len(data) for data in encoded) / len(encoded)
+    print(f"{name:>8}: {size:.0f} bytes/vector, "
+          f"encode {len(vectors) / encode_time:.0f} vectors/sec, decode {len(vectors) / decode_time:.0f} vectors/sec")
+
+    return size, encode_time, decode_time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the binary CLIP vector format against the legacy msgpack one.")
+    parser.add_argument("--num_vectors", type=int, default=10000, help="Number of vectors to encode and decode")
+    parser.add_argument("--dim", type=int, default=1280, help="Size of the vectors")
+
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    # same shape and dtype as KandinskyCLIPImageEncoder.get_image_features
+    vectors = [rng.standard_normal((1, args.dim)).astype(np.float16) for _ in range(args.num_vectors)]
+
+    legacy_size, legacy_encode_time, legacy_decode_time = run("msgpack", encode_legacy_embedding, vectors)
+    binary_size, binary_encode_time, binary_decode_time = run("binary", encode_embedding, vectors)
+
+    print(f"size {legacy_size / binary_size:.1f}x smaller, encode {legacy_encode_time / binary_encode_time:.1f}x faster, "
+          f"decode {legacy_decode_time / binary_decode_time:.1f}x faster")
@@ -0,0 +1,105 @@
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+import sys
+base_dir = './'
+sys.path.insert(0, base_dir)
+
+from utility.utils.image_utils import get_image_hash, get_blake256_hash, get_data_hashes, fingerprint_frame
+from utility.video.video_processing.extract_frames_from_video import frame_generator, get_video_info
+
+
+def get_image_info_reopen(img_path):
+    # frame info as computed before fingerprint_frame: reopen the file, two passes
+    img = Image.open(fp=img_path)
+    return {
+        "image_hash": get_image_hash(img=img),
+        "blake256_hash": get_blake256_hash(img=img),
+        "image_resolution": {
+            "width": img.size[0],
+            "height": img.size[1]
+        },
+        "image_format": img.format
+    }
+
+
+def run_reopen(frames, output_dir):
+    infos = []
+    start_time = time.perf_counter()
+    for index, frame in enumerate(frames):
+        frame_path = os.path.join(output_dir, f'{index:05d}.jpg')
+        Image.fromarray(frame).save(frame_path)
+        infos.append(get_image_info_reopen(frame_path))
+
+    return infos, time.perf_counter() - start_time
+
+
+def run_fingerprint(frames, output_dir, executor=None):
+    infos = []
+    start_time = time.perf_counter()
+    for index, frame in enumerate(frames):
+        data, frame_info = fingerprint_frame(frame, executor=executor)
+        with open(os.path.join(output_dir, f'{index:05d}.jpg'), 'wb') as f:
+            f.write(data)
+        infos.append(frame_info)
+
+    return infos, time.perf_counter() - start_time
+
+
+def run_hashes(frames, executor=None):
+    # the hashing alone, on the pixels fingerprint_frame hashes
+    start_time = time.perf_counter()
+    digests = [get_data_hashes(frame, executor=executor) for frame in frames]
+    return digests, time.perf_counter() - start_time
+
+
+def get_executor(num_workers):
+    return ThreadPoolExecutor(max_workers=num_workers) if num_workers else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare save-and-reopen frame hashing against in-memory fingerprinting.")
+    parser.add_argument("--video_path", type=str, required=True, help="Path to the input video file")
+    parser.add_argument("--num_frames", type=int, default=50, help="Number of frames to fingerprint")
+    parser.add_argument("--fps", type=float, default=1., help="Rate at which the frames are sampled from the video")
+    parser.add_argument("--num_workers", type=int, nargs='+', default=[0, 2], help="Hashing thread pool sizes to try, 0 for serial")
+
+    args = parser.parse_args()
+
+    info = get_video_info(args.video_path)
+    print(info)
+
+    frames = []
+    for frame, _ in frame_generator(args.video_path, fps=args.fps, width=info['width'], height=info['height']):
+        frames.append(frame.copy())
+        if len(frames) == args.num_frames:
+            break
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        reference, elapsed = run_reopen(frames, output_dir)
+        print(f"{'save + reopen':>16}: {len(frames) / elapsed:.2f} frames/sec")
+
+        for num_workers in args.num_workers:
+            executor = get_executor(num_workers)
+            infos, fingerprint_elapsed = run_fingerprint(frames, output_dir, executor)
+            assert infos == reference, "fingerprints differ from get_image_info"
+            print(f"{f'in memory x{num_workers}':>16}: {len(frames) / fingerprint_elapsed:.2f} frames/sec, "
+                  f"speedup {elapsed / fingerprint_elapsed:.2f}x")
+            if executor is not None:
+                executor.shutdown()
+
+    serial_digests, serial_elapsed = run_hashes(frames)
+    print(f"{'hashes x0':>16}: {len(frames) / serial_elapsed:.2f} frames/sec")
+    for num_workers in args.num_workers:
+        if not num_workers:
+            continue
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            digests, hashes_elapsed = run_hashes(frames, executor)
+        assert digests == serial_digests, "threaded digests differ"
+        print(f"{f'hashes x{num_workers}':>16}: {len(frames) / hashes_elapsed:.2f} frames/sec, "
+              f"speedup {serial_elapsed / hashes_elapsed:.2f}x")
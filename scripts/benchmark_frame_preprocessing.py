@@ -0,0 +1,75 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from transformers import CLIPImageProcessor
+
+import sys
+base_dir = './'
+sys.path.insert(0, base_dir)
+
+from kandinsky.model_paths import PRIOR_MODEL_PATH
+from kandinsky.models.clip_image_encoder.frame_preprocessor import FramePreprocessor
+
+
+def load_frames(image_dir, num_frames, height, width):
+    if image_dir is None:
+        rng = np.random.default_rng(0)
+        frames = rng.integers(0, 256, (num_frames, height, width, 3), dtype=np.uint8)
+        # half of the frames smooth, closer to video content than noise
+        frames[::2] = np.clip(np.cumsum(rng.integers(-3, 4, (len(frames[::2]), height, width, 3)), axis=2) + 128, 0, 255)
+        return list(frames)
+
+    file_names = sorted(file_name for file_name in os.listdir(image_dir)
+                        if file_name.lower().endswith(('.jpg', '.jpeg', '.png')))
+    return [np.asarray(Image.open(os.path.join(image_dir, file_name)).convert('RGB')) for file_name in file_names[:num_frames]]
+
+
+def time_per_frame(preprocess, frames, batch_size):
+    pixel_values = []
+    start_time = time.perf_counter()
+    for start in range(0, len(frames), batch_size):
+        pixel_values.append(preprocess(frames[start:start + batch_size]).cpu())
+    elapsed = time.perf_counter() - start_time
+
+    return torch.cat(pixel_values), elapsed / len(frames) * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that FramePreprocessor matches CLIPImageProcessor and compare their speed.")
+    parser.add_argument("--image_dir", type=str, default=None, help="Directory of sample jpg/png frames (random frames if not given)")
+    parser.add_argument("--num_frames", type=int, default=64, help="Number of frames")
+    parser.add_argument("--height", type=int, default=1080, help="Height of the random frames")
+    parser.add_argument("--width", type=int, default=1920, help="Width of the random frames")
+    parser.add_argument("--batch_size", type=int, default=32, help="Frames per preprocessing call")
+    parser.add_argument("--atol", type=float, default=0., help="Largest absolute difference accepted")
+
+    args = parser.parse_args()
+
+    image_processor = CLIPImageProcessor.from_pretrained(PRIOR_MODEL_PATH, subfolder="image_processor", local_files_only=True)
+    frames = load_frames(args.image_dir, args.num_frames, args.height, args.width)
+
+    expected, reference_ms = time_per_frame(
+        lambda batch: image_processor([Image.fromarray(frame) for frame in batch], return_tensors="pt")['pixel_values'],
+        frames, args.batch_size)
+    print(f"{'CLIPImageProcessor':>24}: {reference_ms:.2f} ms/frame")
+
+    devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+    failed = False
+    for device in devices:
+        frame_preprocessor = FramePreprocessor.from_image_processor(image_processor, device=device)
+        # warm up (taps and kernels), then measure
+        frame_preprocessor(frames[:args.batch_size])
+        pixel_values, ms = time_per_frame(frame_preprocessor, frames, args.batch_size)
+
+        max_abs_diff = (pixel_values - expected).abs().max().item()
+        mismatches = (pixel_values != expected).float().mean().item()
+        failed |= max_abs_diff > args.atol
+        print(f"{f'FramePreprocessor ({device})':>24}: {ms:.2f} ms/frame, speedup {reference_ms / ms:.2f}x, "
+              f"max abs diff {max_abs_diff:.3g}, mismatched values {mismatches:.3%}")
+
+    if failed:
+        sys.exit(f"pixel_values differ from CLIPImageProcessor by more than {args.atol}")
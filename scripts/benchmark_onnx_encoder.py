@@ -0,0 +1,93 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+import sys
+base_dir = './'
+sys.path.insert(0, base_dir)
+
+from kandinsky.models.clip_image_encoder.clip_image_encoder import KandinskyCLIPImageEncoder, EncoderPrecision
+from kandinsky.models.clip_image_encoder.inference_backend import BackendType, verify_backend
+
+
+def load_images(image_dir, num_images):
+    if image_dir is None:
+        rng = np.random.default_rng(0)
+        return [Image.fromarray(rng.integers(0, 256, (720, 1280, 3), dtype=np.uint8)) for _ in range(num_images)]
+
+    file_names = sorted(file_name for file_name in os.listdir(image_dir)
+                        if file_name.lower().endswith(('.jpg', '.jpeg', '.png')))
+    return [Image.open(os.path.join(image_dir, file_name)).convert('RGB') for file_name in file_names[:num_images]]
+
+
+def measure_throughput(backend, pixel_values, batch_size):
+    # warm up, then measure
+    backend.run(pixel_values[:batch_size])
+    start_time = time.perf_counter()
+    for start in range(0, len(pixel_values), batch_size):
+        backend.run(pixel_values[start:start + batch_size])
+
+    return len(pixel_values) / (time.perf_counter() - start_time)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the ONNX Runtime CLIP image encoder against torch and compare their CPU throughput.")
+    parser.add_argument("--image_dir", type=str, default=None, help="Directory of sample jpg/png frames (random images if not given)")
+    parser.add_argument("--num_images", type=int, default=32, help="Number of images of the sample set")
+    parser.add_argument("--batch_size", type=int, default=8, help="Images per forward pass")
+    parser.add_argument("--precision", type=str, default=EncoderPrecision.FP32, choices=[EncoderPrecision.FP32, EncoderPrecision.INT8], help="Precision of the ONNX encoder, the torch reference is fp32")
+    parser.add_argument("--onnx_batch_size", type=int, default=None, help="Static batch axis of the exported graph (dynamic if not given)")
+    parser.add_argument("--intra_op_num_threads", type=int, default=None, help="ONNX Runtime threads within an operator")
+    parser.add_argument("--inter_op_num_threads", type=int, default=None, help="ONNX Runtime threads across operators")
+    parser.add_argument("--num_threads", type=int, default=None, help="torch CPU threads (torch default if not given)")
+    parser.add_argument("--min_cosine", type=float, default=None, help="Lowest cosine similarity accepted against torch (0.9999, 0.99 for int8, if not given)")
+    parser.add_argument("--atol", type=float, default=1e-2, help="Largest absolute difference accepted against torch (not checked for int8)")
+    parser.add_argument("--report_path", type=str, default=None, help="Write the report as json")
+
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    images = load_images(args.image_dir, args.num_images)
+
+    # both on CPU, to compare the runtimes rather than the devices
+    torch_encoder = KandinskyCLIPImageEncoder(device='cpu', precision=EncoderPrecision.FP32).load_submodels()
+    pixel_values = torch_encoder.image_processor(images, return_tensors="np")['pixel_values']
+
+    start_time = time.perf_counter()
+    onnx_encoder = KandinskyCLIPImageEncoder(precision=args.precision,
+                                             backend=BackendType.ONNX,
+                                             onnx_batch_size=args.onnx_batch_size,
+                                             intra_op_num_threads=args.intra_op_num_threads,
+                                             inter_op_num_threads=args.inter_op_num_threads).load_submodels()
+    load_time = time.perf_counter() - start_time
+
+    is_quantized = args.precision == EncoderPrecision.INT8
+    atol = None if is_quantized else args.atol
+    min_cosine = args.min_cosine if args.min_cosine is not None else (0.99 if is_quantized else 0.9999)
+    report = {
+        'num_images': len(images),
+        'batch_size': args.batch_size,
+        'precision': args.precision,
+        'onnx_model_path': onnx_encoder.backend.model_path,
+        # includes the export on the first run
+        'onnx_load_time': load_time,
+    }
+    report.update(verify_backend(torch_encoder.backend, onnx_encoder.backend, pixel_values,
+                                 min_cosine=min_cosine, atol=atol))
+    report['torch_images_per_sec'] = measure_throughput(torch_encoder.backend, pixel_values, args.batch_size)
+    report['onnx_images_per_sec'] = measure_throughput(onnx_encoder.backend, pixel_values, args.batch_size)
+    report['speedup'] = report['onnx_images_per_sec'] / report['torch_images_per_sec']
+
+    for key, value in report.items():
+        print(f"{key:>22}: {value:.4f}" if isinstance(value, float) else f"{key:>22}: {value}")
+
+    if args.report_path is not None:
+        with open(args.report_path, 'w') as f:
+            json.dump(report, f, indent=4)
@@ -0,0 +1,107 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+import sys
+base_dir = './'
+sys.path.insert(0, base_dir)
+
+from kandinsky.models.clip_image_encoder.clip_image_encoder import KandinskyCLIPImageEncoder, EncoderPrecision
+
+
+def load_images(image_dir, num_images):
+    if image_dir is None:
+        rng = np.random.default_rng(0)
+        return [Image.fromarray(rng.integers(0, 256, (720, 1280, 3), dtype=np.uint8)) for _ in range(num_images)]
+
+    file_names = sorted(file_name for file_name in os.listdir(image_dir)
+                        if file_name.lower().endswith(('.jpg', '.jpeg', '.png')))
+    return [Image.open(os.path.join(image_dir, file_name)).convert('RGB') for file_name in file_names[:num_images]]
+
+
+def encode(encoder, pixel_values, batch_size):
+    """
+    Return the (N, D) float32 features and the images/sec of the forward passes.
+    """
+    features = []
+    start_time = time.perf_counter()
+    for start in range(0, len(pixel_values), batch_size):
+        features.append(encoder.get_image_features(pixel_values[start:start + batch_size]).float().cpu())
+    elapsed = time.perf_counter() - start_time
+
+    return torch.cat(features).numpy(), len(pixel_values) / elapsed
+
+
+def compare(reference, features):
+    reference = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+    features = features / np.linalg.norm(features, axis=1, keepdims=True)
+    cosine = np.sum(reference * features, axis=1)
+
+    # same nearest neighbour (other than itself) in both embedding spaces
+    reference_similarity = reference @ reference.T
+    similarity = features @ features.T
+    np.fill_diagonal(reference_similarity, -np.inf)
+    np.fill_diagonal(similarity, -np.inf)
+    neighbour_agreement = np.mean(reference_similarity.argmax(axis=1) == similarity.argmax(axis=1))
+
+    return {
+        'cosine_mean': float(cosine.mean()),
+        'cosine_min': float(cosine.min()),
+        'cosine_p1': float(np.percentile(cosine, 1)),
+        'nearest_neighbour_agreement': float(neighbour_agreement),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Accuracy and throughput of the INT8 CLIP image encoder against a reference precision.")
+    parser.add_argument("--image_dir", type=str, default=None, help="Directory of sample jpg/png frames (random images if not given)")
+    parser.add_argument("--num_images", type=int, default=64, help="Number of images of the sample set")
+    parser.add_argument("--batch_size", type=int, default=8, help="Images per forward pass")
+    parser.add_argument("--reference", type=str, default=EncoderPrecision.FP32, choices=[EncoderPrecision.FP16, EncoderPrecision.FP32], help="Precision of the reference encoder")
+    parser.add_argument("--num_threads", type=int, default=None, help="torch CPU threads (torch default if not given)")
+    parser.add_argument("--report_path", type=str, default=None, help="Write the report as json")
+
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    images = load_images(args.image_dir, args.num_images)
+
+    reference_encoder = KandinskyCLIPImageEncoder(precision=args.reference).load_submodels()
+    pixel_values = reference_encoder.image_processor(images, return_tensors="pt")['pixel_values']
+    # warm up, then measure
+    encode(reference_encoder, pixel_values[:args.batch_size], args.batch_size)
+    reference_features, reference_throughput = encode(reference_encoder, pixel_values, args.batch_size)
+    reference_device = reference_encoder.device
+    reference_encoder.unload_submodels()
+
+    start_time = time.perf_counter()
+    quantized_encoder = KandinskyCLIPImageEncoder(precision=EncoderPrecision.INT8).load_submodels()
+    load_time = time.perf_counter() - start_time
+    encode(quantized_encoder, pixel_values[:args.batch_size], args.batch_size)
+    quantized_features, quantized_throughput = encode(quantized_encoder, pixel_values, args.batch_size)
+
+    report = {
+        'num_images': len(images),
+        'batch_size': args.batch_size,
+        'reference': f"{args.reference} ({reference_device})",
+        'reference_images_per_sec': reference_throughput,
+        'int8_images_per_sec': quantized_throughput,
+        'speedup': quantized_throughput / reference_throughput,
+        # includes the quantization on the first run, a cache read afterwards
+        'int8_load_time': load_time,
+    }
+    report.update(compare(reference_features, quantized_features))
+
+    for key, value in report.items():
+        print(f"{key:>28}: {value:.4f}" if isinstance(value, float) else f"{key:>28}: {value}")
+
+    if args.report_path is not None:
+        with open(args.report_path, 'w') as f:
+            json.dump(report, f, indent=4)
@@ -0,0 +1,82 @@
+import argparse
+
+import numpy as np
+import torch
+from PIL import Image
+from transformers import CLIPImageProcessor
+
+import sys
+base_dir = './'
+sys.path.insert(0, base_dir)
+
+from kandinsky.models.clip_image_encoder.frame_preprocessor import FramePreprocessor
+
+# image_processor/preprocessor_config.json of kandinsky-2-2-prior, so that the check runs without the weights
+IMAGE_PROCESSOR_CONFIG = {
+    "crop_size": {"height": 224, "width": 224},
+    "do_center_crop": True,
+    "do_convert_rgb": True,
+    "do_normalize": True,
+    "do_rescale": True,
+    "do_resize": True,
+    "image_mean": [0.48145466, 0.4578275, 0.40821073],
+    "image_std": [0.26862954, 0.26130258, 0.27577711],
+    "resample": 3,
+    "rescale_factor": 0.00392156862745098,
+    "size": {"shortest_edge": 224},
+}
+
+# (height, width): landscape and portrait video sizes, odd sizes, no resize, and an upscale
+FRAME_SIZES = ((1080, 1920), (720, 1280), (1920, 1080), (481, 639), (224, 224), (160, 200))
+
+
+def get_frames(height, width, num_frames, seed):
+    rng = np.random.default_rng(seed)
+    frames = rng.integers(0, 256, (num_frames, height, width, 3), dtype=np.uint8)
+    # half of the frames smooth, closer to video content than noise
+    frames[::2] = np.clip(np.cumsum(rng.integers(-3, 4, (len(frames[::2]), height, width, 3)), axis=2) + 128, 0, 255)
+    return frames
+
+
+def check_parity(image_processor, device='cpu', num_frames=4, seed=0) -> bool:
+    """
+    Compare the `pixel_values` of `FramePreprocessor` and `image_processor` on
+    seeded frames of each of `FRAME_SIZES`, one batch per size and one list of
+    mixed sizes. Returns True if they are equal.
+    """
+    frame_preprocessor = FramePreprocessor.from_image_processor(image_processor, device=device)
+
+    batches = [get_frames(height, width, num_frames, seed + index) for index, (height, width) in enumerate(FRAME_SIZES)]
+    batches.append([batch[0] for batch in batches])
+
+    equal = True
+    for batch in batches:
+        expected = image_processor([Image.fromarray(frame) for frame in batch], return_tensors="pt")['pixel_values']
+        pixel_values = frame_preprocessor(batch).cpu()
+
+        max_abs_diff = (pixel_values - expected).abs().max().item()
+        sizes = sorted({frame.shape[:2] for frame in batch})
+        print(f"{device} {sizes}: max abs diff {max_abs_diff:.3g}")
+        equal &= torch.equal(pixel_values, expected)
+
+    return equal
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that FramePreprocessor gives the same pixel_values as CLIPImageProcessor.")
+    parser.add_argument("--config_path", type=str, default=None, help="preprocessor_config.json to check, the kandinsky prior settings if not given")
+    parser.add_argument("--num_frames", type=int, default=4, help="Frames per size")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random frames")
+
+    args = parser.parse_args()
+
+    if args.config_path is None:
+        image_processor = CLIPImageProcessor(**IMAGE_PROCESSOR_CONFIG)
+    else:
+        image_processor = CLIPImageProcessor.from_json_file(args.config_path)
+
+    devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+    failed = [device for device in devices if not check_parity(image_processor, device, args.num_frames, args.seed)]
+    if failed:
+        sys.exit(f"pixel_values differ from CLIPImageProcessor on {failed}")
+    print("pixel_values match CLIPImageProcessor")
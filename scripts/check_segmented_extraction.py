@@ -0,0 +1,57 @@
+import argparse
+import os
+import tempfile
+import time
+
+import sys
+base_dir = './'
+sys.path.insert(0, base_dir)
+
+from utility.video.video_processing.extract_frames_from_video import SAMPLE_FPS, process_video
+
+
+def run(video_path, output_dir, num_segments):
+    start_time = time.perf_counter()
+    frames = process_video(video_path, output_dir, SAMPLE_FPS, num_segments=num_segments)
+    return frames, time.perf_counter() - start_time
+
+
+def get_kept(frames):
+    # what the pipeline registers and uploads for each kept frame
+    return [(frame_info['frame_num'], os.path.basename(frame_info['file_path']), frame_info['image_hash'])
+            for frame_info in frames]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that segment-parallel extraction keeps the same frames as the serial mode.")
+    parser.add_argument("--video_path", type=str, required=True, help="Path to the input video file")
+    parser.add_argument("--num_segments", type=int, nargs='+', default=[2, 4], help="Segment counts to check")
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        serial_frames, serial_elapsed = run(args.video_path, os.path.join(output_dir, 'serial'), 1)
+        expected = get_kept(serial_frames)
+        print(f"{'serial':>12}: {len(expected)} kept in {serial_elapsed:.2f}s")
+
+        failed = []
+        for num_segments in args.num_segments:
+            segment_dir = os.path.join(output_dir, f'segments_{num_segments}')
+            frames, elapsed = run(args.video_path, segment_dir, num_segments)
+            kept = get_kept(frames)
+
+            expected_nums, kept_nums = {frame_num for frame_num, _, _ in expected}, {frame_num for frame_num, _, _ in kept}
+            print(f"{f'{num_segments} segments':>12}: {len(kept)} kept in {elapsed:.2f}s, speedup {serial_elapsed / elapsed:.2f}x, "
+                  f"serial only: {sorted(expected_nums - kept_nums)}, segmented only: {sorted(kept_nums - expected_nums)}")
+
+            if kept != expected or sorted(os.listdir(segment_dir)) != sorted(name for _, name, _ in expected):
+                # kept by both with other hashes: boundary frames decoded differently after the seek
+                expected_hashes = {frame_num: image_hash for frame_num, _, image_hash in expected}
+                different_hashes = [frame_num for frame_num, _, image_hash in kept
+                                    if frame_num in expected_hashes and expected_hashes[frame_num] != image_hash]
+                print(f"{'':>12}  frames with other pixels than the serial mode: {different_hashes}")
+                failed.append(num_segments)
+
+    if failed:
+        sys.exit(f"segmented extraction differs from the serial mode with num_segments {failed}")
+    print("segmented extraction matches the serial mode")
@@ -1,8 +1,11 @@
+import os
 import json
+import time
+import socket
+import argparse
+import threading
+import multiprocessing
 from typing import List
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
-import torch
 
 import sys
 
@@ -12,61 +15,334 @@ sys.path.insert(0, base_dir)
 from config import MINIO_ACCESS_KEY, MINIO_ADDRESS, MINIO_SECRET_KEY
 
 from schema import VideoMetaData
-from kandinsky.models.clip_image_encoder.clip_image_encoder import KandinskyCLIPImageEncoder
-from pipelines import VideoProcessingPipeline
+from kandinsky.models.clip_image_encoder.clip_image_encoder import KandinskyCLIPImageEncoder, EncoderPrecision
+from kandinsky.models.clip_image_encoder.inference_backend import BackendType
+from kandinsky.models.clip_image_encoder.batched_clip_image_encoder import BatchedCLIPImageEncoder
+from pipelines import VideoProcessingPipeline, VideoStageScheduler
 from utility.minio import cmd
 from utility.http.request import http_get_unprocessed_videos
+from utility.http.image_metadata_writer import ImageMetadataWriter
+from utility.clip import embedding_cache
+from utility.video.video_processing import known_hash_index
+from utility.video.video_processing.extract_frames_from_video import ExtractionStrategy, DEFAULT_SCENE_THRESHOLD, check_segmented_options
+from utility.video.video_processing import adaptive_sampler
+from utility.video.video_processing import phash_index
+from utility.clip.embedding_format import EmbeddingFormat
+from utility.utils import tar_shard
+from utility.utils.job_queue import JobQueue, JobState, DEFAULT_LEASE_SECONDS, DEFAULT_MAX_ATTEMPTS
+from utility.utils import metrics
 from utility import logger
 
-def run_pipeline(minio_client, image_encoder, video: VideoMetaData) -> bool:
-    pipeline = VideoProcessingPipeline(minio_client=minio_client, image_encoder=image_encoder, video=video)
-    return pipeline.run(), pipeline.get_uploaded_image_count()
-
-def run_video_processing(minio_client, 
-                        image_encoder,
-                        videos: List[VideoMetaData], 
-                        batch_size: int = 1,
-                        max_workers:int = 8) -> List[str]:
-    futures = []
-    failed_video_info_list = []
-    len_videos = len(videos)
-    logger.info("video processing...")
-    total_uploaded_image_count = 0
-    for index in range(0, len_videos, batch_size):
-        batch_videos = videos[index:min(index+batch_size, len_videos)]
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            for video in batch_videos:
-                futures.append(executor.submit(run_pipeline, minio_client, image_encoder, video))
-
-            for future in as_completed(futures):
-                is_success, url, uploaded_image_count = future.result()
-                total_uploaded_image_count += uploaded_image_count
-                logger.critical(f"Uploaded images count: {total_uploaded_image_count}")
-                if not is_success:
-                    failed_video_info_list.append(url)
-        logger.info(f"{index + 1}/{len_videos} videos processed")
 
-    return failed_video_info_list
+def load_image_encoder(precision: str = EncoderPrecision.FP16,
+                       backend: str = BackendType.TORCH,
+                       intra_op_num_threads: int = None,
+                       inter_op_num_threads: int = None):
+    print('Loading image-process-encoder model')
+    # the torch backend runs on the GPU if there is one
+    encoder = KandinskyCLIPImageEncoder(precision=precision,
+                                        backend=backend,
+                                        intra_op_num_threads=intra_op_num_threads,
+                                        inter_op_num_threads=inter_op_num_threads)
+    encoder.load_submodels()
+    print('Successfully loaded the model')
+    # the pipelines running in parallel share batched forward passes
+    return BatchedCLIPImageEncoder(encoder)
 
 
-if __name__ == '__main__':
+def _leased_videos(queue: JobQueue, owner: str, poll_interval: float):
+    """
+    Lease the videos of the queue one at a time, as the scheduler takes them. Jobs
+    leased by other workers may come back (failure, lost lease), so the queue is
+    polled until all the jobs are done or dead-lettered.
+    """
+    while True:
+        job = queue.lease(owner)
+        if job is not None:
+            logger.info(f"Leased video {job.job_id} (attempt {job.attempts}/{queue.max_attempts})")
+            yield VideoMetaData.deserialize(job.payload)
+        elif queue.is_finished():
+            return
+        else:
+            time.sleep(poll_interval)
+
+
+def _send_heartbeats(queue: JobQueue, owner: str, stop_event: threading.Event):
+    while not stop_event.wait(queue.lease_seconds / 3):
+        queue.heartbeat(owner)
+
+
+def start_metrics_exporters(queue: JobQueue, worker_index: int, metrics_port: int = None, metrics_dir: str = None,
+                            metrics_interval: float = metrics.DEFAULT_METRICS_INTERVAL) -> list:
+    """
+    Expose the metrics of the worker on port `metrics_port + worker_index` and in
+    `<metrics_dir>/video_worker_<worker_index>.prom`, each sample labelled with the
+    worker index. Returns the exporters, closed by the caller.
+    """
+    metrics.REGISTRY.const_labels['worker'] = str(worker_index)
+    jobs = metrics.gauge('video_jobs', 'Videos of the job queue, by state', ['state'])
+    for state in JobState.ALL:
+        jobs.labels(state=state).set_function(lambda state=state: queue.counts()[state])
+
+    exporters = []
+    if metrics_port is not None:
+        exporters.append(metrics.start_http_server(metrics_port + worker_index))
+        logger.info(f"Serving metrics at http://127.0.0.1:{exporters[-1].port}/metrics")
+    if metrics_dir is not None:
+        exporters.append(metrics.start_file_writer(os.path.join(metrics_dir, f"video_worker_{worker_index}.prom"), metrics_interval))
+    return exporters
+
+
+def run_video_processing_worker(queue_path: str,
+                                streaming: bool = False,
+                                lease_seconds: float = DEFAULT_LEASE_SECONDS,
+                                max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                                num_download_workers: int = 2,
+                                num_extract_workers: int = 2,
+                                num_upload_workers: int = 4,
+                                poll_interval: float = 5.,
+                                encoder_precision: str = EncoderPrecision.FP16,
+                                encoder_backend: str = BackendType.TORCH,
+                                intra_op_num_threads: int = None,
+                                inter_op_num_threads: int = None,
+                                embedding_cache_path: str = None,
+                                embedding_cache_max_bytes: int = embedding_cache.DEFAULT_MAX_CACHE_BYTES,
+                                embedding_cache_bucket: str = None,
+                                num_segments: int = 1,
+                                analysis_width: int = None,
+                                strategy: str = ExtractionStrategy.ORB,
+                                scene_threshold: float = DEFAULT_SCENE_THRESHOLD,
+                                min_fps: float = adaptive_sampler.DEFAULT_MIN_FPS,
+                                max_fps: float = adaptive_sampler.DEFAULT_MAX_FPS,
+                                fetch_kept_frames: bool = True,
+                                pipelined: bool = False,
+                                num_extraction_workers: int = 4,
+                                num_hash_workers: int = 0,
+                                phash_index_dir: str = None,
+                                phash_radius: int = phash_index.DEFAULT_RADIUS,
+                                known_hash_index_path: str = None,
+                                embedding_format: str = EmbeddingFormat.BINARY,
+                                embedding_shards: bool = False,
+                                frames_per_shard: int = None,
+                                pack_frames: bool = False,
+                                max_tar_shard_bytes: int = tar_shard.DEFAULT_MAX_SHARD_BYTES,
+                                resume: bool = True,
+                                worker_index: int = 0,
+                                metrics_port: int = None,
+                                metrics_dir: str = None,
+                                metrics_interval: float = metrics.DEFAULT_METRICS_INTERVAL) -> None:
+    """
+    Worker process of `run_video_processing_queue`: loads its own encoder and runs
+    the videos it leases from the queue through a `VideoStageScheduler`, keeping
+    the leases with heartbeats, until the queue is finished.
+    """
+    owner = f"{socket.gethostname()}-{os.getpid()}"
+    queue = JobQueue(queue_path, lease_seconds=lease_seconds, max_attempts=max_attempts)
+    exporters = start_metrics_exporters(queue, worker_index, metrics_port, metrics_dir, metrics_interval)
 
-    # Load minio client using access and secret key, minio ip address
     minio_client = cmd.get_minio_client(minio_access_key=MINIO_ACCESS_KEY,
                                         minio_secret_key=MINIO_SECRET_KEY,
                                         minio_ip_addr=MINIO_ADDRESS)
-    
-    print('Loading image-process-encoder model')
-    encoder = KandinskyCLIPImageEncoder(device= 'cuda' if torch.cuda.is_available() else 'cpu')
-    encoder.load_submodels()
-    print('Successfully loaded the model')
-    
+    encoder = load_image_encoder(encoder_precision, encoder_backend, intra_op_num_threads, inter_op_num_threads)
+    image_metadata_writer = ImageMetadataWriter()
+    scheduler = VideoStageScheduler(
+        lambda video: VideoProcessingPipeline(minio_client=minio_client,
+                                              image_encoder=encoder,
+                                              video=video,
+                                              streaming=streaming,
+                                              image_metadata_writer=image_metadata_writer,
+                                              embedding_cache_path=embedding_cache_path,
+                                              embedding_cache_max_bytes=embedding_cache_max_bytes,
+                                              embedding_cache_bucket=embedding_cache_bucket,
+                                              num_segments=num_segments,
+                                              analysis_width=analysis_width,
+                                              strategy=strategy,
+                                              scene_threshold=scene_threshold,
+                                              min_fps=min_fps,
+                                              max_fps=max_fps,
+                                              fetch_kept_frames=fetch_kept_frames,
+                                              pipelined=pipelined,
+                                              num_extraction_workers=num_extraction_workers,
+                                              num_hash_workers=num_hash_workers,
+                                              phash_index_dir=phash_index_dir,
+                                              phash_radius=phash_radius,
+                                              known_hash_index_path=known_hash_index_path,
+                                              embedding_format=embedding_format,
+                                              embedding_shards=embedding_shards,
+                                              frames_per_shard=frames_per_shard,
+                                              pack_frames=pack_frames,
+                                              max_tar_shard_bytes=max_tar_shard_bytes,
+                                              resume=resume),
+        num_download_workers=num_download_workers,
+        num_extract_workers=num_extract_workers,
+        num_upload_workers=num_upload_workers)
+
+    stop_event = threading.Event()
+    heartbeat_thread = threading.Thread(target=_send_heartbeats, args=(queue, owner, stop_event), daemon=True)
+    heartbeat_thread.start()
+
+    total_uploaded_image_count = 0
+    try:
+        for is_success, video_id, pipeline, error in scheduler.run(_leased_videos(queue, owner, poll_interval)):
+            if is_success:
+                total_uploaded_image_count += pipeline.get_uploaded_image_count()
+                if not queue.complete(video_id, owner):
+                    logger.error(f"Lost the lease of video {video_id} before it was done")
+            else:
+                state = queue.fail(video_id, owner, error=error)
+                logger.info(f"Video {video_id} failed, {'dead-lettered' if state == JobState.DEAD else 'will be retried'}")
+            logger.critical(f"[{owner}] Uploaded images count: {total_uploaded_image_count}, queue: {queue.counts()}")
+    finally:
+        stop_event.set()
+        heartbeat_thread.join()
+        image_metadata_writer.close()
+        encoder.close()
+        # hashes added since the last periodic sync
+        known_hash_index.sync_all()
+        # the last values are written before the queue the job gauges read is closed
+        for exporter in exporters:
+            exporter.close()
+        queue.close()
+
+    for stage_metrics in scheduler.get_metrics():
+        logger.info(f"[{owner}] Stage metrics: {stage_metrics}")
+    logger.info(f"[{owner}] Image metadata requests: {image_metadata_writer.get_stats()}, "
+                f"CLIP encoder batches: {encoder.get_stats()}")
+    if embedding_cache_path is not None:
+        logger.info(f"[{owner}] Embedding cache: {embedding_cache.get_cache(embedding_cache_path).get_stats()}")
+
+
+def run_video_processing_queue(videos: List[VideoMetaData],
+                               queue_path: str,
+                               num_workers: int = 1,
+                               **worker_kwargs) -> List[str]:
+    """
+    Enqueue `videos` into the durable job queue at `queue_path` and process the
+    queue with `num_workers` worker processes, each with its own encoder (see
+    `run_video_processing_worker`). Videos already in the queue are not enqueued
+    twice, so an interrupted run is resumed by running it again. Returns the ids
+    of the dead-lettered videos.
+    """
+    queue = JobQueue(queue_path,
+                     lease_seconds=worker_kwargs.get('lease_seconds', DEFAULT_LEASE_SECONDS),
+                     max_attempts=worker_kwargs.get('max_attempts', DEFAULT_MAX_ATTEMPTS))
+    num_new_videos = queue.add_many((video.video_id, video.serialize()) for video in videos)
+    logger.info(f"{num_new_videos} new videos enqueued, queue: {queue.counts()}")
+
+    # spawn: the workers load the model themselves (CUDA does not survive a fork)
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=run_video_processing_worker, args=(queue_path,),
+                                 kwargs=dict(worker_kwargs, worker_index=worker_index))
+                 for worker_index in range(num_workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    logger.info(f"Video processing done, queue: {queue.counts()}")
+    failed_video_info_list = [job['job_id'] for job in queue.get_dead_jobs()]
+    queue.close()
+
+    return failed_video_info_list
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Process the unprocessed ingress videos.")
+    parser.add_argument("--num_workers", type=int, default=1, help="Number of worker processes, each loading an encoder")
+    parser.add_argument("--queue_path", type=str, default=os.path.join('output', 'video_jobs.sqlite'), help="SQLite file of the job queue")
+    parser.add_argument("--lease_seconds", type=float, default=DEFAULT_LEASE_SECONDS, help="Seconds a video stays leased without a heartbeat")
+    parser.add_argument("--max_attempts", type=int, default=DEFAULT_MAX_ATTEMPTS, help="Attempts before a video is dead-lettered")
+    parser.add_argument("--retry_dead", action="store_true", help="Put the dead-lettered videos back in the queue")
+    parser.add_argument("--streaming", action="store_true", help="Process the frames in memory")
+    parser.add_argument("--num_download_workers", type=int, default=2, help="Videos downloaded at once, per worker")
+    parser.add_argument("--num_extract_workers", type=int, default=2, help="Videos extracted at once, per worker")
+    parser.add_argument("--num_upload_workers", type=int, default=4, help="Videos uploaded at once, per worker")
+    parser.add_argument("--strategy", type=str, default=ExtractionStrategy.ORB, choices=ExtractionStrategy.ALL, help="How candidate frames are selected")
+    parser.add_argument("--scene_threshold", type=float, default=DEFAULT_SCENE_THRESHOLD, help="Scene change score threshold of the scene strategy")
+    parser.add_argument("--min_fps", type=float, default=adaptive_sampler.DEFAULT_MIN_FPS, help="Lowest sampling rate of the adaptive strategy")
+    parser.add_argument("--max_fps", type=float, default=adaptive_sampler.DEFAULT_MAX_FPS, help="Highest sampling rate of the adaptive strategy")
+    parser.add_argument("--pipe_all_frames", action="store_true", help="Pipe every frame of the adaptive strategy at full resolution instead of fetching the kept ones")
+    parser.add_argument("--num_segments", type=int, default=1, help="Time ranges of a video decoded in parallel processes (disk mode, orb strategy)")
+    parser.add_argument("--analysis_width", type=int, default=None, help="Width of the downscaled stream the dedup runs on")
+    parser.add_argument("--pipelined", action="store_true", help="Run decoding, dedup and frame hashing in separate threads")
+    parser.add_argument("--num_extraction_workers", type=int, default=4, help="Threads saving/hashing frames in pipelined mode")
+    parser.add_argument("--num_hash_workers", type=int, default=0, help="Threads computing the SHA-256 and BLAKE2s digests of each frame in parallel, 0 for none")
+    parser.add_argument("--phash_index_dir", type=str, default=None, help="Directory of the per-game perceptual hash indexes of kept frames")
+    parser.add_argument("--phash_radius", type=int, default=phash_index.DEFAULT_RADIUS, help="Hamming distance within which a frame matches one of the perceptual hash index")
+    parser.add_argument("--known_hash_index_path", type=str, default=None, help="Index of the registered image hashes, skipped right after fingerprinting")
+    parser.add_argument("--embedding_format", type=str, default=EmbeddingFormat.BINARY, choices=EmbeddingFormat.ALL, help="Encoding of the uploaded CLIP vectors")
+    parser.add_argument("--embedding_shards", action="store_true", help="Upload the CLIP vectors of a video in a few shard objects")
+    parser.add_argument("--frames_per_shard", type=int, default=None, help="Frames per CLIP vector shard, one shard per video if not set")
+    parser.add_argument("--pack_frames", action="store_true", help="Pack frames, metadata and CLIP vectors into tar shards")
+    parser.add_argument("--max_tar_shard_mb", type=float, default=tar_shard.DEFAULT_MAX_SHARD_BYTES / 1024 ** 2, help="Size above which a new tar shard is started")
+    parser.add_argument("--no_resume", action="store_true", help="Register and upload all the frames of a failed video again on its retry")
+    parser.add_argument("--encoder_precision", type=str, default=EncoderPrecision.FP16, choices=EncoderPrecision.ALL, help="Precision of the CLIP image encoder, int8 for CPU workers")
+    parser.add_argument("--encoder_backend", type=str, default=BackendType.TORCH, choices=BackendType.ALL, help="Inference backend of the CLIP image encoder, onnx for ONNX Runtime on CPU")
+    parser.add_argument("--intra_op_num_threads", type=int, default=None, help="ONNX Runtime threads within an operator, per worker")
+    parser.add_argument("--inter_op_num_threads", type=int, default=None, help="ONNX Runtime threads across operators, per worker")
+    parser.add_argument("--embedding_cache_path", type=str, default=None, help="SQLite file of the CLIP vectors encoded before, shared by the workers")
+    parser.add_argument("--embedding_cache_max_gb", type=float, default=embedding_cache.DEFAULT_MAX_CACHE_BYTES / 1024 ** 3, help="Size above which the least recently used vectors are evicted")
+    parser.add_argument("--embedding_cache_bucket", type=str, default=None, help="Bucket of the shared read-only cache tier")
+    parser.add_argument("--metrics_port", type=int, default=None, help="Serve the Prometheus metrics of worker i on this port + i")
+    parser.add_argument("--metrics_dir", type=str, default=None, help="Write the Prometheus metrics of each worker into a .prom file of this directory")
+    parser.add_argument("--metrics_interval", type=float, default=metrics.DEFAULT_METRICS_INTERVAL, help="Seconds between two writes of the metrics files")
+
+    args = parser.parse_args()
+
+    # checked once here rather than failing every video in the workers
+    if args.num_segments > 1 and args.streaming:
+        parser.error("--num_segments is only supported in disk mode, not with --streaming")
+    try:
+        check_segmented_options(args.num_segments, args.strategy, args.analysis_width, args.pipelined)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.retry_dead:
+        queue = JobQueue(args.queue_path)
+        logger.info(f"{queue.retry_dead()} dead-lettered videos put back in the queue")
+        queue.close()
+
     # Get the hash list of unprocessed ingress video
-    videos = http_get_unprocessed_videos()
-    failed_video_list = run_video_processing(minio_client=minio_client, 
-                            image_encoder=encoder,
-                            videos=videos)
+    videos = http_get_unprocessed_videos() or []
+    failed_video_list = run_video_processing_queue(videos=videos,
+                                                   queue_path=args.queue_path,
+                                                   num_workers=args.num_workers,
+                                                   streaming=args.streaming,
+                                                   num_download_workers=args.num_download_workers,
+                                                   num_extract_workers=args.num_extract_workers,
+                                                   num_upload_workers=args.num_upload_workers,
+                                                   strategy=args.strategy,
+                                                   scene_threshold=args.scene_threshold,
+                                                   min_fps=args.min_fps,
+                                                   max_fps=args.max_fps,
+                                                   fetch_kept_frames=not args.pipe_all_frames,
+                                                   num_segments=args.num_segments,
+                                                   analysis_width=args.analysis_width,
+                                                   pipelined=args.pipelined,
+                                                   num_extraction_workers=args.num_extraction_workers,
+                                                   num_hash_workers=args.num_hash_workers,
+                                                   phash_index_dir=args.phash_index_dir,
+                                                   phash_radius=args.phash_radius,
+                                                   known_hash_index_path=args.known_hash_index_path,
+                                                   embedding_format=args.embedding_format,
+                                                   embedding_shards=args.embedding_shards,
+                                                   frames_per_shard=args.frames_per_shard,
+                                                   pack_frames=args.pack_frames,
+                                                   max_tar_shard_bytes=int(args.max_tar_shard_mb * 1024 ** 2),
+                                                   resume=not args.no_resume,
+                                                   lease_seconds=args.lease_seconds,
+                                                   max_attempts=args.max_attempts,
+                                                   encoder_precision=args.encoder_precision,
+                                                   encoder_backend=args.encoder_backend,
+                                                   intra_op_num_threads=args.intra_op_num_threads,
+                                                   inter_op_num_threads=args.inter_op_num_threads,
+                                                   embedding_cache_path=args.embedding_cache_path,
+                                                   embedding_cache_max_bytes=int(args.embedding_cache_max_gb * 1024 ** 3),
+                                                   embedding_cache_bucket=args.embedding_cache_bucket,
+                                                   metrics_port=args.metrics_port,
+                                                   metrics_dir=args.metrics_dir,
+                                                   metrics_interval=args.metrics_interval)
 
     # Save list of failed URLs in pipeline in json format
     with open(file='failed_list.json', mode='w') as f:
-        json.dump(obj=failed_video_list, fp=f, indent=4)
\ No newline at end of file
+        json.dump(obj=failed_video_list, fp=f, indent=4)
@@ -0,0 +1,278 @@
+import os
+import time
+import sqlite3
+import argparse
+import threading
+from io import BytesIO
+from typing import Optional
+
+import numpy as np
+
+import sys
+base_dir = './'
+sys.path.insert(0, base_dir)
+
+from utility.clip.embedding_format import encode_embedding, decode_embedding
+from utility import logger
+
+DEFAULT_MAX_CACHE_BYTES = 8 * 1024 ** 3
+# eviction goes down to this fraction of max_bytes, so that it runs once per many inserts
+_EVICTION_TARGET = 0.9
+_EVICTION_BATCH_SIZE = 1024
+DEFAULT_SHARED_PREFIX = 'embedding-cache'
+
+
+def get_shared_object_name(prefix: str, model_id: str, image_hash: str) -> str:
+    return f"{prefix}/{model_id}/{image_hash}.bin"
+
+
+class EmbeddingCache():
+    """
+    Persistent cache of CLIP vectors keyed by (model id, image hash), so that a
+    frame seen before (in another video, a retry or a rerun with other dedup
+    settings) is not encoded again.
+
+    Vectors are stored in the binary embedding format in a SQLite file, shared by
+    the processes of one machine, and evicted least recently used first once the
+    cache holds more than `max_bytes`. On a local miss, the optional shared tier
+    (`<shared_prefix>/<model id>/<image hash>.bin` objects of `shared_bucket`,
+    filled by `publish`) is read, never written, and its hits are kept locally.
+
+    Open one `EmbeddingCache` per process (see `get_cache`); an instance is safe to
+    share between the threads of that process.
+    """
+
+    def __init__(self,
+                 path: str,
+                 max_bytes: int = DEFAULT_MAX_CACHE_BYTES,
+                 minio_client=None,
+                 shared_bucket: str = None,
+                 shared_prefix: str = DEFAULT_SHARED_PREFIX):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.minio_client = minio_client
+        self.shared_bucket = shared_bucket
+        self.shared_prefix = shared_prefix
+
+        # updated under `_lock`, as the threads of the process share the instance
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # autocommit mode, transactions are opened explicitly
+        self._connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('''
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model_id TEXT NOT NULL,
+                    image_hash TEXT NOT NULL,
+                    data BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (model_id, image_hash)
+                )''')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)')
+            # running total of the sizes, kept in the same transactions as the rows
+            self._connection.execute('CREATE TABLE IF NOT EXISTS cache_size (id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER NOT NULL)')
+            self._connection.execute('INSERT OR IGNORE INTO cache_size (id, size) '
+                                     'SELECT 0, COALESCE(SUM(size), 0) FROM embeddings')
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _transaction(self, statements):
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                result = statements(self._connection)
+                self._connection.execute('COMMIT')
+                return result
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+
+    def _get_local(self, model_id, image_hash):
+        def get(connection):
+            row = connection.execute('SELECT data FROM embeddings WHERE model_id = ? AND image_hash = ?',
+                                     (model_id, image_hash)).fetchone()
+            if row is not None:
+                connection.execute('UPDATE embeddings SET last_used = ? WHERE model_id = ? AND image_hash = ?',
+                                   (time.time(), model_id, image_hash))
+                self.hits += 1
+            return row
+
+        row = self._transaction(get)
+        return None if row is None else row[0]
+
+    def _get_shared(self, model_id, image_hash):
+        if self.minio_client is None or self.shared_bucket is None:
+            return None
+
+        object_name = get_shared_object_name(self.shared_prefix, model_id, image_hash)
+        response = None
+        try:
+            response = self.minio_client.get_object(self.shared_bucket, object_name)
+            return response.read()
+        except Exception as e:
+            # missing objects are misses, the other errors too, the frame is only encoded again
+            if getattr(e, 'code', None) != 'NoSuchKey':
+                logger.error(f"Embedding cache: reading {self.shared_bucket}/{object_name} failed: {e}")
+            return None
+        finally:
+            if response is not None:
+                response.close()
+                response.release_conn()
+
+    def get(self, model_id: str, image_hash: str) -> Optional[np.ndarray]:
+        """
+        Cached vector of the image, or None if it was not encoded by `model_id` yet.
+        """
+        # local hits are counted by the lookup transaction
+        data = self._get_local(model_id, image_hash)
+        if data is not None:
+            return decode_embedding(data)
+
+        data = self._get_shared(model_id, image_hash)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.shared_hits += 1
+        if data is None:
+            return None
+
+        self._put_data(model_id, image_hash, data)
+        return decode_embedding(data)
+
+    def put(self, model_id: str, image_hash: str, vector) -> None:
+        self._put_data(model_id, image_hash, encode_embedding(vector))
+
+    def _put_data(self, model_id, image_hash, data):
+        def put(connection):
+            row = connection.execute('SELECT size FROM embeddings WHERE model_id = ? AND image_hash = ?',
+                                     (model_id, image_hash)).fetchone()
+            connection.execute('INSERT OR REPLACE INTO embeddings (model_id, image_hash, data, size, last_used) '
+                               'VALUES (?, ?, ?, ?, ?)',
+                               (model_id, image_hash, data, len(data), time.time()))
+            size_change = len(data) - (row[0] if row is not None else 0)
+            connection.execute('UPDATE cache_size SET size = size + ? WHERE id = 0', (size_change,))
+
+            return connection.execute('SELECT size FROM cache_size WHERE id = 0').fetchone()[0]
+
+        if self._transaction(put) > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        target = int(self.max_bytes * _EVICTION_TARGET)
+
+        def evict(connection):
+            evicted = 0
+            size = connection.execute('SELECT size FROM cache_size WHERE id = 0').fetchone()[0]
+            while size > target:
+                rows = connection.execute('SELECT rowid, size FROM embeddings ORDER BY last_used LIMIT ?',
+                                          (_EVICTION_BATCH_SIZE,)).fetchall()
+                if not rows:
+                    break
+                # the least recently used rows, just enough of them
+                sizes = np.cumsum([row_size for _, row_size in rows])
+                count = min(int(np.searchsorted(sizes, size - target)) + 1, len(rows))
+                connection.executemany('DELETE FROM embeddings WHERE rowid = ?', [(rowid,) for rowid, _ in rows[:count]])
+                size -= int(sizes[count - 1])
+                evicted += count
+            connection.execute('UPDATE cache_size SET size = ? WHERE id = 0', (size,))
+            self.evictions += evicted
+            return evicted
+
+        evicted = self._transaction(evict)
+        logger.debug(msg=f"Embedding cache: evicted {evicted} vectors")
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+
+    def get_size(self) -> int:
+        with self._lock:
+            return self._connection.execute('SELECT size FROM cache_size WHERE id = 0').fetchone()[0]
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            hits, shared_hits, misses, evictions = self.hits, self.shared_hits, self.misses, self.evictions
+        lookups = hits + shared_hits + misses
+        return {
+            'hits': hits,
+            'shared_hits': shared_hits,
+            'misses': misses,
+            'hit_rate': (hits + shared_hits) / lookups if lookups else 0.,
+            'evictions': evictions,
+            'num_vectors': len(self),
+            'size_bytes': self.get_size(),
+        }
+
+    def publish(self, minio_client, bucket: str, model_id: str, prefix: str = DEFAULT_SHARED_PREFIX) -> int:
+        """
+        Upload the vectors of `model_id` to the shared tier read by the other
+        machines. Returns the number of vectors uploaded.
+        """
+        with self._lock:
+            rows = self._connection.execute('SELECT image_hash, data FROM embeddings WHERE model_id = ?',
+                                            (model_id,)).fetchall()
+        for image_hash, data in rows:
+            minio_client.put_object(bucket, get_shared_object_name(prefix, model_id, image_hash), BytesIO(data), length=len(data))
+
+        return len(rows)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(path: str, **kwargs) -> EmbeddingCache:
+    """
+    Return the cache stored at `path`, opened once per process so that the
+    pipelines running in threads share the same instance. `kwargs` (see
+    `EmbeddingCache`) apply when it is first opened.
+    """
+    path = os.path.abspath(path)
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = EmbeddingCache(path, **kwargs)
+            logger.debug(msg=f"Opened embedding cache with {len(_caches[path])} vectors: {path}")
+        return _caches[path]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect embedding caches and publish them to the shared tier.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    stats_parser = subparsers.add_parser("stats", help="Number of vectors and size of a cache, per model")
+    stats_parser.add_argument("--cache_path", type=str, required=True, help="Path of the cache file")
+
+    publish_parser = subparsers.add_parser("publish", help="Upload the vectors of a model to the shared tier in MinIO")
+    publish_parser.add_argument("--cache_path", type=str, required=True, help="Path of the cache file")
+    publish_parser.add_argument("--model_id", type=str, required=True, help="Model id of the vectors")
+    publish_parser.add_argument("--bucket", type=str, required=True, help="Bucket of the shared tier")
+    publish_parser.add_argument("--prefix", type=str, default=DEFAULT_SHARED_PREFIX, help="Prefix of the shared tier")
+
+    args = parser.parse_args()
+
+    cache = EmbeddingCache(args.cache_path)
+    if args.command == "stats":
+        rows = cache._connection.execute('SELECT model_id, COUNT(*), SUM(size) FROM embeddings GROUP BY model_id').fetchall()
+        for model_id, count, size in rows:
+            print(f"{model_id}: {count} vectors, {size / 1024 ** 2:.1f} MB")
+        print(f"total: {len(cache)} vectors, {cache.get_size() / 1024 ** 2:.1f} MB")
+    elif args.command == "publish":
+        from config import MINIO_ACCESS_KEY, MINIO_ADDRESS, MINIO_SECRET_KEY
+        from utility.minio import cmd
+
+        minio_client = cmd.get_minio_client(minio_access_key=MINIO_ACCESS_KEY,
+                                            minio_secret_key=MINIO_SECRET_KEY,
+                                            minio_ip_addr=MINIO_ADDRESS)
+        count = cache.publish(minio_client, args.bucket, args.model_id, args.prefix)
+        print(f"{count} vectors of {args.model_id} published to {args.bucket}/{args.prefix}/{args.model_id}")
+    cache.close()
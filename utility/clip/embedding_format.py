@@ -0,0 +1,133 @@
+import struct
+
+import msgpack
+import numpy as np
+
+# on-disk format: magic, version, dtype code, number of dimensions, then the
+# shape (uint32 each) and the little-endian values, starting on a 16-byte boundary
+EMBEDDING_MAGIC = b'KEMB'
+EMBEDDING_VERSION = 1
+EMBEDDING_HEADER = struct.Struct('<4sHBB')
+EMBEDDING_ALIGNMENT = 16
+
+_DTYPES = {
+    1: np.dtype('<f2'),
+    2: np.dtype('<f4'),
+}
+_DTYPE_CODES = {dtype: code for code, dtype in _DTYPES.items()}
+
+LEGACY_KEY = "clip-feature-vector"
+
+
+class EmbeddingFormat:
+    # {"clip-feature-vector": [[float, ...]]} packed with msgpack
+    MSGPACK = 'msgpack'
+    # EMBEDDING_MAGIC header followed by the raw values, see encode_embedding
+    BINARY = 'binary'
+
+    ALL = (MSGPACK, BINARY)
+
+    # suffix of the object stored next to each frame
+    SUFFIXES = {
+        MSGPACK: '_clip_kandinsky.msgpack',
+        BINARY: '_clip_kandinsky.bin',
+    }
+
+
+def embedding_data_offset(ndim: int) -> int:
+    """
+    Byte offset of the values in a binary embedding of `ndim` dimensions.
+    """
+    header_size = EMBEDDING_HEADER.size + 4 * ndim
+    return -(-header_size // EMBEDDING_ALIGNMENT) * EMBEDDING_ALIGNMENT
+
+
+def as_numpy(array) -> np.ndarray:
+    """
+    Return a numpy array from a numpy array or a tensor with `.cpu().numpy()`.
+    """
+    if hasattr(array, 'cpu'):
+        array = array.cpu().numpy()
+    return np.asarray(array)
+
+
+def encode_embedding(array) -> bytes:
+    """
+    Encode a float16 or float32 array (numpy, or a tensor with `.cpu().numpy()`)
+    in the binary format.
+    """
+    array = as_numpy(array)
+
+    dtype = array.dtype.newbyteorder('<')
+    if dtype not in _DTYPE_CODES:
+        raise ValueError(f"Unsupported embedding dtype {array.dtype}, expected float16 or float32")
+
+    header = EMBEDDING_HEADER.pack(EMBEDDING_MAGIC, EMBEDDING_VERSION, _DTYPE_CODES[dtype], array.ndim)
+    header += struct.pack(f'<{array.ndim}I', *array.shape)
+    header = header.ljust(embedding_data_offset(array.ndim), b'\0')
+
+    return header + np.ascontiguousarray(array, dtype=dtype).tobytes()
+
+
+def encode_legacy_embedding(array) -> bytes:
+    """
+    Encode an array in the msgpack layout written before the binary format.
+    """
+    return msgpack.packb({LEGACY_KEY: as_numpy(array).tolist()})
+
+
+def is_binary_embedding(data) -> bool:
+    return bytes(data[:len(EMBEDDING_MAGIC)]) == EMBEDDING_MAGIC
+
+
+def decode_embedding(data) -> np.ndarray:
+    """
+    Decode an embedding in either format. Binary embeddings are returned as a
+    read-only view over `data` (no copy); legacy msgpack ones as a float32 array.
+    """
+    if not is_binary_embedding(data):
+        return np.array(msgpack.unpackb(data)[LEGACY_KEY], dtype=np.float32)
+
+    dtype, shape, offset = decode_embedding_header(data)
+    count = int(np.prod(shape))
+
+    return np.frombuffer(data, dtype=dtype, count=count, offset=offset).reshape(shape)
+
+
+def decode_embedding_header(data):
+    """
+    Return (dtype, shape, data offset) of a binary embedding. `data` only needs to
+    hold the header, see `embedding_data_offset`.
+    """
+    if not is_binary_embedding(data):
+        raise ValueError("Not a binary embedding")
+
+    _, version, dtype_code, ndim = EMBEDDING_HEADER.unpack_from(data)
+    if version != EMBEDDING_VERSION:
+        raise ValueError(f"Unsupported embedding version {version}")
+    if dtype_code not in _DTYPES:
+        raise ValueError(f"Unknown embedding dtype code {dtype_code}")
+
+    shape = struct.unpack_from(f'<{ndim}I', data, EMBEDDING_HEADER.size)
+
+    return _DTYPES[dtype_code], shape, embedding_data_offset(ndim)
+
+
+def read_embedding(path: str, mmap: bool = False) -> np.ndarray:
+    """
+    Read an embedding file. With `mmap`, a binary embedding is memory-mapped
+    read-only instead of read into memory.
+    """
+    with open(path, 'rb') as f:
+        if not mmap:
+            return decode_embedding(f.read())
+
+        header = f.read(EMBEDDING_HEADER.size)
+        if not is_binary_embedding(header):
+            f.seek(0)
+            return decode_embedding(f.read())
+        _, _, _, ndim = EMBEDDING_HEADER.unpack(header)
+        header += f.read(embedding_data_offset(ndim) - len(header))
+
+    dtype, shape, offset = decode_embedding_header(header)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
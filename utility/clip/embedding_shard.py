@@ -0,0 +1,189 @@
+import json
+import os
+import threading
+from typing import Callable, Optional
+
+import numpy as np
+
+import sys
+base_dir = './'
+sys.path.insert(0, base_dir)
+
+from utility.clip.embedding_format import as_numpy, decode_embedding, encode_embedding, \
+    embedding_data_offset, read_embedding
+
+# version of the shard index layout
+SHARD_INDEX_VERSION = 1
+
+SHARD_SUFFIX = '_clip_kandinsky.bin'
+SHARD_INDEX_SUFFIX = '_clip_kandinsky_index.json'
+
+
+def get_shard_object_name(prefix: str, shard: int) -> str:
+    return f"{prefix}_{shard:04d}{SHARD_SUFFIX}"
+
+
+def get_shard_index_object_name(prefix: str) -> str:
+    return f"{prefix}{SHARD_INDEX_SUFFIX}"
+
+
+class EmbeddingShardWriter():
+    """
+    Collects the CLIP vectors of a video into (num_frames, dim) matrices stored as
+    binary embeddings (see `utility.clip.embedding_format`), one object per
+    `frames_per_shard` frames or per video if None, instead of one object per frame.
+
+    `close` writes the index `{prefix}_clip_kandinsky_index.json`, mapping each
+    frame (object path and image hash) to its shard and row, along with the byte
+    offset and size of the rows so that a single row can be fetched with a range
+    request, see `EmbeddingShardReader`.
+
+    `upload(object_name, data)` stores an object; `add` can be called from several
+    threads, rows are stored in the order they are added.
+    """
+
+    def __init__(self,
+                 upload: Callable[[str, bytes], None],
+                 prefix: str,
+                 frames_per_shard: Optional[int] = None):
+        self.upload = upload
+        self.prefix = prefix
+        self.frames_per_shard = frames_per_shard
+
+        self.shards = []
+        self.frames = []
+        self.dtype = None
+        self.dim = None
+
+        self._rows = []
+        self._lock = threading.Lock()
+
+    def add(self, file_path: str, image_hash: str, vector, frame_num: int = None) -> None:
+        row = as_numpy(vector).reshape(-1)
+
+        with self._lock:
+            if self.dim is None:
+                self.dtype, self.dim = row.dtype, row.shape[0]
+            elif row.shape[0] != self.dim:
+                raise ValueError(f"Embedding of {file_path} has {row.shape[0]} dimensions, expected {self.dim}")
+
+            self.frames.append({
+                'file_path': file_path,
+                'image_hash': image_hash,
+                'frame_num': frame_num,
+                'shard': len(self.shards),
+                'row': len(self._rows),
+            })
+            self._rows.append(row)
+
+            if self.frames_per_shard is None or len(self._rows) < self.frames_per_shard:
+                return
+            shard = self._take_shard()
+
+        self._upload_shard(*shard)
+
+    def _take_shard(self):
+        rows, self._rows = self._rows, []
+        object_name = get_shard_object_name(self.prefix, len(self.shards))
+        self.shards.append({
+            'object_name': object_name,
+            'num_rows': len(rows),
+            'data_offset': embedding_data_offset(2),
+            'row_size': self.dim * self.dtype.itemsize,
+        })
+        return object_name, rows
+
+    def _upload_shard(self, object_name, rows):
+        self.upload(object_name, encode_embedding(np.stack(rows).astype(self.dtype, copy=False)))
+
+    def get_index(self) -> dict:
+        return {
+            'version': SHARD_INDEX_VERSION,
+            'dtype': None if self.dtype is None else self.dtype.str,
+            'dim': self.dim,
+            'shards': self.shards,
+            'frames': self.frames,
+        }
+
+    def close(self) -> dict:
+        """
+        Upload the last shard and the index, and return the index.
+        Call it once all the frames are added.
+        """
+        with self._lock:
+            shard = self._take_shard() if self._rows else None
+        if shard is not None:
+            self._upload_shard(*shard)
+
+        index = self.get_index()
+        self.upload(get_shard_index_object_name(self.prefix), json.dumps(index).encode())
+
+        return index
+
+
+class EmbeddingShardReader():
+    """
+    Reads the embeddings written by `EmbeddingShardWriter` from MinIO, given the
+    object name of the index.
+
+    `get_embedding` fetches a single row with a byte-range request. `load_shard`
+    downloads a whole shard into `cache_dir` and memory-maps it (or keeps it in
+    memory without `cache_dir`).
+    """
+
+    def __init__(self, minio_client, bucket_name: str, index_object_name: str, cache_dir: str = None):
+        self.minio_client = minio_client
+        self.bucket_name = bucket_name
+        self.cache_dir = cache_dir
+
+        self.index = json.loads(self._get_object(index_object_name))
+        if self.index['version'] != SHARD_INDEX_VERSION:
+            raise ValueError(f"Unsupported shard index version {self.index['version']}")
+
+        self.dtype = np.dtype(self.index['dtype']) if self.index['dtype'] else None
+        self.frames = self.index['frames']
+        self._frames_by_key = {}
+        for frame in self.frames:
+            self._frames_by_key[frame['file_path']] = frame
+            self._frames_by_key[frame['image_hash']] = frame
+
+    def _get_object(self, object_name, offset=0, length=0) -> bytes:
+        response = self.minio_client.get_object(self.bucket_name, object_name, offset=offset, length=length)
+        try:
+            return response.read()
+        finally:
+            response.close()
+            response.release_conn()
+
+    def get_frame(self, key: str) -> dict:
+        """
+        Index entry of a frame by object path (without the bucket) or image hash.
+        """
+        return self._frames_by_key[key]
+
+    def get_embedding(self, key: str) -> np.ndarray:
+        """
+        Embedding (dim,) of a frame by object path or image hash, fetched with a
+        byte-range request of a single row.
+        """
+        frame = self.get_frame(key)
+        shard = self.index['shards'][frame['shard']]
+        offset = shard['data_offset'] + frame['row'] * shard['row_size']
+
+        data = self._get_object(shard['object_name'], offset=offset, length=shard['row_size'])
+        return np.frombuffer(data, dtype=self.dtype)
+
+    def load_shard(self, shard: int) -> np.ndarray:
+        """
+        Embeddings (num_rows, dim) of a shard, memory-mapped from `cache_dir`.
+        """
+        object_name = self.index['shards'][shard]['object_name']
+        if self.cache_dir is None:
+            return decode_embedding(self._get_object(object_name))
+
+        path = os.path.join(self.cache_dir, object_name)
+        if not os.path.isfile(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.minio_client.fget_object(self.bucket_name, object_name, path)
+
+        return read_embedding(path, mmap=True)
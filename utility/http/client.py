@@ -0,0 +1,143 @@
+import time
+import threading
+from typing import Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import sys
+base_dir = './'
+sys.path.insert(0, base_dir)
+
+from utility.utils import metrics
+
+# connections kept alive per host; should cover the threads posting at once
+# (upload threads x pipelines)
+DEFAULT_POOL_SIZE = 64
+# (connect, read) seconds
+DEFAULT_TIMEOUT = (5, 60)
+
+# labelled by the URL path without the query, which holds the ids
+HTTP_REQUEST_SECONDS = metrics.histogram('http_request_seconds', 'Latency of the orchestration API requests', ['method', 'path'])
+HTTP_RESPONSES = metrics.counter('http_responses_total', 'Responses of the orchestration API, by status code or error', ['method', 'path', 'status'])
+
+
+class HttpClient():
+    """
+    `requests` session with a keep-alive connection pool of `pool_size`
+    connections per host, and a default timeout on every call. Safe to share
+    between threads: connections are reused instead of opening a TCP connection
+    per request. Requests are timed into the `http_request_seconds` metric.
+    """
+
+    def __init__(self, pool_size: int = DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT):
+        self.pool_size = pool_size
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        # pool_block: threads wait for a free connection rather than opening
+        # connections that are discarded right after the call
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        path = urlsplit(url).path
+        status = 'error'
+        start_time = time.perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            HTTP_REQUEST_SECONDS.labels(method=method, path=path).observe(time.perf_counter() - start_time)
+            HTTP_RESPONSES.labels(method=method, path=path, status=status).inc()
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url: str, **kwargs) -> requests.Response:
+        return self.request('PUT', url, **kwargs)
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class AsyncHttpClient():
+    """
+    asyncio variant of `HttpClient` on an `aiohttp` session (optional dependency).
+    Responses are read completely and returned as (status, json or None, text).
+    Create and use it from a running event loop.
+    """
+
+    def __init__(self, pool_size: int = DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT):
+        try:
+            import aiohttp
+        except ImportError as e:
+            raise ImportError("AsyncHttpClient requires aiohttp: pip install aiohttp") from e
+
+        connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=pool_size),
+            timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout))
+
+    async def request(self, method: str, url: str, **kwargs):
+        async with self.session.request(method, url, **kwargs) as response:
+            text = await response.text()
+            try:
+                data = await response.json(content_type=None)
+            except ValueError:
+                data = None
+            return response.status, data, text
+
+    async def get(self, url: str, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url: str, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def put(self, url: str, **kwargs):
+        return await self.request('PUT', url, **kwargs)
+
+    async def close(self) -> None:
+        await self.session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
+_client: Optional[HttpClient] = None
+_client_lock = threading.Lock()
+
+
+def configure_client(pool_size: int = DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT) -> HttpClient:
+    """
+    Replace the shared client used by `utility.http.request` with one using
+    `pool_size` connections per host and `timeout`. Call it before starting the
+    pipelines, as the previous client is closed.
+    """
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = HttpClient(pool_size=pool_size, timeout=timeout)
+        return _client
+
+
+def get_client() -> HttpClient:
+    """
+    Return the process-wide shared client, created with the defaults on first use.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient()
+        return _client
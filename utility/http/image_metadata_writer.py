@@ -0,0 +1,259 @@
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, wait
+from typing import Optional, Dict
+
+import sys
+base_dir = './'
+sys.path.insert(0, base_dir)
+
+from utility.http import request
+from utility.utils import metrics
+from utility import logger
+
+# statuses for which a batch is split in halves and retried: payload too large,
+# and validation errors, so that a single invalid record does not fail its batch
+SPLIT_STATUS_CODES = (400, 413, 422)
+
+PENDING_RECORDS = metrics.gauge('image_metadata_pending_records', 'Frame metadata records buffered by the writers, not sent yet')
+BATCH_SIZE = metrics.histogram('image_metadata_batch_size', 'Records per image list request, after splits',
+                               buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+RECORDS = metrics.counter('image_metadata_records_total', 'Frame metadata records sent, by result', ['result'])
+
+
+class _PendingRecord():
+
+    def __init__(self, record: dict):
+        self.record = record
+        self.size = len(json.dumps(record))
+        self.future = Future()
+
+
+class ImageMetadataWriter():
+    """
+    Write-behind buffer registering frame metadata through the image list endpoint
+    (`request.http_add_image_list_with_status`) instead of one request per frame.
+
+    `submit` queues a record and returns a future resolving to the record returned
+    by the server (the same dict `http_add_image` returns), or None if it was
+    rejected. A background thread flushes the buffer when it holds
+    `max_batch_size` records or `max_batch_bytes` of JSON, or `max_wait` seconds
+    after its oldest record.
+
+    Returned records are matched to the submitted ones by position, or by
+    `image_hash` when the server returns fewer records than it was sent; a
+    submitted record without a returned one resolves to None, like a duplicate
+    refused by `http_add_image`. A frame submitted again in the same batch is only
+    sent once, its later submissions resolve to None. When a 422 lists the
+    records it rejects (`detail[].loc` = `["body", <index>, ...]`), these resolve
+    to None and the others are sent again in one request. Otherwise a batch
+    rejected with one of `SPLIT_STATUS_CODES` is split in halves until the halves
+    are accepted or down to single records.
+
+    Safe to share between pipelines running in threads.
+    """
+
+    def __init__(self,
+                 max_batch_size: int = 256,
+                 max_batch_bytes: int = 1 << 20,
+                 max_wait: float = 0.5):
+        self.max_batch_size = max_batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.max_wait = max_wait
+
+        self.num_requests = 0
+        self.num_records = 0
+        self.num_splits = 0
+
+        self._pending = deque()
+        self._pending_bytes = 0
+        self._oldest_time = None
+        self._flush_requested = False
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, record: dict) -> Future:
+        pending = _PendingRecord(record)
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("ImageMetadataWriter is closed")
+            if not self._pending:
+                self._oldest_time = time.monotonic()
+            self._pending.append(pending)
+            self._pending_bytes += pending.size
+            PENDING_RECORDS.inc()
+            self._condition.notify()
+        return pending.future
+
+    def add_image(self, record: dict) -> Optional[Dict]:
+        """
+        Blocking drop-in for `request.http_add_image`.
+        """
+        return self.submit(record).result()
+
+    def flush(self) -> None:
+        """
+        Send the buffered records now and wait until they are registered.
+        """
+        with self._condition:
+            futures = [pending.future for pending in self._pending]
+            self._flush_requested = True
+            self._condition.notify()
+        wait(futures)
+
+    def close(self) -> None:
+        """
+        Flush the buffered records and stop the background thread.
+        """
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _is_full(self):
+        return len(self._pending) >= self.max_batch_size or self._pending_bytes >= self.max_batch_bytes
+
+    def _take_batch(self):
+        batch, batch_bytes = [], 0
+        while self._pending and len(batch) < self.max_batch_size:
+            size = self._pending[0].size
+            if batch and batch_bytes + size > self.max_batch_bytes:
+                break
+            batch.append(self._pending.popleft())
+            batch_bytes += size
+
+        self._pending_bytes -= batch_bytes
+        PENDING_RECORDS.dec(len(batch))
+        self._oldest_time = time.monotonic() if self._pending else None
+        if not self._pending:
+            self._flush_requested = False
+
+        return batch
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+
+                while not (self._closed or self._flush_requested or self._is_full()):
+                    timeout = self._oldest_time + self.max_wait - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self._condition.wait(timeout)
+
+                batch = self._take_batch()
+
+            self._send(batch)
+
+    @staticmethod
+    def _take_duplicates(batch):
+        sent, duplicates, image_hashes = [], [], set()
+        for pending in batch:
+            image_hash = pending.record.get('image_hash')
+            if image_hash in image_hashes:
+                duplicates.append(pending)
+            else:
+                image_hashes.add(image_hash)
+                sent.append(pending)
+        return sent, duplicates
+
+    @staticmethod
+    def _match_results(batch, result):
+        image_hashes = [pending.record.get('image_hash') for pending in batch]
+        if len(result) == len(batch) and all(record.get('image_hash') == image_hash
+                                             for record, image_hash in zip(result, image_hashes)):
+            return list(result)
+
+        returned = {record.get('image_hash'): record for record in result}
+        return [returned.get(image_hash) for image_hash in image_hashes]
+
+    @staticmethod
+    def _get_rejected_indexes(body, batch_size):
+        # FastAPI validation errors locate each error in the body, e.g. ["body", 3, "image_hash"]
+        if not isinstance(body, dict) or not isinstance(body.get('detail'), list):
+            return set()
+
+        rejected = set()
+        for error in body['detail']:
+            loc = error.get('loc') if isinstance(error, dict) else None
+            if not isinstance(loc, (list, tuple)) or len(loc) < 2 or loc[0] != 'body':
+                return set()
+            if not isinstance(loc[1], int) or not 0 <= loc[1] < batch_size:
+                return set()
+            rejected.add(loc[1])
+        return rejected
+
+    def _send(self, batch):
+        batch, duplicates = self._take_duplicates(batch)
+        if duplicates:
+            logger.debug(msg=f"{len(duplicates)} image metadata records submitted twice in a batch")
+            RECORDS.labels(result='duplicate').inc(len(duplicates))
+            for pending in duplicates:
+                pending.future.set_result(None)
+
+        try:
+            status_code, result = request.http_add_image_list_with_status([pending.record for pending in batch])
+        except Exception as e:
+            status_code, result = None, None
+            logger.error(msg=f"Adding image metadata list failed: {e}")
+
+        self.num_requests += 1
+        BATCH_SIZE.observe(len(batch))
+
+        if status_code == 200 and result is not None:
+            records = self._match_results(batch, result)
+            num_registered = sum(record is not None for record in records)
+            for pending, record in zip(batch, records):
+                pending.future.set_result(record)
+            self.num_records += num_registered
+            RECORDS.labels(result='registered').inc(num_registered)
+            if num_registered < len(batch):
+                RECORDS.labels(result='duplicate').inc(len(batch) - num_registered)
+            return
+
+        rejected = self._get_rejected_indexes(result, len(batch)) if status_code == 422 and len(batch) > 1 else set()
+        if rejected:
+            logger.debug(msg=f"{len(rejected)} of {len(batch)} image metadata records rejected with status 422")
+            RECORDS.labels(result='rejected').inc(len(rejected))
+            for index in rejected:
+                batch[index].future.set_result(None)
+            accepted = [pending for index, pending in enumerate(batch) if index not in rejected]
+            if accepted:
+                self._send(accepted)
+            return
+
+        if status_code in SPLIT_STATUS_CODES and len(batch) > 1:
+            self.num_splits += 1
+            middle = len(batch) // 2
+            self._send(batch[:middle])
+            self._send(batch[middle:])
+            return
+
+        # 422 on a single record is the server refusing a duplicate image, as with http_add_image
+        log = logger.debug if status_code == 422 else logger.error
+        log(msg=f"Adding image metadata list of {len(batch)} images failed with status {status_code}")
+        RECORDS.labels(result='rejected' if status_code == 422 else 'failed').inc(len(batch))
+        for pending in batch:
+            pending.future.set_result(None)
+
+    def get_stats(self) -> dict:
+        return {
+            'num_requests': self.num_requests,
+            'num_records': self.num_records,
+            'num_splits': self.num_splits,
+        }
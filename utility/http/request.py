@@ -1,6 +1,5 @@
-import requests
 
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Tuple, Union
 import json
 
 import time
@@ -14,6 +13,7 @@ sys.path.insert(0, base_dir)
 from schema import VideoMetaData
 # Import logger
 from utility import logger
+from utility.http.client import get_client
 
 # from config import ORCHESTRATION_ADDRESS as SERVER_ADDRESS
 MAX_RETRY = 6
@@ -45,7 +45,7 @@ def http_add_video(video_metadata) -> Optional[VideoMetaData]:
         url = f'{SERVER_ADDRESS}/ingress-videos/add-ingress-video'
         headers = {'Content-Type': 'application/json'}
 
-        response = requests.post(url=url, json=video_metadata, headers=headers)
+        response = get_client().post(url=url, json=video_metadata, headers=headers)
 
         video_metadata = None
         if response.status_code == 200:
@@ -68,7 +68,7 @@ def http_add_image_list(image_data_list) -> Optional[List[Dict]]:
         url = f'{SERVER_ADDRESS}/external-images/add-external-image-list'
         headers = {'Content-Type': 'application/json'}
 
-        response = requests.post(url, json=image_data_list, headers=headers)
+        response = get_client().post(url, json=image_data_list, headers=headers)
         result = None
         if response.status_code == 200:
             result = response.json()['response']['data']
@@ -81,12 +81,46 @@ def http_add_image_list(image_data_list) -> Optional[List[Dict]]:
     
     return http_wrapper(http_request=add_image_list, image_data_list=image_data_list)
 
+def http_add_image_list_with_status(image_data_list) -> Tuple[Optional[int], Optional[Union[List[Dict], Dict]]]:
+    """
+    Same as `http_add_image_list`, but also returns the status code of the
+    response (None if the server could not be reached), so that callers can tell
+    a rejected payload from a connection failure. For other statuses than 200 the
+    result is the decoded error body (None if it is not JSON), which may tell the
+    rejected records apart.
+    """
+    def add_image_list(image_data_list) -> Tuple[int, Optional[List[Dict]]]:
+        url = f'{SERVER_ADDRESS}/external-images/add-external-image-list'
+        headers = {'Content-Type': 'application/json'}
+
+        response = get_client().post(url, json=image_data_list, headers=headers)
+        status_code = response.status_code
+        result = None
+        if status_code == 200:
+            result = response.json()['response']['data']
+        else:
+            try:
+                result = response.json()
+            except ValueError:
+                result = None
+            logger.debug(msg="Adding image metadata list of {} images failed ({}) -> {}".format(
+                len(image_data_list), status_code, response.text[:200]))
+        if response:
+            response.close()
+
+        return status_code, result
+
+    response = http_wrapper(http_request=add_image_list, image_data_list=image_data_list)
+    if response is None:
+        return None, None
+    return response
+
 def http_add_image(image_data) -> Optional[Dict]:
     def add_image(image_data):
         url = f'{SERVER_ADDRESS}/external-images/add-external-image'
         headers = {'Content-Type': 'application/json'}
 
-        response = requests.post(url=url, json=image_data, headers=headers)
+        response = get_client().post(url=url, json=image_data, headers=headers)
         result = None
         if response.status_code == 200:
             result = response.json()['response']
@@ -105,7 +139,7 @@ def http_get_video_metadata(video_hash) -> Optional[VideoMetaData]:
 
     def get_video_metadata(video_hash) -> Optional[VideoMetaData]:
         url = f'{SERVER_ADDRESS}/ingress-videos/get-ingress-video-by-video-id?video_hash={video_hash}'
-        response = requests.get(url=url)
+        response = get_client().get(url=url)
 
         video_metadata = None
         if response.status_code == 200:
@@ -127,7 +161,7 @@ def http_get_video_metadata(video_hash) -> Optional[VideoMetaData]:
 def http_get_unprocessed_videos() -> Optional[List[VideoMetaData]]:
     def get_unprocessed_videos():
         url = f'{SERVER_ADDRESS}/ingress-videos/list-unprocessed-list'
-        response = requests.get(url=url)
+        response = get_client().get(url=url)
         
         video_metadata = None
         if response.status_code == 200:
@@ -149,7 +183,7 @@ def http_get_unprocessed_videos() -> Optional[List[VideoMetaData]]:
 
 def http_get_video_game(game_id):
     url = f'{SERVER_ADDRESS}/video-games/get-video-game-by-game-id?game_id={game_id}'
-    response = requests.get(url=url)
+    response = get_client().get(url=url)
 
     video_game = None
     if response.status_code == 200:
@@ -166,7 +200,7 @@ def http_get_video_game(game_id):
 
 def http_update_video_status_to_processed(video: VideoMetaData):
     url = f'{SERVER_ADDRESS}/ingress-videos/update-ingress-video'
-    response = requests.put(url=url, json=video.serialize())
+    response = get_client().put(url=url, json=video.serialize())
     headers = {'Content-Type': 'application/json'}
     
     video_game = None
@@ -184,7 +218,7 @@ def http_update_video_status_to_processed(video: VideoMetaData):
 
 def http_ingress_video_by_video_hash(video_id) -> Optional[VideoMetaData]:
     url = f'{SERVER_ADDRESS}/ingress-videos/get-ingress-video-by-video-id?video_id={video_id}'
-    response = requests.get(url=url)
+    response = get_client().get(url=url)
 
     video_game = None
     if response.status_code == 200:
@@ -203,7 +237,7 @@ def http_add_new_dataset(dataset_name, bucket_id):
     server_url = f"{SERVER_ADDRESS}/datasets/add-new-dataset?dataset_name={dataset_name}&bucket_id={bucket_id}"
     response = None
     try:
-        response = requests.post(server_url)
+        response = get_client().post(server_url)
         if response.status_code == 200:
             return response.json()['response']
         else:
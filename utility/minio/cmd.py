@@ -8,9 +8,19 @@ base_dir = './'
 sys.path.insert(0, base_dir)
 
 from utility.utils_logger import logger
+from utility.utils import metrics
 
 from config import MINIO_ADDRESS
 
+MINIO_REQUEST_SECONDS = metrics.histogram('minio_request_seconds', 'Latency of the MinIO calls of the pipelines', ['operation'])
+MINIO_ERRORS = metrics.counter('minio_errors_total', 'MinIO calls of the pipelines that raised', ['operation'])
+MINIO_BYTES = metrics.counter('minio_bytes_total', 'Bytes downloaded from and uploaded to MinIO', ['operation'])
+
+
+def _measure(operation):
+    return metrics.measure(MINIO_REQUEST_SECONDS.labels(operation=operation), MINIO_ERRORS.labels(operation=operation))
+
+
 def get_minio_client(minio_access_key, minio_secret_key, minio_ip_addr=None):
     global MINIO_ADDRESS
 
@@ -54,7 +64,9 @@ def is_minio_server_accessible(address=None):
 
 def download_from_minio(client, bucket_name, object_name, output_path):
     if not os.path.isfile(output_path):
-        client.fget_object(bucket_name, object_name, output_path, progress=Progress())
+        with _measure('download'):
+            client.fget_object(bucket_name, object_name, output_path, progress=Progress())
+        MINIO_BYTES.labels(operation='download').inc(os.path.getsize(output_path))
     else:
         logger.info(f"{object_name} already exists.")
 
@@ -157,22 +169,44 @@ def get_list_of_objects_with_prefix(client, bucket_name, prefix):
     return object_names
 
 
+def get_object_etags_with_prefix(client, bucket_name, prefix):
+    """
+    Names of the objects under `prefix` with their ETag, from a single listing
+    instead of a `stat_object` call per object.
+    """
+    etags = {}
+    with _measure('list'):
+        objects = client.list_objects(bucket_name, prefix=prefix, recursive=True)
+
+        for obj in objects:
+            etags[obj.object_name] = obj.etag.strip('"') if obj.etag else None
+
+    return etags
+
+
 def upload_from_file(client, bucket_name, object_name, file_path, progress = None):
     try:
-        result = client.fput_object(bucket_name, object_name, file_path, part_size=10 * 1024 * 1024,progress=progress)
+        with _measure('upload_file'):
+            result = client.fput_object(bucket_name, object_name, file_path, part_size=10 * 1024 * 1024,progress=progress)
+        MINIO_BYTES.labels(operation='upload_file').inc(os.path.getsize(file_path))
         print(
             "created {0} object; etag: {1}, version-id: {2}".format(
                 result.object_name, result.etag, result.version_id,
             ),
         )
     except Exception as e:
-        print(e)
+        # raised, so that the pipeline does not mark a video with missing frames or shards as done
+        logger.error(f"Uploading {file_path} to {bucket_name}/{object_name} failed: {e}")
+        raise
 
 def upload_data(client, bucket_name, object_name, data):
     try:
-        result = client.put_object(
-            bucket_name, object_name, data, length=-1, part_size=10 * 1024 * 1024,
-        )
+        with _measure('upload'):
+            result = client.put_object(
+                bucket_name, object_name, data, length=-1, part_size=10 * 1024 * 1024,
+            )
+        if hasattr(data, 'getbuffer'):
+            MINIO_BYTES.labels(operation='upload').inc(data.getbuffer().nbytes)
         print(
             "created {0} object; etag: {1}, version-id: {2}".format(
                 result.object_name, result.etag, result.version_id,
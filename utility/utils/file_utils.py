@@ -1,6 +1,8 @@
 import os
+import fcntl
 import shutil
 import hashlib
+from contextlib import contextmanager
 
 def delete_all_files(dir: str, ignore_missing=True) -> None:
     """
@@ -49,4 +51,23 @@ def get_file_hash(fpath: str, chunk_size: int = 1024) -> str:
                 break
             sha256.update(data)
 
-    return sha256.hexdigest()
\ No newline at end of file
+    return sha256.hexdigest()
+
+
+@contextmanager
+def file_lock(path: str):
+    """
+    Hold an exclusive inter-process lock for `path`, e.g. around a read-merge-write
+    of a file shared by the worker processes. The lock is taken on the sidecar file
+    `<path>.lock`, since `path` itself is replaced by the writers.
+
+    Args:
+        path (str): The path of the file to lock.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(f'{path}.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -1,7 +1,15 @@
+from io import BytesIO
+from typing import Optional, Tuple
+from concurrent.futures import Executor
 from PIL import Image
+import numpy as np
 import hashlib
+from Crypto.Hash import BLAKE2s
 from utility.utils.blake256_hash import Blake256
 
+# bytes fed to both hashes at a time by get_data_hashes
+HASH_CHUNK_SIZE = 1 << 20
+
 def get_image_hash(img) -> str:
     # Convert the image to bytes
     img_bytes = img.tobytes()
@@ -16,14 +24,42 @@ def get_blake256_hash(img) -> str:
     hash_instance = Blake256(data=img_bytes)
     return hash_instance.hexdigest()
 
-def get_image_info(img_path):
-    img = Image.open(fp=img_path)
-    
-    image_hash = get_image_hash(img=img)
-    image_blake256_hash = get_blake256_hash(img=img)
+def _update_hashes(hashes, data):
+    with memoryview(data) as view, view.cast('B') as flat_view:
+        for start in range(0, len(flat_view), HASH_CHUNK_SIZE):
+            chunk = flat_view[start:start + HASH_CHUNK_SIZE]
+            for hash_instance in hashes:
+                hash_instance.update(chunk)
+
+    return [hash_instance.hexdigest() for hash_instance in hashes]
+
+def get_data_hashes(data, executor: Optional[Executor] = None) -> Tuple[str, str]:
+    """
+    SHA-256 and BLAKE2s-256 (same digest as `Blake256`) hex digests of `data`, any
+    C-contiguous buffer, computed in a single pass: each chunk is fed to both hashes
+    while it is still in cache.
+
+    With an `executor` (a `ThreadPoolExecutor`), the BLAKE2s digest is computed on
+    one of its threads while the calling thread computes the SHA-256 one. Both
+    release the GIL while hashing, so the two passes run in parallel.
+    """
+    sha256 = hashlib.sha256()
+    blake256 = BLAKE2s.new(digest_bits=256)
+
+    if executor is None:
+        return tuple(_update_hashes([sha256, blake256], data))
+
+    blake256_future = executor.submit(_update_hashes, [blake256], data)
+    sha256_digest, = _update_hashes([sha256], data)
+    blake256_digest, = blake256_future.result()
+    return sha256_digest, blake256_digest
+
+
+def _get_decoded_image_info(img, executor: Optional[Executor] = None, pixels: bytes = None) -> dict:
+    # `pixels` is img.tobytes(), when the caller already has it
+    image_hash, image_blake256_hash = get_data_hashes(img.tobytes() if pixels is None else pixels, executor=executor)
     image_resolution = img.size
-    image_format = img.format
-    
+
     return {
         "image_hash": image_hash,
         "blake256_hash": image_blake256_hash,
@@ -31,6 +67,71 @@ def get_image_info(img_path):
             "width": image_resolution[0],
             "height": image_resolution[1]
         },
-        "image_format": image_format
+        "image_format": img.format
     }
 
+
+def get_image_info(img_path):
+    with Image.open(fp=img_path) as img:
+        return _get_decoded_image_info(img)
+
+
+def get_encoded_image_info(data: bytes, executor: Optional[Executor] = None) -> dict:
+    """
+    Same as `get_image_info` for an encoded image held in memory, e.g. the bytes
+    that are about to be written to or uploaded as `img_path`. See
+    `get_data_hashes` for `executor`.
+    """
+    with Image.open(BytesIO(data)) as img:
+        return _get_decoded_image_info(img, executor=executor)
+
+
+def decode_encoded_image(data: bytes, executor: Optional[Executor] = None) -> Tuple[np.ndarray, dict]:
+    """
+    Decode an encoded image held in memory into a uint8 (H, W, 3) RGB array, and
+    return it with its `get_encoded_image_info` dict, computed from the same decode.
+    """
+    with Image.open(BytesIO(data)) as img:
+        if img.mode != 'RGB':
+            return np.asarray(img.convert('RGB')), _get_decoded_image_info(img, executor=executor)
+
+        pixels = img.tobytes()
+        frame_info = _get_decoded_image_info(img, executor=executor, pixels=pixels)
+        # read-only, like np.asarray of an image
+        return np.frombuffer(pixels, dtype=np.uint8).reshape(img.size[1], img.size[0], 3), frame_info
+
+
+def encode_frame(frame, image_format="JPEG") -> bytes:
+    """
+    Encode an RGB frame (HxWx3 uint8 numpy array), with the same settings as
+    `Image.save` to a file of that format.
+    """
+    buffer = BytesIO()
+    Image.fromarray(frame).save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+def fingerprint_frame(frame, image_format="JPEG", executor: Optional[Executor] = None) -> Tuple[bytes, dict]:
+    """
+    Encode `frame` and return the encoded bytes with their info dict, equal to
+    `get_image_info` of a file holding these bytes, without reading it back. See
+    `get_data_hashes` for `executor`.
+
+    The bytes are decoded once in memory before hashing, on purpose: the image hash
+    registered for a frame is the hash of the pixels of its stored JPEG, which
+    differ from `frame` as JPEG is lossy, so hashing `frame` or the encoded bytes
+    would give other digests than `get_image_info` and the server.
+    """
+    data = encode_frame(frame, image_format=image_format)
+    return data, get_encoded_image_info(data, executor=executor)
+
+
+def fingerprint_frame_decoded(frame, image_format="JPEG", executor: Optional[Executor] = None) -> Tuple[bytes, dict, np.ndarray]:
+    """
+    Same as `fingerprint_frame`, also returning the pixels of the encoded bytes as
+    decoded for hashing, e.g. for the CLIP encoder, which embeds the stored JPEG.
+    """
+    data = encode_frame(frame, image_format=image_format)
+    decoded_frame, frame_info = decode_encoded_image(data, executor=executor)
+    return data, frame_info, decoded_frame
+
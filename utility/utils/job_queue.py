@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from typing import Dict, List, Optional
+
+# seconds a leased job stays reserved without a heartbeat
+DEFAULT_LEASE_SECONDS = 600.
+# leases (including the ones lost by a crashed worker) before a job is dead-lettered
+DEFAULT_MAX_ATTEMPTS = 3
+# seconds a failed job waits before it can be leased again
+DEFAULT_RETRY_DELAY = 30.
+
+
+class JobState:
+    PENDING = 'pending'
+    LEASED = 'leased'
+    DONE = 'done'
+    # failed max_attempts times, left aside for inspection
+    DEAD = 'dead'
+
+    ALL = (PENDING, LEASED, DONE, DEAD)
+
+
+class Job():
+
+    def __init__(self, job_id: str, payload: dict, attempts: int):
+        self.job_id = job_id
+        self.payload = payload
+        self.attempts = attempts
+
+
+class JobQueue():
+    """
+    Durable job queue in a SQLite file, shared by the worker processes of one
+    machine.
+
+    A worker `lease`s a job for `lease_seconds` and keeps it with `heartbeat`
+    while working on it, then marks it `complete` or `fail`s it. A job whose lease
+    expires (e.g. the worker crashed) can be leased again by another worker.
+    After `max_attempts` leases a failing job is dead-lettered instead of being
+    retried. Jobs survive a restart: `add` ignores the ids already in the queue,
+    so the same job list can be enqueued again.
+
+    Open one `JobQueue` per process; an instance is safe to share between the
+    threads of that process.
+    """
+
+    def __init__(self,
+                 path: str,
+                 lease_seconds: float = DEFAULT_LEASE_SECONDS,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                 retry_delay: float = DEFAULT_RETRY_DELAY):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # autocommit mode, transactions are opened explicitly
+        self._connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    lease_owner TEXT,
+                    lease_expires REAL,
+                    available_at REAL NOT NULL,
+                    last_error TEXT,
+                    updated_at REAL NOT NULL
+                )''')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, available_at)')
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _transaction(self, statements):
+        with self._lock:
+            # IMMEDIATE takes the write lock up front, so two workers cannot lease the same job
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                result = statements(self._connection)
+                self._connection.execute('COMMIT')
+                return result
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+
+    def add(self, job_id: str, payload: dict) -> bool:
+        """
+        Enqueue a job. Returns False if `job_id` is already in the queue, whatever
+        its state.
+        """
+        return self.add_many([(job_id, payload)]) == 1
+
+    def add_many(self, jobs) -> int:
+        """
+        Enqueue (job_id, payload) pairs. Returns the number of new jobs.
+        """
+        now = time.time()
+
+        def insert(connection):
+            cursor = connection.executemany(
+                'INSERT OR IGNORE INTO jobs (job_id, payload, state, available_at, updated_at) VALUES (?, ?, ?, ?, ?)',
+                [(job_id, json.dumps(payload), JobState.PENDING, now, now) for job_id, payload in jobs])
+            return cursor.rowcount
+
+        return self._transaction(insert)
+
+    def lease(self, owner: str) -> Optional[Job]:
+        """
+        Lease the oldest available job for `owner`, or return None if there is none.
+        """
+        now = time.time()
+
+        def lease(connection):
+            # expired leases of the jobs that used all their attempts are dead-lettered
+            connection.execute(
+                'UPDATE jobs SET state = ?, lease_owner = NULL, last_error = ?, updated_at = ? '
+                'WHERE state = ? AND lease_expires < ? AND attempts >= ?',
+                (JobState.DEAD, 'lease expired', now, JobState.LEASED, now, self.max_attempts))
+
+            row = connection.execute(
+                'SELECT job_id, payload, attempts FROM jobs '
+                'WHERE (state = ? AND available_at <= ?) OR (state = ? AND lease_expires < ?) '
+                'ORDER BY available_at LIMIT 1',
+                (JobState.PENDING, now, JobState.LEASED, now)).fetchone()
+            if row is None:
+                return None
+
+            job_id, payload, attempts = row
+            connection.execute(
+                'UPDATE jobs SET state = ?, attempts = ?, lease_owner = ?, lease_expires = ?, updated_at = ? '
+                'WHERE job_id = ?',
+                (JobState.LEASED, attempts + 1, owner, now + self.lease_seconds, now, job_id))
+            return Job(job_id, json.loads(payload), attempts + 1)
+
+        return self._transaction(lease)
+
+    def heartbeat(self, owner: str) -> int:
+        """
+        Extend the leases of all the jobs held by `owner`. Returns their number.
+        """
+        now = time.time()
+        return self._transaction(lambda connection: connection.execute(
+            'UPDATE jobs SET lease_expires = ?, updated_at = ? WHERE state = ? AND lease_owner = ?',
+            (now + self.lease_seconds, now, JobState.LEASED, owner)).rowcount)
+
+    def complete(self, job_id: str, owner: str) -> bool:
+        """
+        Mark a job done. Returns False if `owner` lost its lease in the meantime.
+        """
+        now = time.time()
+        return self._transaction(lambda connection: connection.execute(
+            'UPDATE jobs SET state = ?, lease_owner = NULL, last_error = NULL, updated_at = ? '
+            'WHERE job_id = ? AND state = ? AND lease_owner = ?',
+            (JobState.DONE, now, job_id, JobState.LEASED, owner)).rowcount == 1)
+
+    def fail(self, job_id: str, owner: str, error: str) -> Optional[str]:
+        """
+        Release a failed job for a retry after `retry_delay`, or dead-letter it if it
+        used its `max_attempts`. Returns the new state, or None if `owner` lost its
+        lease in the meantime.
+        """
+        now = time.time()
+
+        def fail(connection):
+            row = connection.execute('SELECT attempts FROM jobs WHERE job_id = ? AND state = ? AND lease_owner = ?',
+                                     (job_id, JobState.LEASED, owner)).fetchone()
+            if row is None:
+                return None
+
+            state = JobState.DEAD if row[0] >= self.max_attempts else JobState.PENDING
+            connection.execute(
+                'UPDATE jobs SET state = ?, lease_owner = NULL, available_at = ?, last_error = ?, updated_at = ? '
+                'WHERE job_id = ?',
+                (state, now + self.retry_delay, error, now, job_id))
+            return state
+
+        return self._transaction(fail)
+
+    def retry_dead(self) -> int:
+        """
+        Put the dead-lettered jobs back in the queue with their attempts reset.
+        """
+        now = time.time()
+        return self._transaction(lambda connection: connection.execute(
+            'UPDATE jobs SET state = ?, attempts = 0, available_at = ?, updated_at = ? WHERE state = ?',
+            (JobState.PENDING, now, now, JobState.DEAD)).rowcount)
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._connection.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall()
+        counts = {state: 0 for state in JobState.ALL}
+        counts.update(dict(rows))
+        return counts
+
+    def is_finished(self) -> bool:
+        """
+        Whether all the jobs are done or dead-lettered.
+        """
+        counts = self.counts()
+        return counts[JobState.PENDING] == 0 and counts[JobState.LEASED] == 0
+
+    def get_dead_jobs(self) -> List[dict]:
+        with self._lock:
+            rows = self._connection.execute('SELECT job_id, attempts, last_error FROM jobs WHERE state = ?',
+                                            (JobState.DEAD,)).fetchall()
+        return [{'job_id': job_id, 'attempts': attempts, 'last_error': last_error}
+                for job_id, attempts, last_error in rows]
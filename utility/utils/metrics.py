@@ -0,0 +1,413 @@
+import os
+import math
+import time
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Sequence
+
+# seconds, from a CLIP batch to the download of a video
+DEFAULT_LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60., 300., 900.)
+DEFAULT_METRICS_INTERVAL = 15.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_value(value) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if math.isnan(value):
+        return 'NaN'
+    return repr(float(value))
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _escape_help(documentation: str) -> str:
+    return documentation.replace('\\', r'\\').replace('\n', r'\n')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label_value(value)}"' for name, value in labels.items()) + '}'
+
+
+class _CounterValue():
+
+    def __init__(self):
+        self.value = 0.
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.) -> None:
+        if amount < 0:
+            raise ValueError("Counters can only be incremented by non-negative amounts")
+        with self._lock:
+            self.value += amount
+
+    def collect(self):
+        return [('', {}, self.value)]
+
+
+class _GaugeValue():
+
+    def __init__(self):
+        self.value = 0.
+        self.function = None
+        self._lock = threading.Lock()
+
+    def set(self, value: float) -> None:
+        with self._lock:
+            self.value = float(value)
+
+    def inc(self, amount: float = 1.) -> None:
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.) -> None:
+        with self._lock:
+            self.value -= amount
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """
+        Read the value from `function` when the metrics are rendered, for values
+        another object already keeps (queue sizes, row counts).
+        """
+        self.function = function
+
+    def collect(self):
+        if self.function is None:
+            return [('', {}, self.value)]
+        return [('', {}, float(self.function()))]
+
+
+class _Timer():
+
+    def __init__(self, histogram_value):
+        self.histogram_value = histogram_value
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram_value.observe(time.perf_counter() - self.start_time)
+
+
+class _HistogramValue():
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[index] += 1
+                    break
+            self.sum += value
+            self.count += 1
+
+    def time(self) -> _Timer:
+        """
+        Context manager observing the seconds spent in its block, also when it raises.
+        """
+        return _Timer(self)
+
+    def collect(self):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            samples.append(('_bucket', {'le': _format_value(bound)}, cumulative))
+        samples.append(('_bucket', {'le': '+Inf'}, count))
+        samples.append(('_sum', {}, total))
+        samples.append(('_count', {}, count))
+        return samples
+
+
+class _Metric(ABC):
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def _new_value(self):
+        pass
+
+    def labels(self, **labels):
+        """
+        Value of the metric for one combination of label values, created on first use.
+        """
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} has the labels {list(self.labelnames)}, got {sorted(labels)}")
+
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = self._new_value()
+            return self._values[key]
+
+    def _value(self):
+        if self.labelnames:
+            raise ValueError(f"{self.name} has labels, use {self.name}.labels(...)")
+        return self.labels()
+
+    def collect(self):
+        """
+        (sample name, labels, value) of every sample of the metric.
+        """
+        with self._lock:
+            values = list(self._values.items())
+
+        samples = []
+        for key, value in values:
+            labels = dict(zip(self.labelnames, key))
+            for suffix, sample_labels, sample_value in value.collect():
+                samples.append((self.name + suffix, {**labels, **sample_labels}, sample_value))
+        return samples
+
+
+class Counter(_Metric):
+    """
+    Monotonic total, e.g. of frames or bytes. Rates (frames/sec) are computed by
+    the scraper.
+    """
+    type = 'counter'
+
+    def _new_value(self):
+        return _CounterValue()
+
+    def inc(self, amount: float = 1.) -> None:
+        self._value().inc(amount)
+
+
+class Gauge(_Metric):
+    """
+    Value that goes up and down, e.g. a queue depth or the number of busy workers.
+    """
+    type = 'gauge'
+
+    def _new_value(self):
+        return _GaugeValue()
+
+    def set(self, value: float) -> None:
+        self._value().set(value)
+
+    def inc(self, amount: float = 1.) -> None:
+        self._value().inc(amount)
+
+    def dec(self, amount: float = 1.) -> None:
+        self._value().dec(amount)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self._value().set_function(function)
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values, by default latencies in seconds, counted in
+    cumulative `buckets`.
+    """
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(float(bound) for bound in buckets))
+
+    def _new_value(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self._value().observe(value)
+
+    def time(self) -> _Timer:
+        return self._value().time()
+
+
+class MetricsRegistry():
+    """
+    Metrics of one process, rendered in the Prometheus text format. `const_labels`
+    are added to every sample, e.g. the worker the process is.
+
+    Metrics are created with `counter`, `gauge` and `histogram`, which return the
+    metric already registered under the same name, so that modules can declare the
+    metrics they update at import time.
+    """
+
+    def __init__(self, const_labels: Dict[str, str] = None):
+        self.const_labels = dict(const_labels or {})
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            registered = self._metrics.get(metric.name)
+            if registered is None:
+                self._metrics[metric.name] = metric
+                return metric
+
+        if type(registered) is not type(metric) or registered.labelnames != metric.labelnames:
+            raise ValueError(f"Metric {metric.name} is already registered as a {registered.type} "
+                             f"with the labels {list(registered.labelnames)}")
+        return registered
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {_escape_help(metric.documentation)}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.collect():
+                lines.append(f"{name}{_format_labels({**self.const_labels, **labels})} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str) -> None:
+        """
+        Write the rendered metrics to `path`, replaced at once so that a reader
+        (e.g. the textfile collector of the node exporter) never sees half a file.
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, mode='w') as f:
+            f.write(self.render())
+        os.replace(temp_path, path)
+
+
+# registry of the process, updated by the pipelines, the extraction and the HTTP/MinIO layers
+REGISTRY = MetricsRegistry()
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    return REGISTRY.counter(name, documentation, labelnames)
+
+
+def gauge(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+    return REGISTRY.gauge(name, documentation, labelnames)
+
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = (),
+              buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS) -> Histogram:
+    return REGISTRY.histogram(name, documentation, labelnames, buckets)
+
+
+@contextmanager
+def measure(seconds, errors=None, in_progress=None):
+    """
+    Observe the seconds spent in the block into the histogram value `seconds`,
+    count the exceptions it raises into the counter value `errors`, and the blocks
+    running into the gauge value `in_progress`.
+    """
+    if in_progress is not None:
+        in_progress.inc()
+    start_time = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        if errors is not None:
+            errors.inc()
+        raise
+    finally:
+        seconds.observe(time.perf_counter() - start_time)
+        if in_progress is not None:
+            in_progress.dec()
+
+
+class MetricsServer():
+    """
+    Serves the metrics of `registry` at `http://<address>:<port>/metrics` from a
+    daemon thread. Port 0 picks a free port, see `port`.
+    """
+
+    def __init__(self, port: int, address: str = '127.0.0.1', registry: MetricsRegistry = REGISTRY):
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # one line per scrape would flood the logs
+                pass
+
+        self._server = ThreadingHTTPServer((address, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+class MetricsFileWriter():
+    """
+    Writes the metrics of `registry` to `path` every `interval` seconds from a
+    daemon thread, and once more when closed.
+    """
+
+    def __init__(self, path: str, interval: float = DEFAULT_METRICS_INTERVAL, registry: MetricsRegistry = REGISTRY):
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.registry.write(self.path)
+
+    def close(self) -> None:
+        self._stop_event.set()
+        self._thread.join()
+        self.registry.write(self.path)
+
+
+def start_http_server(port: int, address: str = '127.0.0.1', registry: MetricsRegistry = REGISTRY) -> MetricsServer:
+    return MetricsServer(port, address, registry)
+
+
+def start_file_writer(path: str, interval: float = DEFAULT_METRICS_INTERVAL, registry: MetricsRegistry = REGISTRY) -> MetricsFileWriter:
+    return MetricsFileWriter(path, interval, registry)
+
@@ -0,0 +1,278 @@
+import time
+import threading
+from queue import Queue, Empty, Full
+
+import sys
+base_dir = './'
+sys.path.insert(0, base_dir)
+
+from utility.utils import metrics as metrics_registry
+
+# how often blocked workers check whether the pipeline was stopped
+POLL_INTERVAL = 0.1
+
+_END = object()
+
+# labelled with the name of the pipeline (pipelines of the same name add up) and of the stage
+STAGE_ITEMS = metrics_registry.counter('stage_pipeline_items_total', 'Items processed by a stage', ['pipeline', 'stage'])
+STAGE_BUSY_SECONDS = metrics_registry.counter('stage_pipeline_busy_seconds_total', 'Time spent running the stage function, summed over the workers', ['pipeline', 'stage'])
+STAGE_IDLE_SECONDS = metrics_registry.counter('stage_pipeline_idle_seconds_total', 'Time spent waiting for an input item, summed over the workers', ['pipeline', 'stage'])
+STAGE_BLOCKED_SECONDS = metrics_registry.counter('stage_pipeline_blocked_seconds_total', 'Time spent waiting for room in the next queue, summed over the workers', ['pipeline', 'stage'])
+STAGE_QUEUE_DEPTH = metrics_registry.gauge('stage_pipeline_queue_depth', 'Items waiting in the input queue of a stage', ['pipeline', 'stage'])
+STAGE_WORKERS = metrics_registry.gauge('stage_pipeline_workers', 'Worker threads of a stage', ['pipeline', 'stage'])
+STAGE_BUSY_WORKERS = metrics_registry.gauge('stage_pipeline_busy_workers', 'Worker threads of a stage running the stage function', ['pipeline', 'stage'])
+
+
+class StageMetrics():
+    """
+    Counters of one stage. Times are in seconds, summed over the stage's workers.
+    With a `pipeline_name`, they are also added to the metrics registry.
+    """
+
+    def __init__(self, name, num_workers, queue_size, pipeline_name=None):
+        self.name = name
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+        self.processed = 0
+        # time spent running the stage function
+        self.busy_time = 0.
+        # time spent waiting for an input item
+        self.idle_time = 0.
+        # time spent waiting for room in the next stage's queue (backpressure)
+        self.blocked_time = 0.
+        self.max_queue_depth = 0
+        self._lock = threading.Lock()
+
+        self._registry_values = None
+        if pipeline_name is not None:
+            self._registry_values = [metric.labels(pipeline=pipeline_name, stage=name)
+                                     for metric in (STAGE_BUSY_SECONDS, STAGE_IDLE_SECONDS, STAGE_BLOCKED_SECONDS, STAGE_ITEMS)]
+
+    def add(self, busy_time=0., idle_time=0., blocked_time=0., processed=0):
+        with self._lock:
+            self.busy_time += busy_time
+            self.idle_time += idle_time
+            self.blocked_time += blocked_time
+            self.processed += processed
+
+        if self._registry_values is not None:
+            for value, amount in zip(self._registry_values, (busy_time, idle_time, blocked_time, processed)):
+                if amount:
+                    value.inc(amount)
+
+    def serialize(self, queue_depth=0):
+        return {
+            'name': self.name,
+            'num_workers': self.num_workers,
+            'queue_size': self.queue_size,
+            'queue_depth': queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'processed': self.processed,
+            'busy_time': self.busy_time,
+            'idle_time': self.idle_time,
+            'blocked_time': self.blocked_time,
+        }
+
+
+class Stage():
+    """
+    One step of a `StagePipeline`: `function` is called on every input item by
+    `num_workers` threads, and its result is passed to the next stage. Returning
+    None drops the item. Stateful functions must use a single worker, which also
+    keeps the items in order.
+    """
+
+    def __init__(self, name, function, num_workers=1, queue_size=8):
+        self.name = name
+        self.function = function
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+
+
+class StagePipeline():
+    """
+    Runs a source iterator and a chain of stages in threads connected by bounded
+    queues, so that blocking I/O and GIL-releasing calls of different stages
+    overlap while the number of items in flight stays bounded.
+
+    A pipeline with a `name` also updates the `stage_pipeline_*` metrics of the
+    metrics registry while it runs: stage counters, queue depths and busy workers.
+    """
+
+    def __init__(self, stages, output_queue_size=8, name=None):
+        self.stages = stages
+        self.name = name
+        self.queues = [Queue(maxsize=stage.queue_size) for stage in stages]
+        self.output_queue = Queue(maxsize=output_queue_size)
+        self.metrics = [StageMetrics(stage.name, stage.num_workers, stage.queue_size, name) for stage in stages]
+        self.source_metrics = StageMetrics('source', 1, 0, name)
+
+        self._queue_depths = {}
+        self._busy_workers = [None] * len(stages)
+        if name is not None:
+            for index, (stage, queue) in enumerate(zip(stages, self.queues)):
+                self._queue_depths[id(queue)] = STAGE_QUEUE_DEPTH.labels(pipeline=name, stage=stage.name)
+                self._busy_workers[index] = STAGE_BUSY_WORKERS.labels(pipeline=name, stage=stage.name)
+
+        self._stop = threading.Event()
+        self._error = None
+        self._threads = []
+        self._remaining_workers = [stage.num_workers for stage in stages]
+        self._lock = threading.Lock()
+
+    def _put(self, queue, item, metrics):
+        start_time = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                queue.put(item, timeout=POLL_INTERVAL)
+                self._change_queue_depth(queue, 1)
+                break
+            except Full:
+                continue
+        metrics.add(blocked_time=time.perf_counter() - start_time)
+
+    def _get(self, queue, metrics):
+        start_time = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                item = queue.get(timeout=POLL_INTERVAL)
+                self._change_queue_depth(queue, -1)
+                break
+            except Empty:
+                continue
+        else:
+            item = _END
+        metrics.add(idle_time=time.perf_counter() - start_time)
+        return item
+
+    def _change_queue_depth(self, queue, change):
+        # gauges of pipelines of the same name are shared, so they are moved by
+        # differences rather than set to the size of one queue
+        queue_depth = self._queue_depths.get(id(queue))
+        if queue_depth is not None:
+            queue_depth.inc(change)
+
+    def _next_queue(self, index):
+        return self.queues[index + 1] if index + 1 < len(self.stages) else self.output_queue
+
+    def _end_stage(self, index):
+        """
+        Called by every worker of stage `index` when it is done. The last one
+        forwards the end of the stream to the next stage.
+        """
+        with self._lock:
+            self._remaining_workers[index] -= 1
+            is_last = self._remaining_workers[index] == 0
+        if not is_last:
+            return
+
+        if index + 1 < len(self.stages):
+            for _ in range(self.stages[index + 1].num_workers):
+                self._put(self.queues[index + 1], _END, self.metrics[index])
+        else:
+            self._put(self.output_queue, _END, self.metrics[index])
+
+    def _fail(self, error):
+        with self._lock:
+            if self._error is None:
+                self._error = error
+        self._stop.set()
+
+    def _run_source(self, source):
+        try:
+            iterator = iter(source)
+            while not self._stop.is_set():
+                start_time = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                self.source_metrics.add(busy_time=time.perf_counter() - start_time, processed=1)
+                self._put(self.queues[0], item, self.source_metrics)
+                self.metrics[0].max_queue_depth = max(self.metrics[0].max_queue_depth, self.queues[0].qsize())
+        except Exception as e:
+            self._fail(e)
+        finally:
+            for _ in range(self.stages[0].num_workers):
+                self._put(self.queues[0], _END, self.source_metrics)
+            close = getattr(source, 'close', None)
+            if close is not None:
+                close()
+
+    def _run_worker(self, index):
+        stage, metrics = self.stages[index], self.metrics[index]
+        next_queue = self._next_queue(index)
+        try:
+            while True:
+                item = self._get(self.queues[index], metrics)
+                if item is _END:
+                    break
+
+                busy_workers = self._busy_workers[index]
+                if busy_workers is not None:
+                    busy_workers.inc()
+                start_time = time.perf_counter()
+                try:
+                    result = stage.function(item)
+                finally:
+                    if busy_workers is not None:
+                        busy_workers.dec()
+                metrics.add(busy_time=time.perf_counter() - start_time, processed=1)
+
+                if result is not None:
+                    self._put(next_queue, result, metrics)
+                    if index + 1 < len(self.stages):
+                        next_metrics = self.metrics[index + 1]
+                        next_metrics.max_queue_depth = max(next_metrics.max_queue_depth, next_queue.qsize())
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._end_stage(index)
+
+    def get_metrics(self):
+        """
+        Return the counters of the source and every stage, with the current depth
+        of each stage's input queue.
+        """
+        metrics = [self.source_metrics.serialize()]
+        for stage_metrics, queue in zip(self.metrics, self.queues):
+            metrics.append(stage_metrics.serialize(queue_depth=queue.qsize()))
+        return metrics
+
+    def run(self, source):
+        """
+        Feed `source` through the stages and yield the results of the last stage as
+        they are produced. Results of stages with several workers may be out of
+        order. An exception raised by the source or a stage stops the pipeline and
+        is raised here.
+        """
+        self._threads = [threading.Thread(target=self._run_source, args=(source,), daemon=True)]
+        for index, stage in enumerate(self.stages):
+            for _ in range(stage.num_workers):
+                self._threads.append(threading.Thread(target=self._run_worker, args=(index,), daemon=True))
+        if self.name is not None:
+            for stage in self.stages:
+                STAGE_WORKERS.labels(pipeline=self.name, stage=stage.name).inc(stage.num_workers)
+        for thread in self._threads:
+            thread.start()
+
+        output_metrics = StageMetrics('output', 1, 0)
+        try:
+            while True:
+                item = self._get(self.output_queue, output_metrics)
+                if item is _END:
+                    break
+                yield item
+        finally:
+            self._stop.set()
+            for thread in self._threads:
+                thread.join()
+            if self.name is not None:
+                # items left behind by a failure
+                for queue in self.queues:
+                    self._change_queue_depth(queue, -queue.qsize())
+                for stage in self.stages:
+                    STAGE_WORKERS.labels(pipeline=self.name, stage=stage.name).dec(stage.num_workers)
+
+        if self._error is not None:
+            raise self._error
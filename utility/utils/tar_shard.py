@@ -0,0 +1,218 @@
+import io
+import json
+import os
+import tarfile
+import threading
+import time
+from typing import Callable, Dict, Iterator, List
+
+# version of the tar shard index layout
+TAR_SHARD_INDEX_VERSION = 1
+# shards are closed and uploaded once they reach this size
+DEFAULT_MAX_SHARD_BYTES = 256 * 1024 * 1024
+
+TAR_SHARD_SUFFIX = '.tar'
+TAR_SHARD_INDEX_SUFFIX = '_tar_index.json'
+
+
+def get_tar_shard_object_name(prefix: str, shard: int) -> str:
+    return f"{prefix}_{shard:04d}{TAR_SHARD_SUFFIX}"
+
+
+def get_tar_shard_index_object_name(prefix: str) -> str:
+    return f"{prefix}{TAR_SHARD_INDEX_SUFFIX}"
+
+
+def _padded_size(size):
+    return -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+
+class TarShardWriter():
+    """
+    Packs samples into size-bounded tar shards laid out as WebDataset expects:
+    the members of a sample are `{key}.{extension}` (e.g. `{key}.jpg`,
+    `{key}.json`, `{key}.bin`) and follow each other in the tar.
+
+    Shards are written into `temp_dir` and handed to `upload(object_name, path)`
+    once they reach `max_shard_bytes`, or on `close`, then deleted. `close` also
+    uploads the index `{prefix}_tar_index.json`, recording the shard of each
+    sample and the byte offset and size of its members, so that a single member
+    can be fetched with a range request (see `TarShardReader.get_member`).
+
+    `add` can be called from several threads.
+    """
+
+    def __init__(self,
+                 upload: Callable[[str, str], None],
+                 prefix: str,
+                 temp_dir: str,
+                 max_shard_bytes: int = DEFAULT_MAX_SHARD_BYTES):
+        self.upload = upload
+        self.prefix = prefix
+        self.temp_dir = temp_dir
+        self.max_shard_bytes = max_shard_bytes
+
+        self.shards = []
+        self.samples = []
+
+        self._tar = None
+        self._path = None
+        self._num_samples = 0
+        self._lock = threading.Lock()
+
+    def _open_shard(self):
+        os.makedirs(self.temp_dir, exist_ok=True)
+        self._path = os.path.join(self.temp_dir, os.path.basename(get_tar_shard_object_name(self.prefix, len(self.shards))))
+        self._tar = tarfile.open(self._path, mode='w', format=tarfile.PAX_FORMAT)
+        self._num_samples = 0
+
+    def add(self, key: str, members: Dict[str, bytes], info: dict = None) -> None:
+        """
+        Add a sample `key` with its members by extension. `info` is stored with
+        the sample in the index.
+        """
+        with self._lock:
+            if self._tar is None:
+                self._open_shard()
+
+            sample = dict(info or {})
+            sample.update({
+                'key': key,
+                'shard': len(self.shards),
+                'offset': self._tar.offset,
+                'members': {},
+            })
+            mtime = time.time()
+            for extension, data in members.items():
+                tarinfo = tarfile.TarInfo(f"{key}.{extension}")
+                tarinfo.size = len(data)
+                tarinfo.mtime = mtime
+                self._tar.addfile(tarinfo, io.BytesIO(data))
+                # data sits right before the end of the member, padded to a block
+                sample['members'][extension] = [self._tar.offset - _padded_size(len(data)), len(data)]
+
+            self.samples.append(sample)
+            self._num_samples += 1
+
+            if self._tar.offset < self.max_shard_bytes:
+                return
+            shard = self._close_shard()
+
+        self._upload_shard(*shard)
+
+    def _close_shard(self):
+        self._tar.close()
+        object_name = get_tar_shard_object_name(self.prefix, len(self.shards))
+        self.shards.append({
+            'object_name': object_name,
+            'num_samples': self._num_samples,
+            'size': os.path.getsize(self._path),
+        })
+        shard = object_name, self._path
+        self._tar, self._path = None, None
+        return shard
+
+    def _upload_shard(self, object_name, path):
+        try:
+            self.upload(object_name, path)
+        finally:
+            os.remove(path)
+
+    def get_index(self) -> dict:
+        return {
+            'version': TAR_SHARD_INDEX_VERSION,
+            'shards': self.shards,
+            'samples': self.samples,
+        }
+
+    def close(self) -> dict:
+        """
+        Upload the last shard and the index, and return the index.
+        Call it once all the samples are added.
+        """
+        with self._lock:
+            shard = self._close_shard() if self._tar is not None else None
+        if shard is not None:
+            self._upload_shard(*shard)
+
+        index = self.get_index()
+        index_path = os.path.join(self.temp_dir, os.path.basename(get_tar_shard_index_object_name(self.prefix)))
+        with open(index_path, 'w') as f:
+            json.dump(index, f)
+        self._upload_shard(get_tar_shard_index_object_name(self.prefix), index_path)
+
+        return index
+
+
+def iter_tar_samples(fileobj) -> Iterator[dict]:
+    """
+    Stream the samples of a tar shard from a file object read sequentially (no
+    seeking, e.g. an HTTP response), as dicts {'__key__': key, extension: bytes}.
+    """
+    sample = None
+    with tarfile.open(fileobj=fileobj, mode='r|') as tar:
+        for tarinfo in tar:
+            if not tarinfo.isfile():
+                continue
+            key, extension = tarinfo.name.rsplit('.', 1)
+            if sample is not None and sample['__key__'] != key:
+                yield sample
+                sample = None
+            if sample is None:
+                sample = {'__key__': key}
+            sample[extension] = tar.extractfile(tarinfo).read()
+
+    if sample is not None:
+        yield sample
+
+
+class TarShardReader():
+    """
+    Reads the tar shards written by `TarShardWriter` from MinIO, given the object
+    name of the index: `iter_samples` streams whole shards for training reads,
+    `get_member` fetches one member of a sample with a byte-range request.
+    """
+
+    def __init__(self, minio_client, bucket_name: str, index_object_name: str):
+        self.minio_client = minio_client
+        self.bucket_name = bucket_name
+
+        response = self.minio_client.get_object(self.bucket_name, index_object_name)
+        try:
+            self.index = json.loads(response.read())
+        finally:
+            response.close()
+            response.release_conn()
+        if self.index['version'] != TAR_SHARD_INDEX_VERSION:
+            raise ValueError(f"Unsupported tar shard index version {self.index['version']}")
+
+        self.samples = self.index['samples']
+        self._samples_by_key = {sample['key']: sample for sample in self.samples}
+
+    def get_shard_object_names(self) -> List[str]:
+        return [shard['object_name'] for shard in self.index['shards']]
+
+    def iter_samples(self, shards: List[int] = None) -> Iterator[dict]:
+        """
+        Stream the samples of `shards` (all by default), one shard after the other.
+        """
+        object_names = self.get_shard_object_names()
+        for shard in (range(len(object_names)) if shards is None else shards):
+            response = self.minio_client.get_object(self.bucket_name, object_names[shard])
+            try:
+                yield from iter_tar_samples(response)
+            finally:
+                response.close()
+                response.release_conn()
+
+    def get_member(self, key: str, extension: str) -> bytes:
+        sample = self._samples_by_key[key]
+        offset, size = sample['members'][extension]
+        object_name = self.index['shards'][sample['shard']]['object_name']
+
+        response = self.minio_client.get_object(self.bucket_name, object_name, offset=offset, length=size)
+        try:
+            return response.read()
+        finally:
+            response.close()
+            response.release_conn()
@@ -0,0 +1,80 @@
+DEFAULT_MIN_FPS = 1 / 12
+DEFAULT_MAX_FPS = 1.
+DEFAULT_INITIAL_FPS = 1 / 3
+
+# thumbnail deltas of an analyzed frame below which the content is considered
+# static, and above which it is considered changing
+DEFAULT_STATIC_THRESHOLD = 0.02
+DEFAULT_MOTION_THRESHOLD = 0.1
+
+
+class AdaptiveSampler():
+    """
+    Chooses which frames of a stream decoded at `max_fps` are analyzed.
+
+    The activity signal is the thumbnail delta the dedup computes anyway: the
+    distance of an analyzed frame to the closest thumbnail it kept (see
+    `ThumbnailHistory.min_distance`). The interval to the next analyzed frame is
+    multiplied by `step` when the delta is below `static_threshold`, and divided by
+    `step` when it is above `motion_threshold`, within [1 / max_fps, 1 / min_fps]
+    seconds.
+
+    Frames must be passed in order: `due` for every decoded frame, then `update`
+    with the delta of the frames that were analyzed.
+
+    With `fetch_kept_frames`, the extraction decodes only the analysis stream at
+    `max_fps` and fetches each kept frame at full resolution with a seek, which
+    pays off when most frames are skipped (see scripts/benchmark_adaptive_sampling.py).
+    Otherwise every decoded frame is also scaled and piped at full resolution.
+    """
+
+    def __init__(self,
+                 min_fps=DEFAULT_MIN_FPS,
+                 max_fps=DEFAULT_MAX_FPS,
+                 initial_fps=DEFAULT_INITIAL_FPS,
+                 static_threshold=DEFAULT_STATIC_THRESHOLD,
+                 motion_threshold=DEFAULT_MOTION_THRESHOLD,
+                 step=2.,
+                 fetch_kept_frames=True):
+        if not 0 < min_fps <= max_fps:
+            raise ValueError(f"Expected 0 < min_fps <= max_fps, got {min_fps} and {max_fps}")
+
+        self.min_fps = min_fps
+        self.max_fps = max_fps
+        self.static_threshold = static_threshold
+        self.motion_threshold = motion_threshold
+        self.step = step
+        self.fetch_kept_frames = fetch_kept_frames
+
+        self.min_interval = 1 / max_fps
+        self.max_interval = 1 / min_fps
+        self.interval = min(max(1 / initial_fps, self.min_interval), self.max_interval)
+        self.next_time = 0.
+
+    def timestamp(self, frame_num) -> float:
+        """
+        Time in seconds of the `frame_num`-th frame decoded at `max_fps`.
+        """
+        return frame_num / self.max_fps
+
+    def due(self, frame_num) -> bool:
+        """
+        Return True if the `frame_num`-th decoded frame should be analyzed.
+        """
+        # tolerance for the float rounding of the intervals
+        return self.timestamp(frame_num) >= self.next_time - 1e-6
+
+    def update(self, frame_num, delta) -> float:
+        """
+        Adapt the interval to the thumbnail `delta` of the `frame_num`-th frame (inf
+        while nothing is kept, which leaves it unchanged), and schedule the next
+        analyzed frame. Returns the interval.
+        """
+        if delta < self.static_threshold:
+            self.interval = min(self.interval * self.step, self.max_interval)
+        elif delta > self.motion_threshold and delta != float('inf'):
+            self.interval = max(self.interval / self.step, self.min_interval)
+
+        self.next_time = self.timestamp(frame_num) + self.interval
+
+        return self.interval
@@ -1,4 +1,13 @@
 import os
+import time
+import bisect
+import itertools
+from fractions import Fraction
+from functools import partial
+import subprocess
+import threading
+from queue import Queue
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import ffmpeg
 import numpy as np
@@ -12,9 +21,112 @@ import sys
 base_dir = './'
 sys.path.insert(0, base_dir)
 
-from utility.utils.image_utils import get_image_info
+from utility.utils.image_utils import fingerprint_frame, fingerprint_frame_decoded
+from utility.video.video_processing.thumbnail_history import ThumbnailHistory
+from utility.video.video_processing.frame_buffer_pool import FrameBufferPool, read_frames, read_frame_into
+from utility.video.video_processing.phash_index import PerceptualHashIndex, compute_phash, DEFAULT_RADIUS
+from utility.video.video_processing.known_hash_index import KnownHashIndex
+from utility.video.video_processing import adaptive_sampler
+from utility.video.video_processing.adaptive_sampler import AdaptiveSampler
+from utility.utils.stage_pipeline import Stage, StagePipeline
+from utility.utils import metrics
 
-def frame_generator(video_path, start=0., end=None, fps=1, width=1920, height=1080):
+# rate at which frame_generator samples frames by default (one frame every 3 seconds)
+SAMPLE_FPS = 1/3
+
+DEFAULT_SCENE_THRESHOLD = 0.3
+
+
+class ExtractionStrategy:
+    # SAMPLE_FPS sampling with ORB/thumbnail dedup
+    ORB = 'orb'
+    # every frame at the given fps, no dedup
+    FIXED_FPS = 'fps'
+    # I-frames only, non-key frames are not decoded
+    KEYFRAME = 'keyframe'
+    # frames whose ffmpeg scene change score is above a threshold
+    SCENE = 'scene'
+    # ORB/thumbnail dedup at a rate adapted to the amount of change, see AdaptiveSampler
+    ADAPTIVE = 'adaptive'
+
+    ALL = (ORB, FIXED_FPS, KEYFRAME, SCENE, ADAPTIVE)
+
+
+# sampled: candidates decoded, kept: selected by the dedup, skipped: passed over by
+# the adaptive sampler, known: kept frames dropped as already registered
+EXTRACTION_FRAMES = metrics.counter('extraction_frames_total', 'Frames seen by the extraction, by outcome', ['strategy', 'outcome'])
+
+
+class ExtractionStats():
+    """
+    Throughput and kept-frame counters of one extraction run. Counts are also
+    added to the `extraction_frames_total` metric as they are made.
+    """
+
+    def __init__(self, strategy=ExtractionStrategy.ORB):
+        self.strategy = strategy
+        # frames coming out of ffmpeg, i.e. candidates for the dedup
+        self.sampled_frames = 0
+        self.kept_frames = 0
+        # frames passed over by the adaptive sampler without being analyzed
+        self.skipped_frames = 0
+        # kept frames dropped because their image hash is already registered
+        self.known_frames = 0
+        self.start_time = time.time()
+        self.end_time = None
+        # per-stage counters of `staged_frame_generator`, see `StagePipeline.get_metrics`
+        self.stage_metrics = None
+
+    def add(self, sampled=0, kept=0, skipped=0, known=0):
+        self.sampled_frames += sampled
+        self.kept_frames += kept
+        self.skipped_frames += skipped
+        self.known_frames += known
+        for outcome, count in (('sampled', sampled), ('kept', kept), ('skipped', skipped), ('known', known)):
+            if count:
+                EXTRACTION_FRAMES.labels(strategy=self.strategy, outcome=outcome).inc(count)
+
+    def stop(self):
+        self.end_time = time.time()
+
+    @property
+    def elapsed(self):
+        end_time = self.end_time if self.end_time is not None else time.time()
+        return end_time - self.start_time
+
+    def serialize(self):
+        elapsed = self.elapsed
+        return {
+            'strategy': self.strategy,
+            'sampled_frames': self.sampled_frames,
+            'kept_frames': self.kept_frames,
+            'skipped_frames': self.skipped_frames,
+            'known_frames': self.known_frames,
+            'elapsed': elapsed,
+            'sampled_fps': self.sampled_frames / elapsed if elapsed > 0 else 0.,
+            'kept_fps': self.kept_frames / elapsed if elapsed > 0 else 0.,
+            'kept_ratio': self.kept_frames / self.sampled_frames if self.sampled_frames else 0.,
+            'stage_metrics': self.stage_metrics,
+        }
+
+    def __str__(self):
+        stats = self.serialize()
+        lines = [f"[{stats['strategy']}] {stats['sampled_frames']} sampled, {stats['kept_frames']} kept "
+                 f"({stats['kept_ratio']:.1%}) in {stats['elapsed']:.1f}s, "
+                 f"{stats['sampled_fps']:.2f} sampled frames/sec"]
+        if stats['skipped_frames']:
+            lines[0] += f", {stats['skipped_frames']} skipped by the adaptive sampler"
+        if stats['known_frames']:
+            lines[0] += f", {stats['known_frames']} already registered"
+        for stage in self.stage_metrics or []:
+            lines.append(f"  {stage['name']:>8} x{stage['num_workers']}: {stage['processed']} items, "
+                         f"busy {stage['busy_time']:.1f}s, idle {stage['idle_time']:.1f}s, "
+                         f"blocked {stage['blocked_time']:.1f}s, "
+                         f"max queue depth {stage['max_queue_depth']}/{stage['queue_size']}")
+        return '\n'.join(lines)
+
+
+def frame_generator(video_path, start=0., end=None, fps=SAMPLE_FPS, width=1920, height=1080):
 
     # .input(video_path, hwaccel='cuda', hwaccel_device='0', hwaccel_output_format='cuda')
     if end is None:
@@ -24,23 +136,124 @@ def frame_generator(video_path, start=0., end=None, fps=1, width=1920, height=10
     
     process = (
         stream
-        .filter('fps', fps=1/3)
+        .filter('fps', fps=fps)
         .output('pipe:', format='rawvideo', pix_fmt='rgb24')
         .global_args('-loglevel', 'error')
         .run_async(pipe_stdout=True)
     )
     
-    frame_num = 0
-    while True:
-        in_bytes = process.stdout.read(width * height * 3)
-        if not in_bytes:
-            break
-        in_frame = np.frombuffer(in_bytes, np.uint8).reshape([height, width, 3])
-        yield in_frame, frame_numd
-        frame_num += 1
+    for frame_num, in_frame in enumerate(read_frames(process.stdout, (height, width, 3))):
+        yield in_frame, frame_num
     process.wait()
 
 
+def _read_frames_into_queue(pipe, shape, frame_queue):
+    for frame in read_frames(pipe, shape):
+        frame_queue.put(frame)
+        del frame
+    frame_queue.put(None)
+
+
+def get_analysis_size(width, height, analysis_width):
+    # keep the aspect ratio, with an even height as required by ffmpeg's scaler
+    analysis_height = max(2, round(height * analysis_width / width / 2) * 2)
+    return analysis_width, analysis_height
+
+
+def analysis_frame_generator(video_path, start=0., end=None, width=1920, height=1080, analysis_width=480,
+                             fps=SAMPLE_FPS, full_resolution=True):
+    """
+    Same sampling as `frame_generator`, but ffmpeg also emits a downscaled grayscale
+    copy and a 64x64 RGB thumbnail of every sampled frame on two more pipes, so that
+    the dedup checks never touch the full resolution frame.
+
+    Yields (frame, analysis_frame, thumb, frame_num), where `frame` is the full
+    resolution RGB frame, `analysis_frame` a (analysis_height, analysis_width) uint8
+    array and `thumb` a (64, 64, 3) uint8 array. With `full_resolution` False, the
+    full resolution frames are neither scaled nor piped and `frame` is None.
+    """
+    analysis_width, analysis_height = get_analysis_size(width, height, analysis_width)
+
+    if end is None:
+        stream = ffmpeg.input(video_path, ss=start)
+    else:
+        stream = ffmpeg.input(video_path, ss=start, to=end)
+
+    analysis_read_fd, analysis_write_fd = os.pipe()
+    thumb_read_fd, thumb_write_fd = os.pipe()
+
+    split = stream.filter('fps', fps=fps).split()
+    analysis_output = (
+        split[1]
+        .filter('scale', analysis_width, analysis_height, flags='area')
+        .output(f'pipe:{analysis_write_fd}', format='rawvideo', pix_fmt='gray')
+    )
+    thumb_output = (
+        split[2]
+        .filter('scale', 64, 64, flags='bicubic')
+        .output(f'pipe:{thumb_write_fd}', format='rawvideo', pix_fmt='rgb24')
+    )
+    outputs = [analysis_output, thumb_output]
+    if full_resolution:
+        outputs.insert(0, split[0].output('pipe:1', format='rawvideo', pix_fmt='rgb24'))
+    args = (
+        ffmpeg.merge_outputs(*outputs)
+        .global_args('-loglevel', 'error')
+        .compile()
+    )
+
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, pass_fds=(analysis_write_fd, thumb_write_fd))
+    os.close(analysis_write_fd)
+    os.close(thumb_write_fd)
+
+    # ffmpeg writes the outputs in an order we do not control, so the full
+    # resolution and thumbnail pipes are drained by threads to avoid blocking
+    # on any of the pipes.
+    thumb_pipe = os.fdopen(thumb_read_fd, 'rb')
+    pipes = [(thumb_pipe, (64, 64, 3))]
+    if full_resolution:
+        pipes.insert(0, (process.stdout, (height, width, 3)))
+    readers = []
+    for pipe, shape in pipes:
+        frame_queue = Queue(maxsize=4)
+        reader = threading.Thread(target=_read_frames_into_queue,
+                                  args=(pipe, shape, frame_queue),
+                                  daemon=True)
+        reader.start()
+        readers.append((reader, frame_queue))
+    full_frames = readers[0][1] if full_resolution else None
+    thumbs = readers[-1][1]
+
+    analysis_pipe = os.fdopen(analysis_read_fd, 'rb')
+    analysis_frames = FrameBufferPool((analysis_height, analysis_width))
+    frame_num = 0
+    finished = False
+    try:
+        while True:
+            analysis_frame = analysis_frames.acquire()
+            if not read_frame_into(analysis_pipe, analysis_frame):
+                break
+            in_frame = full_frames.get() if full_resolution else None
+            thumb = thumbs.get()
+            if (full_resolution and in_frame is None) or thumb is None:
+                break
+            yield in_frame, analysis_frame, thumb, frame_num
+            del in_frame, analysis_frame, thumb
+            frame_num += 1
+        finished = True
+    finally:
+        # stop ffmpeg if the consumer stopped early, and unblock the reader threads
+        if not finished:
+            process.kill()
+        for reader, frame_queue in readers:
+            while reader.is_alive() or not frame_queue.empty():
+                if frame_queue.get() is None:
+                    break
+        process.wait()
+        analysis_pipe.close()
+        thumb_pipe.close()
+
+
 def key_frame_generator(video_path, start=0., end=None, width=1920, height=1080):
 
     # .input(video_path, hwaccel='cuda', hwaccel_device='0', hwaccel_output_format='cuda')
@@ -57,14 +270,32 @@ def key_frame_generator(video_path, start=0., end=None, width=1920, height=1080)
         .run_async(pipe_stdout=True)
     )
     
-    frame_num = 0
-    while True:
-        in_bytes = process.stdout.read(width * height * 3)
-        if not in_bytes:
-            break
-        in_frame = np.frombuffer(in_bytes, np.uint8).reshape([height, width, 3])
+    for frame_num, in_frame in enumerate(read_frames(process.stdout, (height, width, 3))):
+        yield in_frame, frame_num
+
+    process.wait()
+
+
+def scene_frame_generator(video_path, start=0., end=None, threshold=DEFAULT_SCENE_THRESHOLD, width=1920, height=1080):
+    """
+    Yield the first frame and every frame whose ffmpeg scene change score is above
+    `threshold`, as (frame, frame_num).
+    """
+    if end is None:
+        stream = ffmpeg.input(video_path, ss=start)
+    else:
+        stream = ffmpeg.input(video_path, ss=start, to=end)
+
+    process = (
+        stream
+        .filter('select', f'eq(n,0)+gt(scene,{threshold})')
+        .output('pipe:', format='rawvideo', pix_fmt='rgb24', vsync='vfr')
+        .global_args('-loglevel', 'error')
+        .run_async(pipe_stdout=True)
+    )
+
+    for frame_num, in_frame in enumerate(read_frames(process.stdout, (height, width, 3))):
         yield in_frame, frame_num
-        frame_num += 1
 
     process.wait()
 
@@ -92,75 +323,769 @@ def get_video_info(video_path):
         raise e
 
 
-def process_video(video_path, output_dir, fps):
+def get_video_duration(video_path):
+    probe = ffmpeg.probe(video_path)
+    return float(probe['format']['duration'])
+
+
+def get_keyframe_timestamps(video_path):
+    """
+    Return the sorted presentation times (in seconds) of the keyframes of the first
+    video stream. Only packet headers are read, nothing is decoded.
+    """
+    probe = ffmpeg.probe(video_path, select_streams='v:0', show_entries='packet=pts_time,flags')
+
+    timestamps = []
+    for packet in probe.get('packets', []):
+        pts_time = packet.get('pts_time', 'N/A')
+        if 'K' in packet.get('flags', '') and pts_time != 'N/A':
+            timestamps.append(float(pts_time))
+
+    return sorted(timestamps)
+
+
+def get_segments(keyframe_timestamps, duration, num_segments, sample_fps=SAMPLE_FPS):
+    """
+    Split [0, duration] into at most `num_segments` (start, end) time ranges.
+
+    Every boundary is placed on the keyframe closest to an even split, then moved
+    back onto the sampling grid of `sample_fps` so that each segment samples the
+    same timestamps as a serial decode of the whole video. `end` is None for the
+    last segment.
+    """
+    interval = 1 / sample_fps
+
+    boundaries = [0.]
+    for i in range(1, num_segments):
+        target = duration * i / num_segments
+        if keyframe_timestamps:
+            index = bisect.bisect_left(keyframe_timestamps, target)
+            candidates = keyframe_timestamps[max(index - 1, 0):index + 1]
+            target = min(candidates, key=lambda t: abs(t - target))
+
+        boundary = (target // interval) * interval
+        if boundary > boundaries[-1]:
+            boundaries.append(boundary)
+
+    return list(zip(boundaries, boundaries[1:] + [None]))
+
+
+class FrameDeduplicator():
+    """
+    Keeps the ORB descriptors of the last kept frame and the thumbnails of the
+    last `num_old_thumbs` kept frames, and decides whether a new frame is a
+    near-duplicate of them.
+    """
+
+    def __init__(self,
+                 distance_threshold=40,
+                 match_ratio_threshold=0.75,
+                 thumb_delta_threshold=0.1,
+                 num_old_thumbs=64):
+        self.distance_threshold = distance_threshold
+        self.match_ratio_threshold = match_ratio_threshold
+        self.thumb_delta_threshold = thumb_delta_threshold
+        self.num_old_thumbs = num_old_thumbs
+
+        self.orb = cv2.ORB_create()
+        self.matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+
+        self.old_des = None
+        self.old_thumbs = ThumbnailHistory(capacity=num_old_thumbs)
+
+    def compute_descriptors(self, image):
+        """
+        Return the ORB descriptors of an RGB or grayscale image.
+        """
+        _, des = self.orb.detectAndCompute(image, None)
+
+        return des
+
+    def compute_features(self, frame):
+        """
+        Return the ORB descriptors and the 64x64 uint8 thumbnail used to compare `frame`.
+        """
+        des = self.compute_descriptors(frame)
+
+        thumb = np.array(Image.fromarray(frame).resize((64, 64)))
+
+        return des, thumb
+
+    def _matches_last_kept(self, des):
+        matches = self.matcher.match(des, self.old_des)
+
+        good_matches = [m for m in matches if m.distance < self.distance_threshold]
+        good_ratio = len(good_matches) / len(matches) if matches else 0
+
+        return good_ratio > self.match_ratio_threshold
+
+    def _keep(self, des, thumb):
+        self.old_des = des
+        return self.old_thumbs.append(thumb)
+
+    def get_thumb_delta(self, thumb) -> float:
+        """
+        Distance of `thumb` to the closest kept thumbnail, inf if none is kept yet.
+        """
+        return self.old_thumbs.min_distance(thumb)
+
+    def check_features(self, des, thumb, thumb_delta=None):
+        """
+        Same as `check`, from features computed by `compute_features`. `thumb_delta`
+        is the `get_thumb_delta` of `thumb`, computed if not given.
+        """
+        if self.old_des is not None:
+
+            if self._matches_last_kept(des):
+                return False
+
+            if thumb_delta is None:
+                thumb_delta = self.get_thumb_delta(thumb)
+            if thumb_delta < self.thumb_delta_threshold:
+                return False
+
+        self._keep(des, thumb)
+
+        return True
+
+    def check_features_block(self, descriptors, thumbs):
+        """
+        Same as calling `check_features` on each frame of a block in order, with the
+        thumbnails of the whole block scored against the history in one call.
+
+        Returns a list of booleans, True for the kept frames.
+        """
+        thumbs = np.asarray(thumbs)
+        deltas = self.old_thumbs.distances(thumbs)
+
+        kept = []
+        for index, des in enumerate(descriptors):
+            if self.old_des is not None:
+
+                if self._matches_last_kept(des) or deltas[index].min() < self.thumb_delta_threshold:
+                    kept.append(False)
+                    continue
+
+            slot = self._keep(des, thumbs[index])
+            # the kept thumbnail replaced the one in `slot` for the rest of the block
+            deltas[index + 1:, slot] = self.old_thumbs.distance_to_slot(thumbs[index + 1:], slot)
+            kept.append(True)
+
+        return kept
+
+    def check(self, frame):
+        """
+        Return True if the frame should be kept. Kept frames are added to the history.
+        """
+        return self.check_features(*self.compute_features(frame))
+
+
+def dedup_frames(frames, deduplicator=None):
+    """
+    Yield (frame, frame_num) for every frame of `frames` that is not a near-duplicate
+    of the previously kept ones.
+    """
+    if deduplicator is None:
+        deduplicator = FrameDeduplicator()
+
+    for frame, frame_num in frames:
+        if deduplicator.check(frame):
+            yield frame, frame_num
+
+
+def _count_frames(frames, stats):
+    for frame in frames:
+        if stats is not None:
+            stats.add(sampled=1)
+        yield frame
+
+
+def _frame_source(video_path, width, height, strategy=ExtractionStrategy.ORB, fps=SAMPLE_FPS,
+                  scene_threshold=DEFAULT_SCENE_THRESHOLD, analysis_width=None, sampler=None):
+    """
+    Yield (frame, frame_num, analysis_frame, thumb) for the candidate frames of
+    `strategy`. `analysis_frame` and `thumb` are None unless the ORB or ADAPTIVE
+    strategy runs on the analysis stream.
+
+    ADAPTIVE decodes at `sampler.max_fps`, as the next interval is only known once
+    the previous frame is analyzed. With `sampler.fetch_kept_frames`, it runs on the
+    analysis stream alone (full width without `analysis_width`): the full
+    resolution frames are neither scaled nor piped, and `frame` is a callable
+    fetching the frame with a seek, called for the frames the dedup keeps (see
+    `_resolve_frame`). Otherwise every frame is piped at full resolution as for ORB.
+    """
+    if strategy == ExtractionStrategy.FIXED_FPS:
+        # video_frame_rate may be a number or a string such as '30' or '30000/1001'
+        fps = float(Fraction(str(fps)))
+        frames = frame_generator(video_path, fps=fps, width=width, height=height)
+    elif strategy == ExtractionStrategy.KEYFRAME:
+        frames = key_frame_generator(video_path, width=width, height=height)
+    elif strategy == ExtractionStrategy.SCENE:
+        frames = scene_frame_generator(video_path, threshold=scene_threshold, width=width, height=height)
+    elif strategy not in (ExtractionStrategy.ORB, ExtractionStrategy.ADAPTIVE):
+        raise ValueError(f"Unknown extraction strategy: {strategy}, expected one of {ExtractionStrategy.ALL}")
+    elif strategy == ExtractionStrategy.ADAPTIVE and sampler.fetch_kept_frames:
+        for _, analysis_frame, thumb, frame_num in analysis_frame_generator(video_path,
+                                                                            width=width,
+                                                                            height=height,
+                                                                            analysis_width=analysis_width or width,
+                                                                            fps=sampler.max_fps,
+                                                                            full_resolution=False):
+            frame = partial(_decode_frame_at, video_path, frame_num, width, height, fps=sampler.max_fps)
+            yield frame, frame_num, analysis_frame, thumb
+        return
+    else:
+        sample_fps = sampler.max_fps if strategy == ExtractionStrategy.ADAPTIVE else SAMPLE_FPS
+        if analysis_width is None:
+            frames = frame_generator(video_path, fps=sample_fps, width=width, height=height)
+        else:
+            for frame, analysis_frame, thumb, frame_num in analysis_frame_generator(video_path,
+                                                                                    width=width,
+                                                                                    height=height,
+                                                                                    analysis_width=analysis_width,
+                                                                                    fps=sample_fps):
+                yield frame, frame_num, analysis_frame, thumb
+            return
+
+    for frame, frame_num in frames:
+        yield frame, frame_num, None, None
+
+
+def _resolve_frame(frame):
+    # the full resolution frame, fetched if the source only yielded how to get it
+    return frame() if callable(frame) else frame
+
+
+class FrameSelector():
+    """
+    Decides which candidate frames of `_frame_source` are kept: the adaptive
+    sampler and the ORB/thumbnail dedup of the strategy, then the cross-video
+    `phash_index`. Stateful, frames must be passed in order.
+    """
+
+    def __init__(self, strategy=ExtractionStrategy.ORB, phash_index=None, phash_radius=DEFAULT_RADIUS,
+                 sampler=None, stats=None):
+        self.deduplicator = None
+        if strategy in (ExtractionStrategy.ORB, ExtractionStrategy.ADAPTIVE):
+            self.deduplicator = FrameDeduplicator()
+
+        self.sampler = None
+        if strategy == ExtractionStrategy.ADAPTIVE:
+            self.sampler = sampler if sampler is not None else AdaptiveSampler()
+
+        self.phash_index = phash_index
+        self.phash_radius = phash_radius
+        self.stats = stats
+
+    def select(self, frame, frame_num, analysis_frame=None, thumb=None):
+        """
+        Return (keep, phash, frame) for a candidate frame. `phash` is None without an
+        index. `frame` is the given one, fetched if it is a callable and the index
+        needed it: pass kept frames through `_resolve_frame`.
+        """
+        if self.sampler is not None and not self.sampler.due(frame_num):
+            if self.stats is not None:
+                self.stats.add(skipped=1)
+            return False, None, frame
+
+        if self.deduplicator is not None:
+            if analysis_frame is None:
+                des, thumb = self.deduplicator.compute_features(frame)
+            else:
+                des = self.deduplicator.compute_descriptors(analysis_frame)
+
+            thumb_delta = None
+            if self.sampler is not None:
+                # the dedup distance is the activity signal of the sampler
+                thumb_delta = self.deduplicator.get_thumb_delta(thumb)
+                self.sampler.update(frame_num, thumb_delta)
+
+            if not self.deduplicator.check_features(des, thumb, thumb_delta):
+                return False, None, frame
+
+        phash = None
+        if self.phash_index is not None:
+            frame = _resolve_frame(frame)
+            phash = compute_phash(frame)
+            if self.phash_index.contains(phash, self.phash_radius):
+                return False, None, frame
+
+        if self.stats is not None:
+            self.stats.add(kept=1)
+
+        return True, phash, frame
+
+
+def kept_frame_generator(video_path, width, height, analysis_width=None, phash_index=None, phash_radius=DEFAULT_RADIUS,
+                         strategy=ExtractionStrategy.ORB, fps=SAMPLE_FPS, scene_threshold=DEFAULT_SCENE_THRESHOLD,
+                         stats=None, sampler=None):
+    """
+    Yield (frame, frame_num, phash) for the kept frames of the video.
+
+    `strategy` selects the candidate frames (see `ExtractionStrategy`): `fps` is only
+    used by FIXED_FPS, `scene_threshold` by SCENE and `sampler` (an `AdaptiveSampler`,
+    default one if None) by ADAPTIVE. Only the ORB and ADAPTIVE strategies run the
+    ORB/thumbnail dedup. With `analysis_width` set, its checks run on the downscaled
+    streams decoded alongside the full resolution one (see `analysis_frame_generator`).
+    For ADAPTIVE, `frame_num` counts frames at `sampler.max_fps`, and with
+    `sampler.fetch_kept_frames` only the kept frames are decoded at full resolution
+    (see `_frame_source`).
+
+    With a `phash_index` (see `phash_index.PerceptualHashIndex`), frames within
+    `phash_radius` of a frame indexed from another video are dropped as well. The
+    index is only read: the caller adds the `phash` of the kept frames once the
+    video is fully processed. `phash` is None without an index.
+
+    The counters of `stats` (an `ExtractionStats`) are updated as frames go through.
+    """
+    selector = FrameSelector(strategy, phash_index, phash_radius, sampler=sampler, stats=stats)
+
+    for frame, frame_num, analysis_frame, thumb in tqdm(_count_frames(_frame_source(video_path, width, height,
+                                                                                    strategy=strategy,
+                                                                                    fps=fps,
+                                                                                    scene_threshold=scene_threshold,
+                                                                                    analysis_width=analysis_width,
+                                                                                    sampler=selector.sampler),
+                                                                      stats)):
+        keep, phash, frame = selector.select(frame, frame_num, analysis_frame, thumb)
+        if keep:
+            yield _resolve_frame(frame), frame_num, phash
+
+
+def staged_frame_generator(video_path, width, height, process_frame, analysis_width=None, phash_index=None,
+                           phash_radius=DEFAULT_RADIUS, strategy=ExtractionStrategy.ORB, fps=SAMPLE_FPS,
+                           scene_threshold=DEFAULT_SCENE_THRESHOLD, stats=None, sampler=None,
+                           num_workers=4, queue_size=8):
+    """
+    Same selection as `kept_frame_generator`, run as three stages connected by
+    bounded queues: the ffmpeg reader, the dedup (one thread, in order), and
+    `process_frame(frame, frame_num, phash, index)` on `num_workers` threads, where
+    `index` counts the kept frames. Yields the results of `process_frame`, not
+    necessarily in frame order.
+
+    The per-stage queue depth, idle and busy times are written to
+    `stats.stage_metrics` when the video is done.
+    """
+    selector = FrameSelector(strategy, phash_index, phash_radius, sampler=sampler, stats=stats)
+    kept_count = itertools.count()
+
+    def select(item):
+        frame, frame_num, analysis_frame, thumb = item
+        keep, phash, frame = selector.select(frame, frame_num, analysis_frame, thumb)
+        if not keep:
+            return None
+
+        return frame, frame_num, phash, next(kept_count)
+
+    def process(item):
+        # ADAPTIVE frames are fetched at full resolution by the workers, off the dedup thread
+        frame, frame_num, phash, index = item
+        return process_frame(_resolve_frame(frame), frame_num, phash, index)
+
+    pipeline = StagePipeline([
+        Stage('dedup', select, num_workers=1, queue_size=queue_size),
+        Stage('process', process, num_workers=num_workers, queue_size=queue_size),
+    ], name='frames')
+
+    source = _count_frames(_frame_source(video_path, width, height,
+                                         strategy=strategy,
+                                         fps=fps,
+                                         scene_threshold=scene_threshold,
+                                         analysis_width=analysis_width,
+                                         sampler=selector.sampler),
+                           stats)
+    try:
+        yield from tqdm(pipeline.run(source))
+    finally:
+        if stats is not None:
+            stats.stage_metrics = pipeline.get_metrics()
+
+
+def stream_video(video_path, fps, analysis_width=None, phash_index=None, phash_radius=DEFAULT_RADIUS,
+                 strategy=ExtractionStrategy.ORB, scene_threshold=DEFAULT_SCENE_THRESHOLD, stats=None,
+                 pipelined=False, num_workers=4, sampler=None, known_hashes=None, num_hash_workers=0):
+    """
+    Decode and deduplicate a video entirely in memory.
+
+    Yields (data, frame_info, decoded_frame) for every kept frame, where `data` is
+    the frame encoded as JPEG, `frame_info` holds the same fields as the dicts
+    returned by `process_video` (computed from `data`, see `fingerprint_frame`),
+    except `file_path`, and `decoded_frame` the RGB pixels of `data`, decoded once
+    for hashing and reused for the CLIP encoder. Upload `data` as is so that the
+    stored object has the registered hash. Nothing is written to disk.
+
+    With `pipelined`, decoding, dedup and hashing run in separate threads (see
+    `staged_frame_generator`) and frames may be yielded out of order. Frames whose
+    image hash is in `known_hashes` (see `known_hash_index.KnownHashIndex`) are
+    dropped once fingerprinted. With `num_hash_workers`, the two digests of each
+    frame are computed in parallel on a thread pool (see `get_data_hashes`).
+    """
+    info = get_video_info(video_path)
+    print(info)
+
+    if stats is None:
+        stats = ExtractionStats(strategy)
+
+    known_count = itertools.count()
+    hash_executor = ThreadPoolExecutor(max_workers=num_hash_workers) if num_hash_workers else None
+
+    def fingerprint(frame, frame_num, phash, index=None):
+        data, frame_info, decoded_frame = fingerprint_frame_decoded(frame, executor=hash_executor)
+        if _is_known(frame_info, known_hashes, known_count):
+            return None
+        frame_info['frame_num'] = frame_num
+        if phash is not None:
+            frame_info['phash'] = phash
+        return data, frame_info, decoded_frame
+
+    selection = dict(analysis_width=analysis_width,
+                     phash_index=phash_index,
+                     phash_radius=phash_radius,
+                     strategy=strategy,
+                     fps=fps,
+                     scene_threshold=scene_threshold,
+                     stats=stats,
+                     sampler=sampler)
+
+    try:
+        if pipelined:
+            yield from staged_frame_generator(video_path, info['width'], info['height'], fingerprint,
+                                              num_workers=num_workers, **selection)
+        else:
+            for frame, frame_num, phash in kept_frame_generator(video_path, info['width'], info['height'], **selection):
+                result = fingerprint(frame, frame_num, phash)
+                if result is not None:
+                    yield result
+    finally:
+        if hash_executor is not None:
+            hash_executor.shutdown()
+
+    # next() returns the number of frames counted so far
+    stats.add(known=next(known_count))
+    stats.stop()
+    print(stats)
+
+
+def check_segmented_options(num_segments, strategy=ExtractionStrategy.ORB, analysis_width=None, pipelined=False):
+    """
+    Raise ValueError if `num_segments` > 1 is combined with options the segmented
+    mode of `process_video` cannot honor: it runs the ORB strategy on full
+    resolution frames, in one process per segment.
+    """
+    if num_segments <= 1:
+        return
+
+    unsupported = []
+    if strategy != ExtractionStrategy.ORB:
+        unsupported.append(f"strategy={strategy}")
+    if analysis_width is not None:
+        unsupported.append(f"analysis_width={analysis_width}")
+    if pipelined:
+        unsupported.append("pipelined")
+    if unsupported:
+        raise ValueError(f"num_segments={num_segments} only supports the {ExtractionStrategy.ORB} strategy on full "
+                         f"resolution frames, not pipelined, got {', '.join(unsupported)}")
+
+
+def process_video(video_path, output_dir, fps, num_segments=1, analysis_width=None,
+                  phash_index=None, phash_radius=DEFAULT_RADIUS,
+                  strategy=ExtractionStrategy.ORB, scene_threshold=DEFAULT_SCENE_THRESHOLD, stats=None,
+                  pipelined=False, num_workers=4, sampler=None, known_hashes=None, num_hash_workers=0):
+    """
+    Extract the frames selected by `strategy` (see `kept_frame_generator`) into
+    `output_dir` and return their info dicts. `fps` is the sampling rate of the
+    FIXED_FPS strategy and `sampler` configures the ADAPTIVE one (see
+    `adaptive_sampler.AdaptiveSampler`). `num_segments` > 1 decodes in parallel
+    processes, only with the ORB strategy, without `analysis_width` or `pipelined`
+    (ValueError otherwise, see `check_segmented_options`). With `pipelined`, decoding, dedup and saving run
+    in separate threads, `num_workers` of them saving the frames (see
+    `staged_frame_generator`). Frames whose image hash is in `known_hashes` are
+    not saved. With `num_hash_workers`, the two digests of each frame are computed
+    in parallel on a thread pool (see `get_data_hashes`). Throughput and kept-frame counts are written to `stats` when
+    given, and printed.
+    """
+    check_segmented_options(num_segments, strategy, analysis_width, pipelined)
+
+    if stats is None:
+        stats = ExtractionStats(strategy)
+
+    if num_segments > 1:
+        frames = process_video_segmented(video_path, output_dir, fps, num_segments,
+                                         phash_index=phash_index,
+                                         phash_radius=phash_radius,
+                                         stats=stats,
+                                         num_hash_workers=num_hash_workers)
+        if known_hashes is not None:
+            # fingerprinted in the worker processes, dropped here
+            new_frames = []
+            for frame_info in frames:
+                if known_hashes.contains(frame_info['image_hash']):
+                    os.remove(frame_info['file_path'])
+                    stats.add(known=1)
+                else:
+                    new_frames.append(frame_info)
+            frames = new_frames
+        stats.stop()
+        print(stats)
+        return frames
 
     info = get_video_info(video_path)
     print(info)
 
     os.makedirs(output_dir, exist_ok=True)
 
-    distance_threshold = 40
-    match_ratio_threshold = 0.75
-    thumb_delta_threshold = 0.1
+    known_count = itertools.count()
+    hash_executor = ThreadPoolExecutor(max_workers=num_hash_workers) if num_hash_workers else None
+
+    def save(frame, frame_num, phash, index):
+        frame_path = os.path.join(output_dir, f'{index:05d}.jpg')
+        frame_info = _write_frame(frame, frame_path, known_hashes, known_count, hash_executor)
+        if frame_info is None:
+            return None
+        frame_info['frame_num'] = frame_num
+        frame_info['file_path'] = frame_path
+        if phash is not None:
+            frame_info['phash'] = phash
 
-    num_old_thumbs = 64
+        return frame_info
+
+    selection = dict(analysis_width=analysis_width,
+                     phash_index=phash_index,
+                     phash_radius=phash_radius,
+                     strategy=strategy,
+                     fps=fps,
+                     scene_threshold=scene_threshold,
+                     stats=stats,
+                     sampler=sampler)
+
+    try:
+        if pipelined:
+            frames = list(staged_frame_generator(video_path, info['width'], info['height'], save,
+                                                 num_workers=num_workers, **selection))
+            frames.sort(key=lambda frame_info: frame_info['frame_num'])
+        else:
+            frames = [save(frame, frame_num, phash, index)
+                      for index, (frame, frame_num, phash) in enumerate(kept_frame_generator(video_path,
+                                                                                             info['width'],
+                                                                                             info['height'],
+                                                                                             **selection))]
+            frames = [frame_info for frame_info in frames if frame_info is not None]
+    finally:
+        if hash_executor is not None:
+            hash_executor.shutdown()
+
+    # next() returns the number of frames counted so far
+    stats.add(known=next(known_count))
+    stats.stop()
+    print(stats)
+
+    return frames
 
-    orb = cv2.ORB_create()
+def _process_segment(video_path, output_dir, start, end, width, height, num_hash_workers=0):
+    """
+    Decode and deduplicate the frames of [start, end) and save the kept ones.
 
-    count = 0
+    Runs in a worker process of `process_video_segmented`. Returns a
+    (frame_num, des, thumb, frame_info, phash) tuple for every sampled frame, with
+    `frame_info` and `phash` set to None for the frames that were not saved, so that
+    the parent can replay the dedup of the whole video without decoding it again.
+    """
+    first_frame_num = round(start * SAMPLE_FPS)
+    last_frame_num = None if end is None else round(end * SAMPLE_FPS)
 
-    old_kp, old_des = None, None
-    old_thumbs = list()
+    deduplicator = FrameDeduplicator()
+    hash_executor = ThreadPoolExecutor(max_workers=num_hash_workers) if num_hash_workers else None
 
     frames = []
-    # for frame, frame_num in tqdm(key_frame_generator(video_path, width=info['width'], height=info['height'])):
-    for frame, frame_num in tqdm(frame_generator(video_path, width=info['width'], height=info['height'])):
-    
-        kp, des = orb.detectAndCompute(frame, None)
+    try:
+        for frame, frame_num in frame_generator(video_path, start=start, end=end, width=width, height=height):
+            frame_num += first_frame_num
+            # the next segment starts on this timestamp
+            if last_frame_num is not None and frame_num >= last_frame_num:
+                break
 
-        thumb = np.array(Image.fromarray(frame).resize((64, 64))).astype(float) / 255.
+            des, thumb = deduplicator.compute_features(frame)
 
-        if old_kp is not None and old_des is not None:
-            
-            matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
-            matches = matcher.match(des, old_des)
-            matches = sorted(matches, key=lambda x: x.distance)
+            frame_info, phash = None, None
+            if deduplicator.check_features(des, thumb):
+                frame_info = _save_frame(frame, frame_num, output_dir, hash_executor)
+                phash = compute_phash(frame)
 
-            good_matches = [m for m in matches if m.distance < distance_threshold]
-            good_ratio = len(good_matches) / len(matches) if matches else 0
+            frames.append((frame_num, des, thumb, frame_info, phash))
+    finally:
+        if hash_executor is not None:
+            hash_executor.shutdown()
+
+    return frames
+
+
+def _is_known(frame_info, known_hashes, known_count):
+    if known_hashes is None or not known_hashes.contains(frame_info['image_hash']):
+        return False
+    # itertools.count is thread-safe, unlike incrementing the stats from the workers
+    next(known_count)
+    return True
+
+
+def _write_frame(frame, frame_path, known_hashes=None, known_count=None, hash_executor=None):
+    """
+    Save `frame` as JPEG and return its `get_image_info` dict, computed from the
+    encoded bytes instead of reading the file back. Returns None without saving
+    it if its image hash is in `known_hashes`.
+    """
+    data, frame_info = fingerprint_frame(frame, executor=hash_executor)
+    if _is_known(frame_info, known_hashes, known_count):
+        return None
+    with open(frame_path, 'wb') as f:
+        f.write(data)
+
+    return frame_info
+
+
+def _save_frame(frame, frame_num, output_dir, hash_executor=None):
+    # renamed to the names of the serial mode once the kept frames are known
+    frame_path = os.path.join(output_dir, f'segment_{frame_num:06d}.jpg')
+    frame_info = _write_frame(frame, frame_path, hash_executor=hash_executor)
+    frame_info['frame_num'] = frame_num
+    frame_info['file_path'] = frame_path
+
+    return frame_info
 
-            if good_ratio > match_ratio_threshold:
-                continue
 
-            delta = np.abs(thumb - np.stack(old_thumbs, axis=0)).mean(-1).mean(-1).mean(-1).min()
+def _decode_frame_at(video_path, frame_num, width, height, fps=SAMPLE_FPS):
+    # the `frame_num`-th frame of `frame_generator` at `fps`, decoded from a seek
+    start = frame_num / fps
+    for frame, _ in frame_generator(video_path, start=start, end=start + 1 / fps, fps=fps, width=width, height=height):
+        return frame
 
-            if delta < thumb_delta_threshold:
+
+def process_video_segmented(video_path, output_dir, fps, num_segments, max_workers=None, replay_block_size=32,
+                            phash_index=None, phash_radius=DEFAULT_RADIUS, stats=None, num_hash_workers=0):
+    """
+    Same output as `process_video`, with the video split into `num_segments` time
+    ranges aligned to keyframes that are decoded and deduplicated in parallel
+    processes.
+
+    Each segment starts with an empty dedup history, so the parent replays the dedup
+    checks over the features of all sampled frames, in order. Frames kept by a
+    segment but not by the replay are deleted, and the few frames kept only by the
+    replay (near a segment boundary) are decoded again with a short seek. The
+    `phash_index` is consulted during the replay, in frame order. The kept frames
+    are then renamed `{index:05d}.jpg` in frame order, as in the serial mode.
+    """
+    info = get_video_info(video_path)
+    print(info)
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    segments = get_segments(get_keyframe_timestamps(video_path),
+                            get_video_duration(video_path),
+                            num_segments)
+
+    with ProcessPoolExecutor(max_workers=max_workers or len(segments)) as executor:
+        futures = [executor.submit(_process_segment,
+                                   video_path,
+                                   output_dir,
+                                   start,
+                                   end,
+                                   info['width'],
+                                   info['height'],
+                                   num_hash_workers)
+                   for start, end in segments]
+        segment_frames = [future.result() for future in futures]
+
+    candidates = [frame for segment in segment_frames for frame in segment]
+    if stats is not None:
+        stats.add(sampled=len(candidates))
+
+    deduplicator = FrameDeduplicator()
+
+    frames = []
+    for start in tqdm(range(0, len(candidates), replay_block_size)):
+        block = candidates[start:start + replay_block_size]
+        kept = deduplicator.check_features_block([des for _, des, _, _, _ in block],
+                                                 [thumb for _, _, thumb, _, _ in block])
+
+        for is_kept, (frame_num, _, _, frame_info, phash) in zip(kept, block):
+            frame = None
+            if is_kept and frame_info is None:
+                frame = _decode_frame_at(video_path, frame_num, info['width'], info['height'])
+                is_kept = frame is not None
+                if is_kept:
+                    phash = compute_phash(frame)
+
+            if is_kept and phash_index is not None:
+                is_kept = not phash_index.contains(phash, phash_radius)
+
+            if not is_kept:
+                if frame_info is not None:
+                    os.remove(frame_info['file_path'])
                 continue
-        
-        frame_path = os.path.join(output_dir, f'{count:05d}.jpg')
-        Image.fromarray(frame).save(frame_path)
 
-        frame_info = get_image_info(frame_path)
-        frame_info['frame_num'] = frame_num
+            if frame_info is None:
+                frame_info = _save_frame(frame, frame_num, output_dir)
+            if phash_index is not None:
+                frame_info['phash'] = phash
+
+            frames.append(frame_info)
+
+    # same names as the serial mode, numbered in frame order
+    for index, frame_info in enumerate(frames):
+        frame_path = os.path.join(output_dir, f'{index:05d}.jpg')
+        os.replace(frame_info['file_path'], frame_path)
         frame_info['file_path'] = frame_path
 
-        frames.append(frame_info)
+    if stats is not None:
+        stats.add(kept=len(frames))
 
-        count += 1
-        
-        old_kp, old_des = kp, des
-        if len(old_thumbs) >= num_old_thumbs:
-            old_thumbs = old_thumbs[1:]
-        old_thumbs.append(thumb)
-    
     return frames
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process a video.")
     parser.add_argument("--video_path", type=str, required=True, help="Path to the input video file")
     parser.add_argument("--output_dir", type=str, required=True, help="Path where the output video should be saved")
-    parser.add_argument("--fps", type=int, required=True, help="Frames per second for the output video")
+    parser.add_argument("--fps", type=float, required=True, help="Sampling rate of the fps strategy")
+    parser.add_argument("--num_segments", type=int, default=1, help="Number of time ranges decoded in parallel processes")
+    parser.add_argument("--analysis_width", type=int, default=None, help="Width of the grayscale stream used for dedup")
+    parser.add_argument("--phash_index_path", type=str, default=None, help="Perceptual hash index of frames to skip, updated with the kept ones")
+    parser.add_argument("--known_hash_index_path", type=str, default=None, help="Index of registered image hashes to skip, updated with the kept ones")
+    parser.add_argument("--strategy", type=str, default=ExtractionStrategy.ORB, choices=ExtractionStrategy.ALL, help="How candidate frames are selected")
+    parser.add_argument("--scene_threshold", type=float, default=DEFAULT_SCENE_THRESHOLD, help="Scene change score threshold of the scene strategy")
+    parser.add_argument("--min_fps", type=float, default=adaptive_sampler.DEFAULT_MIN_FPS, help="Lowest sampling rate of the adaptive strategy")
+    parser.add_argument("--max_fps", type=float, default=adaptive_sampler.DEFAULT_MAX_FPS, help="Highest sampling rate of the adaptive strategy")
+    parser.add_argument("--pipe_all_frames", action="store_true", help="Pipe every frame of the adaptive strategy at full resolution instead of fetching the kept ones")
+    parser.add_argument("--pipelined", action="store_true", help="Run decoding, dedup and saving in separate threads")
+    parser.add_argument("--num_workers", type=int, default=4, help="Number of threads saving frames in pipelined mode")
 
     args = parser.parse_args()
 
-    print(process_video(args.video_path, args.output_dir, args.fps))
+    phash_index = None
+    if args.phash_index_path is not None:
+        phash_index = PerceptualHashIndex.load_or_create(args.phash_index_path)
+
+    known_hashes = None
+    if args.known_hash_index_path is not None:
+        known_hashes = KnownHashIndex(args.known_hash_index_path)
+
+    frames = process_video(args.video_path, args.output_dir, args.fps,
+                           num_segments=args.num_segments,
+                           analysis_width=args.analysis_width,
+                           phash_index=phash_index,
+                           strategy=args.strategy,
+                           scene_threshold=args.scene_threshold,
+                           pipelined=args.pipelined,
+                           num_workers=args.num_workers,
+                           sampler=AdaptiveSampler(min_fps=args.min_fps, max_fps=args.max_fps,
+                                                   fetch_kept_frames=not args.pipe_all_frames),
+                           known_hashes=known_hashes)
+    print(frames)
+
+    if phash_index is not None:
+        for frame_info in frames:
+            phash_index.add(frame_info['phash'])
+        phash_index.save(args.phash_index_path)
+
+    if known_hashes is not None:
+        for frame_info in frames:
+            known_hashes.add(frame_info['image_hash'])
+        known_hashes.sync(force=True)
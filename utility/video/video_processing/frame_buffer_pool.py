@@ -0,0 +1,87 @@
+import sys
+import threading
+
+import numpy as np
+
+
+class FrameBufferPool():
+    """
+    Preallocated frame arrays recycled across the frames read from a pipe.
+
+    A buffer is handed out again only once nothing outside the pool references it
+    anymore (CPython reference count), so consumers may keep frames, or arrays and
+    images viewing them, as long as they need without releasing them explicitly.
+    The pool grows while all its buffers are in use, up to `max_size` buffers;
+    beyond that, frames are allocated and left to the garbage collector.
+    """
+
+    def __init__(self, shape, dtype=np.uint8, size=4, max_size=64):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.max_size = max_size
+
+        self._buffers = []
+        self._lock = threading.Lock()
+        # reference count of a buffer held only by the pool
+        self._free_refcount = None
+
+        for _ in range(size):
+            self._allocate()
+
+    def __len__(self):
+        return len(self._buffers)
+
+    def _allocate(self):
+        self._buffers.append(np.empty(self.shape, dtype=self.dtype))
+        if self._free_refcount is None:
+            self._free_refcount = sys.getrefcount(self._buffers[-1])
+        return self._buffers[-1]
+
+    def acquire(self) -> np.ndarray:
+        """
+        Return a buffer that nobody else references. Its content is undefined.
+        """
+        with self._lock:
+            for index in range(len(self._buffers)):
+                if sys.getrefcount(self._buffers[index]) <= self._free_refcount:
+                    return self._buffers[index]
+
+            if len(self._buffers) < self.max_size:
+                return self._allocate()
+
+        return np.empty(self.shape, dtype=self.dtype)
+
+
+def read_frame_into(pipe, buffer) -> bool:
+    """
+    Fill the C-contiguous `buffer` from `pipe`, looping over short reads.
+
+    Returns False at the end of the stream, including when it ends in the middle
+    of a frame, in which case the incomplete frame is dropped.
+    """
+    with memoryview(buffer) as buffer_view, buffer_view.cast('B') as view:
+        filled = 0
+        while filled < len(view):
+            count = pipe.readinto(view[filled:])
+            if not count:
+                return False
+            filled += count
+
+    return True
+
+
+def read_frames(pipe, shape, pool=None):
+    """
+    Yield the frames of `shape` (uint8) read from `pipe` into the buffers of `pool`,
+    a `FrameBufferPool` created for the stream if None.
+    """
+    if pool is None:
+        pool = FrameBufferPool(shape)
+
+    while True:
+        frame = pool.acquire()
+        if not read_frame_into(pipe, frame):
+            break
+        yield frame
+        # drop the generator's own reference so the buffer can be recycled
+        del frame
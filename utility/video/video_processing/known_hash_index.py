@@ -0,0 +1,248 @@
+import os
+import math
+import time
+import struct
+import threading
+import argparse
+
+import numpy as np
+
+import sys
+base_dir = './'
+sys.path.insert(0, base_dir)
+
+from utility.utils.file_utils import file_lock
+from utility import logger
+
+# on-disk format: magic, version, number of hashes, then the sorted 32-byte digests
+INDEX_MAGIC = b'KHIX'
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct('<4sIQ')
+DIGEST_SIZE = 32
+DIGEST_DTYPE = np.dtype(f'S{DIGEST_SIZE}')
+
+DEFAULT_FALSE_POSITIVE_RATE = 0.01
+# seconds between two writes of the index file by `sync`
+DEFAULT_SYNC_INTERVAL = 60.
+# digests hashed into the Bloom filter at a time
+_BLOOM_CHUNK_SIZE = 1 << 16
+
+
+class BloomFilter():
+    """
+    Bloom filter over uniformly distributed digests (sha256): the bit positions
+    are derived from the first 16 bytes of the digest by double hashing, without
+    hashing again.
+    """
+
+    def __init__(self, capacity: int, false_positive_rate: float = DEFAULT_FALSE_POSITIVE_RATE):
+        self.capacity = max(capacity, 1024)
+        self.false_positive_rate = false_positive_rate
+        self.num_bits = int(math.ceil(-self.capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / self.capacity * math.log(2)))
+        self.bits = np.zeros((self.num_bits + 7) // 8, dtype=np.uint8)
+        self.count = 0
+
+    def _positions(self, digests):
+        digests = np.frombuffer(digests.tobytes(), dtype=np.uint8).reshape(-1, DIGEST_SIZE)
+        h1 = digests[:, :8].copy().view('<u8')
+        h2 = digests[:, 8:16].copy().view('<u8') | np.uint64(1)
+        steps = np.arange(self.num_hashes, dtype=np.uint64)
+
+        return (h1 + steps * h2) % np.uint64(self.num_bits)
+
+    def add_many(self, digests) -> None:
+        """
+        Add an array of digests (dtype `DIGEST_DTYPE`).
+        """
+        for start in range(0, len(digests), _BLOOM_CHUNK_SIZE):
+            positions = self._positions(digests[start:start + _BLOOM_CHUNK_SIZE]).ravel()
+            np.bitwise_or.at(self.bits, positions >> np.uint64(3), np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+        self.count += len(digests)
+
+    def _digest_positions(self, digest):
+        # same positions as `_positions`, without the numpy overhead of a single digest
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:16], 'little') | 1
+        return [((h1 + step * h2) & 0xFFFFFFFFFFFFFFFF) % self.num_bits for step in range(self.num_hashes)]
+
+    def add(self, digest: bytes) -> None:
+        for position in self._digest_positions(digest):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, digest: bytes) -> bool:
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._digest_positions(digest))
+
+
+def _read_digests(path):
+    with open(path, 'rb') as f:
+        magic, version, count = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+    if magic != INDEX_MAGIC:
+        raise ValueError(f"{path} is not a known hash index")
+    if version != INDEX_VERSION:
+        raise ValueError(f"Unsupported known hash index version {version} in {path}")
+    if count == 0:
+        return np.empty(0, dtype=DIGEST_DTYPE)
+
+    return np.memmap(path, dtype=DIGEST_DTYPE, mode='r', offset=INDEX_HEADER.size, shape=(count,))
+
+
+class KnownHashIndex():
+    """
+    Set of image hashes (the sha256 `image_hash` of the frame metadata) already
+    registered on the server, so that known frames are dropped right after being
+    fingerprinted, before they are saved, registered, embedded and uploaded.
+
+    Lookups go through a Bloom filter; its positives are confirmed against the
+    exact set: the sorted digests of the index file (memory-mapped, binary
+    searched) and the hashes added since the last sync. `sync` merges the hashes
+    saved by other processes and writes the union back. Safe to share between
+    threads.
+    """
+
+    def __init__(self, path: str = None,
+                 false_positive_rate: float = DEFAULT_FALSE_POSITIVE_RATE,
+                 sync_interval: float = DEFAULT_SYNC_INTERVAL):
+        self.path = path
+        self.false_positive_rate = false_positive_rate
+        self.sync_interval = sync_interval
+
+        self._digests = np.empty(0, dtype=DIGEST_DTYPE)
+        self._added = set()
+        self._last_sync = time.monotonic()
+        self._lock = threading.Lock()
+
+        if path is not None and os.path.isfile(path):
+            self._digests = _read_digests(path)
+        self._bloom = self._build_bloom(len(self._digests))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._digests) + len(self._added)
+
+    def _build_bloom(self, count):
+        bloom = BloomFilter(2 * count, self.false_positive_rate)
+        bloom.add_many(self._digests)
+        if self._added:
+            bloom.add_many(np.array(list(self._added), dtype=DIGEST_DTYPE))
+        return bloom
+
+    def _in_digests(self, digest):
+        digest = np.array([digest], dtype=DIGEST_DTYPE)
+        index = np.searchsorted(self._digests, digest)[0]
+        # compared as arrays: numpy strips the trailing zero bytes of the scalars
+        return index < len(self._digests) and bool(self._digests[index:index + 1] == digest)
+
+    def _contains(self, digest):
+        if digest not in self._bloom:
+            return False
+        return digest in self._added or self._in_digests(digest)
+
+    def contains(self, image_hash: str) -> bool:
+        digest = bytes.fromhex(image_hash)
+        with self._lock:
+            return self._contains(digest)
+
+    def add(self, image_hash: str) -> bool:
+        """
+        Add a hash. Returns False if it was already known.
+        """
+        digest = bytes.fromhex(image_hash)
+        with self._lock:
+            if self._contains(digest):
+                return False
+            self._added.add(digest)
+            self._bloom.add(digest)
+            if self._bloom.count > self._bloom.capacity:
+                self._bloom = self._build_bloom(len(self._digests) + len(self._added))
+            return True
+
+    def sync(self, force: bool = False) -> int:
+        """
+        Merge the hashes saved to `path` by other processes and write the union
+        back, atomically, at most once per `sync_interval` seconds unless `force`.
+        The read-merge-write holds the lock of `path`, so that concurrent syncs of
+        other processes do not drop each other's hashes. Returns the number of
+        hashes picked up from the file.
+        """
+        if self.path is None:
+            return 0
+
+        with self._lock:
+            if not force and time.monotonic() - self._last_sync < self.sync_interval:
+                return 0
+            self._last_sync = time.monotonic()
+
+            with file_lock(self.path):
+                saved = _read_digests(self.path) if os.path.isfile(self.path) else np.empty(0, dtype=DIGEST_DTYPE)
+                picked_up = np.setdiff1d(saved, self._digests, assume_unique=True)
+                digests = np.union1d(saved, np.array(list(self._added), dtype=DIGEST_DTYPE))
+
+                if len(digests) != len(saved):
+                    temp_path = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp'
+                    with open(temp_path, 'wb') as f:
+                        f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(digests)))
+                        f.write(digests.tobytes())
+                    os.replace(temp_path, self.path)
+
+                self._digests = _read_digests(self.path) if len(digests) else digests
+            self._added = set()
+            self._bloom.add_many(picked_up)
+            if self._bloom.count > self._bloom.capacity:
+                self._bloom = self._build_bloom(len(self._digests))
+
+            return len(picked_up)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(path: str) -> KnownHashIndex:
+    """
+    Return the index stored at `path`, loaded once per process so that the
+    pipelines running in threads share the same instance.
+    """
+    path = os.path.abspath(path)
+    with _indexes_lock:
+        if path not in _indexes:
+            _indexes[path] = KnownHashIndex(path)
+            logger.debug(msg=f"Loaded known hash index with {len(_indexes[path])} hashes: {path}")
+        return _indexes[path]
+
+
+def sync_all() -> None:
+    """
+    Write the hashes added to the indexes loaded by `get_index`, e.g. before exit.
+    """
+    with _indexes_lock:
+        indexes = list(_indexes.values())
+    for index in indexes:
+        index.sync(force=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import and query known image hash indexes.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser("import", help="Add the hashes of a text file (one hex sha256 per line), e.g. exported from the server")
+    import_parser.add_argument("--hashes_path", type=str, required=True, help="Text file of image hashes")
+    import_parser.add_argument("--index_path", type=str, required=True, help="Path of the index file")
+
+    query_parser = subparsers.add_parser("query", help="Check whether image hashes are known")
+    query_parser.add_argument("--image_hashes", type=str, nargs='+', required=True, help="Hex sha256 image hashes")
+    query_parser.add_argument("--index_path", type=str, required=True, help="Path of the index file")
+
+    args = parser.parse_args()
+
+    index = KnownHashIndex(args.index_path)
+    if args.command == "import":
+        with open(args.hashes_path) as f:
+            added = sum(index.add(line.strip()) for line in f if line.strip())
+        index.sync(force=True)
+        print(f"{args.index_path}: {added} hashes added, {len(index)} hashes")
+    elif args.command == "query":
+        for image_hash in args.image_hashes:
+            print(f"{image_hash} {'known' if index.contains(image_hash) else 'unknown'}")
@@ -0,0 +1,267 @@
+import os
+import struct
+import threading
+import argparse
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import sys
+base_dir = './'
+sys.path.insert(0, base_dir)
+
+from utility.utils.file_utils import file_lock
+from utility import logger
+
+# on-disk format: magic, version, number of hashes, then the 64-bit hashes (little-endian)
+INDEX_MAGIC = b'PHIX'
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct('<4sIQ')
+
+DEFAULT_RADIUS = 4
+
+
+def compute_phash(image) -> int:
+    """
+    64-bit DCT perceptual hash of an RGB (HxWx3) or grayscale (HxW) uint8 image.
+    """
+    image = np.asarray(image)
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+
+    small = cv2.resize(image, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low_freq = cv2.dct(small)[:8, :8].flatten()
+    # the DC coefficient is left out of the median, as it only encodes brightness
+    bits = low_freq > np.median(low_freq[1:])
+
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+class BKTree():
+    """
+    Burkhard-Keller tree over 64-bit hashes with the Hamming distance.
+
+    Each node is a [hash, children] list, where children maps a distance to the
+    subtree of hashes at that distance from the node.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, value: int) -> bool:
+        """
+        Insert `value`. Returns False if it was already in the tree.
+        """
+        if self.root is None:
+            self.root = [value, {}]
+            self.size += 1
+            return True
+
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                return False
+
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = [value, {}]
+                self.size += 1
+                return True
+            node = child
+
+    def query(self, value: int, radius: int):
+        """
+        Return (hash, distance) for every hash within `radius` of `value`.
+        """
+        if self.root is None:
+            return []
+
+        results = []
+        nodes = [self.root]
+        while nodes:
+            node_value, children = nodes.pop()
+            distance = hamming_distance(value, node_value)
+            if distance <= radius:
+                results.append((node_value, distance))
+
+            for child_distance, child in children.items():
+                if distance - radius <= child_distance <= distance + radius:
+                    nodes.append(child)
+
+        return results
+
+    def find_any(self, value: int, radius: int) -> bool:
+        """
+        Return True as soon as a hash within `radius` of `value` is found.
+        """
+        if self.root is None:
+            return False
+
+        nodes = [self.root]
+        while nodes:
+            node_value, children = nodes.pop()
+            distance = hamming_distance(value, node_value)
+            if distance <= radius:
+                return True
+
+            for child_distance, child in children.items():
+                if distance - radius <= child_distance <= distance + radius:
+                    nodes.append(child)
+
+        return False
+
+
+class PerceptualHashIndex():
+    """
+    Set of perceptual hashes of already processed frames (per game or per
+    dataset), with Hamming-radius lookups. Safe to share between threads.
+    """
+
+    def __init__(self, hashes=()):
+        self._tree = BKTree()
+        self._hashes = []
+        self._lock = threading.Lock()
+
+        for value in hashes:
+            self.add(value)
+
+    def __len__(self):
+        return len(self._hashes)
+
+    @property
+    def hashes(self):
+        with self._lock:
+            return list(self._hashes)
+
+    def add(self, value: int) -> bool:
+        with self._lock:
+            if not self._tree.add(value):
+                return False
+            self._hashes.append(value)
+            return True
+
+    def query(self, value: int, radius: int = DEFAULT_RADIUS):
+        with self._lock:
+            return self._tree.query(value, radius)
+
+    def contains(self, value: int, radius: int = DEFAULT_RADIUS) -> bool:
+        with self._lock:
+            return self._tree.find_any(value, radius)
+
+    def merge(self, other: 'PerceptualHashIndex') -> int:
+        """
+        Add the hashes of `other` to this index. Returns the number of new hashes.
+        """
+        return sum(self.add(value) for value in other.hashes)
+
+    def save(self, path: str) -> None:
+        """
+        Write the index to `path`, merged with the hashes already saved there by
+        another process. The file is replaced atomically, under the lock of `path`
+        so that concurrent saves do not drop each other's hashes.
+        """
+        with file_lock(path):
+            if os.path.isfile(path):
+                self.merge(PerceptualHashIndex.load(path))
+
+            hashes = np.array(self.hashes, dtype='<u8')
+
+            temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(hashes)))
+                f.write(hashes.tobytes())
+            os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'PerceptualHashIndex':
+        with open(path, 'rb') as f:
+            magic, version, count = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+            if magic != INDEX_MAGIC:
+                raise ValueError(f"{path} is not a perceptual hash index")
+            if version != INDEX_VERSION:
+                raise ValueError(f"Unsupported perceptual hash index version {version} in {path}")
+            hashes = np.frombuffer(f.read(count * 8), dtype='<u8')
+
+        return cls(int(value) for value in hashes)
+
+    @classmethod
+    def load_or_create(cls, path: str) -> 'PerceptualHashIndex':
+        if os.path.isfile(path):
+            return cls.load(path)
+        return cls()
+
+    @classmethod
+    def build(cls, images) -> 'PerceptualHashIndex':
+        """
+        Build an index from an iterable of RGB or grayscale uint8 images.
+        """
+        return cls(compute_phash(image) for image in images)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(path: str) -> PerceptualHashIndex:
+    """
+    Return the index stored at `path`, loaded once per process so that the
+    pipelines running in threads share the same instance.
+    """
+    path = os.path.abspath(path)
+    with _indexes_lock:
+        if path not in _indexes:
+            _indexes[path] = PerceptualHashIndex.load_or_create(path)
+            logger.debug(msg=f"Loaded perceptual hash index with {len(_indexes[path])} hashes: {path}")
+        return _indexes[path]
+
+
+def _load_images(image_dir):
+    for file_name in sorted(os.listdir(image_dir)):
+        if file_name.lower().endswith(('.jpg', '.jpeg', '.png')):
+            yield np.array(Image.open(os.path.join(image_dir, file_name)).convert('RGB'))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build, query and merge perceptual hash indexes.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Add the images of a directory to an index")
+    build_parser.add_argument("--image_dir", type=str, required=True, help="Directory of jpg/png images")
+    build_parser.add_argument("--index_path", type=str, required=True, help="Path of the index file")
+
+    query_parser = subparsers.add_parser("query", help="List the indexed hashes close to an image")
+    query_parser.add_argument("--image_path", type=str, required=True, help="Path of the image to look up")
+    query_parser.add_argument("--index_path", type=str, required=True, help="Path of the index file")
+    query_parser.add_argument("--radius", type=int, default=DEFAULT_RADIUS, help="Maximum Hamming distance")
+
+    merge_parser = subparsers.add_parser("merge", help="Merge several indexes into one")
+    merge_parser.add_argument("--index_paths", type=str, nargs='+', required=True, help="Paths of the indexes to merge")
+    merge_parser.add_argument("--output_path", type=str, required=True, help="Path of the merged index")
+
+    args = parser.parse_args()
+
+    if args.command == "build":
+        index = PerceptualHashIndex.build(_load_images(args.image_dir))
+        index.save(args.index_path)
+        print(f"{args.index_path}: {len(index)} hashes")
+    elif args.command == "query":
+        index = PerceptualHashIndex.load(args.index_path)
+        value = compute_phash(np.array(Image.open(args.image_path).convert('RGB')))
+        for match, distance in sorted(index.query(value, args.radius), key=lambda x: x[1]):
+            print(f"{match:016x} {distance}")
+    elif args.command == "merge":
+        index = PerceptualHashIndex()
+        for index_path in args.index_paths:
+            index.merge(PerceptualHashIndex.load(index_path))
+        index.save(args.output_path)
+        print(f"{args.output_path}: {len(index)} hashes")
@@ -0,0 +1,93 @@
+import cv2
+import numpy as np
+
+
+class ThumbnailHistory():
+    """
+    Fixed-size circular buffer of the thumbnails of the last kept frames.
+
+    Thumbnails are stored flattened as uint8, and the distance between two
+    thumbnails is the mean absolute difference of their pixels scaled to [0, 1],
+    as in the original near-duplicate check. It is computed from integer sums, so
+    it matches `np.abs(a / 255. - b / 255.).mean()` without any float buffer. Once
+    the buffer is full, appending a thumbnail overwrites the oldest one.
+    """
+
+    def __init__(self, capacity=64, thumb_shape=(64, 64, 3)):
+        self.capacity = capacity
+        self.thumb_shape = tuple(thumb_shape)
+        self.thumb_size = int(np.prod(self.thumb_shape))
+
+        self.buffer = np.zeros((capacity, self.thumb_size), dtype=np.uint8)
+        # pixel sum of each slot, for the distance kernel
+        self.sums = np.zeros(capacity, dtype=np.int64)
+        self.size = 0
+        self.next_slot = 0
+
+    def __len__(self):
+        return self.size
+
+    def _flatten(self, thumbs):
+        thumbs = np.asarray(thumbs)
+        if thumbs.dtype != np.uint8:
+            raise ValueError(f"thumbnails must be uint8 arrays, got {thumbs.dtype}")
+        return thumbs.reshape(-1, self.thumb_size)
+
+    def _scale(self, sums):
+        return sums / (255. * self.thumb_size)
+
+    def append(self, thumb) -> int:
+        """
+        Add a uint8 thumbnail and return the slot it was written to.
+        """
+        slot = self.next_slot
+        self.buffer[slot] = self._flatten(thumb)[0]
+        self.sums[slot] = self.buffer[slot].sum(dtype=np.int64)
+
+        self.next_slot = (slot + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+        return slot
+
+    def distances(self, thumbs) -> np.ndarray:
+        """
+        Score a block of uint8 thumbnails against every slot of the history.
+
+        Returns a (len(thumbs), capacity) float64 array, with inf for the slots
+        that are still empty. The whole block is scored in one broadcast of the
+        thumbnails against the uint8 buffer, from sum |a - b| = sum a + sum b - 2 sum
+        min(a, b), so that the only (n, size, D) operand is a uint8 minimum.
+        """
+        thumbs = self._flatten(thumbs)
+        result = np.full((len(thumbs), self.capacity), np.inf)
+        if self.size == 0 or len(thumbs) == 0:
+            return result
+
+        minimums = np.minimum(thumbs[:, None], self.buffer[None, :self.size])
+        # 32-bit sums of the SIMD reduction hold 255 * D
+        minimum_sums = cv2.reduce(minimums.reshape(-1, self.thumb_size), 1, cv2.REDUCE_SUM, dtype=cv2.CV_32S)
+        minimum_sums = minimum_sums.reshape(len(thumbs), self.size)
+
+        thumb_sums = thumbs.sum(axis=1, dtype=np.int64)
+        sums = thumb_sums[:, None] + self.sums[None, :self.size] - 2 * minimum_sums
+        result[:, :self.size] = self._scale(sums)
+
+        return result
+
+    def min_distance(self, thumb) -> float:
+        """
+        Distance between `thumb` and the closest thumbnail of the history.
+        """
+        return float(self.distances(thumb)[0].min())
+
+    def distance_to_slot(self, thumbs, slot) -> np.ndarray:
+        """
+        Distance between each of `thumbs` and the thumbnail stored in `slot`.
+        """
+        thumbs = self._flatten(thumbs)
+        if len(thumbs) == 0:
+            return np.empty(0)
+
+        diff = cv2.absdiff(thumbs, np.broadcast_to(self.buffer[slot], thumbs.shape).copy())
+        sums = cv2.reduce(diff, 1, cv2.REDUCE_SUM, dtype=cv2.CV_32S)
+        return self._scale(sums[:, 0])